@@ -1,46 +1,424 @@
 import functools
 
+import tensorflow as tf
 from loguru import logger
 
 import ops.augmentations_ops as aug_ops
+from protos import augmentations_pb2
 
+_DETERMINISTIC_TYPES = ('resize', 'horizontal_flip', 'gray_scale')
 
-def build_augmentations(augmentations_proto):
-    augmentations = augmentations_proto.augment_method
-    augmentation_fns = list()
-    for augmentation in augmentations:
+
+def build_augmentations(augmentations_proto, input_signature=None,
+                        resize_fn=None):
+    # When resize_fn is given the resize is folded into the returned function
+    # and cheap geometric augmentations are moved after it, so they run on
+    # the smaller, resized images.
+    # When a seed is configured the returned function is called as
+    # augmentation_fn(x, example_id, epoch) and is fully determined by
+    # (seed, example_id, epoch).
+    plan, deferred_plan = plan_augmentations(
+        augmentations_proto.augment_method,
+        defer_geometric=resize_fn is not None
+    )
+    if resize_fn is not None:
+        plan = plan + [('resize', resize_fn)] + deferred_plan
+    jit_compile = augmentations_proto.jit_compile
+    steps = [(augmentation_type, build_plan_step(augmentation_type,
+                                                 augmentation,
+                                                 jit_compile=jit_compile))
+             for augmentation_type, augmentation in plan]
+    seeded = augmentations_proto.HasField('seed')
+    if seeded:
+        augmentation_fn = build_seeded_augmentations(
+            steps=steps,
+            seed=augmentations_proto.seed
+        )
+    else:
+        augmentation_fns = [fn for _, fn in steps]
+        augmentation_fn = lambda x: functools.reduce(
+            lambda acc, x: x(*acc), augmentation_fns, x
+        )
+    if jit_compile:
+        augmentation_fn = build_compiled_augmentations(
+            augmentation_fn=augmentation_fn,
+            input_signature=input_signature,
+            seeded=seeded
+        )
+    return augmentation_fn
+
+
+def build_seeded_augmentations(steps, seed):
+    # Every stochastic step draws from its own stateless seed, derived from
+    # the global seed, the example id and the epoch. Results then do not
+    # depend on op seeds or execution order, so maps can run in parallel
+    # without a deterministic order and any augmented sample can be
+    # reproduced from its key.
+    logger.debug('Building stateless augmentations with seed {}.'.format(
+        seed))
+
+    def augmentation_fn(x, example_id, epoch=0):
+        if not steps:
+            return x
+        key = tf.random.experimental.stateless_fold_in(
+            tf.stack([tf.constant(seed, tf.int64),
+                      tf.cast(example_id, tf.int64)]),
+            tf.cast(epoch, tf.int64)
+        )
+        step_seeds = tf.random.experimental.stateless_split(key,
+                                                            num=len(steps))
+        for index, (augmentation_type, fn) in enumerate(steps):
+            if augmentation_type in _DETERMINISTIC_TYPES:
+                x = fn(*x)
+            else:
+                x = fn(*x, seed=step_seeds[index])
+        return x
+
+    return augmentation_fn
+
+
+def build_plan_step(augmentation_type, augmentation, jit_compile=False):
+    if augmentation_type == 'resize':
+        fn = augmentation
+    elif augmentation_type == 'random_horizontal_flip':
+        fn = build_random_horizontal_flip(augmentation)
+    elif augmentation_type == 'horizontal_flip':
+        fn = build_horizontal_flip(augmentation)
+    elif augmentation_type == 'random_gray_scale':
+        fn = build_random_grayscale(augmentation)
+    elif augmentation_type == 'gray_scale':
+        fn = build_grayscale(augmentation)
+    elif augmentation_type == 'random_affine':
+        fn = build_random_affine(augmentation, jit_compile)
+    elif augmentation_type == 'random_color_jitter':
+        fn = build_random_color_jitter(augmentation)
+    elif augmentation_type == 'mixup':
+        fn = build_mixup(augmentation)
+    elif augmentation_type == 'cutmix':
+        fn = build_cutmix(augmentation)
+    elif augmentation_type == 'mosaic':
+        fn = build_mosaic(augmentation)
+    elif augmentation_type == 'rand_augment':
+        fn = build_rand_augment(augmentation, jit_compile)
+    else:
+        logger.error('Unsupported augmentation provided.')
+        raise ValueError('Please see the log message above.')
+    return fn
+
+
+def plan_augmentations(augment_methods, defer_geometric=False):
+    # Rewrites the configured augmentations before any graph is built.
+    # Returns a list of (augmentation_type, augmentation_proto) steps and the
+    # list of steps that can run after the resize. Besides the proto oneof
+    # names, steps may be 'horizontal_flip' and 'gray_scale', the
+    # unconditional forms of the random ops. Adjacent gray scales are merged
+    # exactly and adjacent color jitters that always run approximately, see
+    # _mergeable.
+    plan = list()
+    dropped = 0
+    rewritten = 0
+    for augmentation in augment_methods:
         augmentation_type = augmentation.WhichOneof('augmentation')
         augmentation = eval('augmentation.{}'.format(augmentation_type))
-        if augmentation_type == 'random_horizontal_flip':
-            fn = build_random_horizontal_flip(augmentation)
-        elif augmentation_type == 'random_gray_scale':
-            fn = build_random_grayscale(augmentation)
+        probability = _step_probability(augmentation_type, augmentation)
+        if probability is not None and probability <= 0.0:
+            logger.debug('Dropping {} with probability 0.'.format(
+                augmentation_type))
+            dropped += 1
+            continue
+        plan.append(_unconditional_step(augmentation_type, augmentation))
+        # A cancellation exposes an earlier step to the new last one, so keep
+        # folding the tail until it no longer changes.
+        while len(plan) > 1:
+            if _cancels(plan[-2], plan[-1]):
+                logger.debug('Cancelling back-to-back horizontal flips.')
+                del plan[-2:]
+                rewritten += 2
+            elif _mergeable(plan[-2], plan[-1]):
+                logger.debug('Merging adjacent {} augmentations.'.format(
+                    plan[-1][0]))
+                step = plan.pop()
+                plan.append(_merged(plan.pop(), step))
+                rewritten += 1
+            else:
+                break
+
+    deferred_plan = list()
+    if defer_geometric:
+        plan, deferred_plan = _split_at_resize(plan)
+
+    logger.debug(
+        'Augmentation plan: [{}], after resize: [{}]. Dropped {} and rewrote '
+        '{} augmentations.'.format(
+            ', '.join(step[0] for step in plan),
+            ', '.join(step[0] for step in deferred_plan),
+            dropped, rewritten))
+    return plan, deferred_plan
+
+
+def _step_probability(augmentation_type, augmentation):
+    if augmentation_type == 'random_horizontal_flip':
+        return augmentation.flip_probability
+    elif augmentation_type == 'random_gray_scale':
+        return augmentation.gray_probability
+    elif augmentation_type == 'random_color_jitter':
+        return augmentation.jitter_probability
+    return None
+
+
+def _unconditional_step(augmentation_type, augmentation):
+    if augmentation_type not in ('random_horizontal_flip',
+                                 'random_gray_scale'):
+        return augmentation_type, augmentation
+    probability = _step_probability(augmentation_type, augmentation)
+    if probability < 1.0:
+        return augmentation_type, augmentation
+    logger.debug('Making {} unconditional.'.format(augmentation_type))
+    if augmentation_type == 'random_horizontal_flip':
+        return 'horizontal_flip', augmentation
+    return 'gray_scale', augmentation
+
+
+def _cancels(previous_step, step):
+    return previous_step[0] == step[0] == 'horizontal_flip'
+
+
+def _mergeable(previous_step, step):
+    # Graying is idempotent, so two adjacent gray scale steps with the same
+    # settings are one step that fires if either of them would have.
+    # Two adjacent color jitters that always run become one jitter covering
+    # the combined range of adjustments in a single pass. Unlike the gray
+    # scale merge this is not exact: every adjustment is drawn once from the
+    # combined range instead of twice, and nothing is clipped in between.
+    # Jitters with a jitter_probability below 1 are kept apart, since the
+    # combined step could not fire for one of them only.
+    if previous_step[0] == step[0] == 'random_color_jitter':
+        return (previous_step[1].jitter_probability >= 1.0 and
+                step[1].jitter_probability >= 1.0)
+    gray_types = ('random_gray_scale', 'gray_scale')
+    if previous_step[0] not in gray_types or step[0] not in gray_types:
+        return False
+    return (previous_step[1].keep_channels == step[1].keep_channels and
+            previous_step[1].per_example == step[1].per_example)
+
+
+def _merged(previous_step, step):
+    if step[0] == 'random_color_jitter':
+        return _merged_color_jitter(previous_step, step)
+    return _merged_gray_scale(previous_step, step)
+
+
+def _merged_gray_scale(previous_step, step):
+    merged = augmentations_pb2.RandomGrayScale()
+    merged.CopyFrom(step[1])
+    merged.gray_probability = 1.0 - (
+        (1.0 - min(previous_step[1].gray_probability, 1.0)) *
+        (1.0 - min(step[1].gray_probability, 1.0))
+    )
+    return _unconditional_step('random_gray_scale', merged)
+
+
+def _merged_color_jitter(previous_step, step):
+    # Deltas add up and contrast and saturation factors multiply.
+    previous_jitter, jitter = previous_step[1], step[1]
+    merged = augmentations_pb2.RandomColorJitter()
+    merged.max_brightness_delta = (previous_jitter.max_brightness_delta +
+                                   jitter.max_brightness_delta)
+    merged.min_contrast = previous_jitter.min_contrast * jitter.min_contrast
+    merged.max_contrast = previous_jitter.max_contrast * jitter.max_contrast
+    merged.min_saturation = (previous_jitter.min_saturation *
+                             jitter.min_saturation)
+    merged.max_saturation = (previous_jitter.max_saturation *
+                             jitter.max_saturation)
+    merged.max_hue_delta = (previous_jitter.max_hue_delta +
+                            jitter.max_hue_delta)
+    return 'random_color_jitter', merged
+
+
+def _split_at_resize(plan):
+    # Flips commute with the resize and with per pixel colour changes, so a
+    # flip can be moved after the resize as long as no other geometric
+    # augmentation follows it.
+    deferrable_types = ('random_horizontal_flip', 'horizontal_flip')
+    photometric_types = ('random_gray_scale', 'gray_scale',
+                         'random_color_jitter')
+    before_resize = list()
+    after_resize = list()
+    for index, step in enumerate(plan):
+        remaining_types = [s[0] for s in plan[index + 1:]]
+        if step[0] in deferrable_types and all(
+                t in deferrable_types + photometric_types
+                for t in remaining_types):
+            after_resize.append(step)
         else:
-            logger.error('Unsupported augmentation provided.')
-            raise ValueError('Please see the log message above.')
+            before_resize.append(step)
+    return before_resize, after_resize
 
-        augmentation_fns.append(fn)
-    augmentation_fn = lambda x: functools.reduce(
-        lambda acc, x: x(*acc), augmentation_fns, x
+
+def build_compiled_augmentations(augmentation_fn, input_signature=None,
+                                 seeded=False):
+    # input_signature, when given, describes the single
+    # (images, labels, boxes, masks) tuple argument and pins the traced shapes
+    # so the chain is traced and compiled exactly once.
+    logger.debug('Compiling augmentations into a single XLA function.')
+    if input_signature is not None:
+        input_signature = [tuple(input_signature)]
+        if seeded:
+            input_signature += [tf.TensorSpec([], tf.int64),
+                                tf.TensorSpec([], tf.int64)]
+    compiled_fn = tf.function(
+        augmentation_fn,
+        input_signature=input_signature,
+        jit_compile=True
     )
-    return augmentation_fn
+    return compiled_fn
 
 
 def build_random_horizontal_flip(augmentation_proto):
     logger.debug('Building Random Horizontal flip.')
     flip_probability = augmentation_proto.flip_probability
+    per_example = augmentation_proto.per_example
     flip_fn = functools.partial(
         aug_ops.random_horizontal_flip,
-        flip_probability=flip_probability
+        flip_probability=flip_probability,
+        per_example=per_example
     )
     return flip_fn
 
 
+def build_horizontal_flip(augmentation_proto):
+    logger.debug('Building Horizontal flip.')
+    return aug_ops.horizontal_flip
+
+
 def build_random_grayscale(augmentation_proto):
     logger.debug('Building Random Grayscale.')
     gray_probability = augmentation_proto.gray_probability
-    flip_fn = functools.partial(
+    keep_channels = augmentation_proto.keep_channels
+    per_example = augmentation_proto.per_example
+    if per_example and not keep_channels:
+        logger.error('Per example Random Grayscale requires keep_channels to '
+                     'be set.')
+        raise ValueError('Please see the log message above.')
+    gray_fn = functools.partial(
         aug_ops.random_grayscale,
-        gray_probability=gray_probability
+        gray_probability=gray_probability,
+        keep_channels=keep_channels,
+        per_example=per_example
     )
-    return flip_fn
+    return gray_fn
+
+
+def build_grayscale(augmentation_proto):
+    logger.debug('Building Grayscale.')
+    keep_channels = augmentation_proto.keep_channels
+    gray_fn = functools.partial(
+        aug_ops.grayscale,
+        keep_channels=keep_channels
+    )
+    return gray_fn
+
+
+def build_random_affine(augmentation_proto, jit_compile=False):
+    logger.debug('Building Random Affine.')
+    flip_probability = augmentation_proto.flip_probability
+    min_scale = augmentation_proto.min_scale
+    max_scale = augmentation_proto.max_scale
+    max_translation = augmentation_proto.max_translation
+    max_rotation_degrees = augmentation_proto.max_rotation_degrees
+    max_shear_degrees = augmentation_proto.max_shear_degrees
+    fill_value = augmentation_proto.fill_value
+    if min_scale > max_scale:
+        logger.error('min_scale must not be larger than max_scale.')
+        raise ValueError('Please see the log message above.')
+    affine_fn = functools.partial(
+        aug_ops.random_affine,
+        flip_probability=flip_probability,
+        min_scale=min_scale,
+        max_scale=max_scale,
+        max_translation=max_translation,
+        max_rotation_degrees=max_rotation_degrees,
+        max_shear_degrees=max_shear_degrees,
+        fill_value=fill_value,
+        in_xla=jit_compile
+    )
+    return affine_fn
+
+
+def build_random_color_jitter(augmentation_proto):
+    logger.debug('Building Random Color Jitter.')
+    max_brightness_delta = augmentation_proto.max_brightness_delta
+    min_contrast = augmentation_proto.min_contrast
+    max_contrast = augmentation_proto.max_contrast
+    min_saturation = augmentation_proto.min_saturation
+    max_saturation = augmentation_proto.max_saturation
+    max_hue_delta = augmentation_proto.max_hue_delta
+    jitter_probability = augmentation_proto.jitter_probability
+    if min_contrast > max_contrast or min_saturation > max_saturation:
+        logger.error('Minimum contrast and saturation must not be larger '
+                     'than their maximum.')
+        raise ValueError('Please see the log message above.')
+    jitter_fn = functools.partial(
+        aug_ops.random_color_jitter,
+        max_brightness_delta=max_brightness_delta,
+        min_contrast=min_contrast,
+        max_contrast=max_contrast,
+        min_saturation=min_saturation,
+        max_saturation=max_saturation,
+        max_hue_delta=max_hue_delta,
+        jitter_probability=jitter_probability
+    )
+    return jitter_fn
+
+
+def build_mixup(augmentation_proto):
+    logger.debug('Building MixUp.')
+    alpha = augmentation_proto.alpha
+    if alpha <= 0.0:
+        logger.error('MixUp alpha must be positive.')
+        raise ValueError('Please see the log message above.')
+    mixup_fn = functools.partial(
+        aug_ops.mixup,
+        alpha=alpha
+    )
+    return mixup_fn
+
+
+def build_cutmix(augmentation_proto):
+    logger.debug('Building CutMix.')
+    alpha = augmentation_proto.alpha
+    if alpha <= 0.0:
+        logger.error('CutMix alpha must be positive.')
+        raise ValueError('Please see the log message above.')
+    cutmix_fn = functools.partial(
+        aug_ops.cutmix,
+        alpha=alpha
+    )
+    return cutmix_fn
+
+
+def build_mosaic(augmentation_proto):
+    logger.debug('Building Mosaic.')
+    return aug_ops.mosaic
+
+
+def build_rand_augment(augmentation_proto, jit_compile=False):
+    logger.debug('Building RandAugment.')
+    num_layers = augmentation_proto.num_layers
+    magnitude = augmentation_proto.magnitude
+    augmentations = [
+        augmentations_pb2.RandAugment.Augmentation.Name(augmentation).lower()
+        for augmentation in augmentation_proto.augmentations
+    ]
+    if num_layers < 0 or not 0.0 <= magnitude <= 1.0:
+        logger.error('RandAugment needs a non-negative num_layers and a '
+                     'magnitude in [0, 1].')
+        raise ValueError('Please see the log message above.')
+    rand_augment_fn = functools.partial(
+        aug_ops.random_augment,
+        num_layers=num_layers,
+        magnitude=magnitude,
+        augmentations=augmentations,
+        in_xla=jit_compile
+    )
+    return rand_augment_fn
@@ -0,0 +1,72 @@
+import time
+
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.augmentations_builder import build_augmentations
+from protos import augmentations_pb2
+
+BATCH_SIZE = 64
+IMAGE_SIZE = 224
+NUM_BOXES = 16
+NUM_ITERS = 50
+
+
+class AugmentationsBuilderBenchmark(tf.test.Benchmark):
+    def _inputs(self):
+        images = tf.random.uniform([BATCH_SIZE, IMAGE_SIZE, IMAGE_SIZE, 3])
+        labels = tf.zeros([BATCH_SIZE, 10])
+        boxes = tf.random.uniform([BATCH_SIZE, NUM_BOXES, 4])
+        masks = tf.zeros([BATCH_SIZE, NUM_BOXES, IMAGE_SIZE, IMAGE_SIZE])
+        return images, labels, boxes, masks
+
+    def _build(self, jit_compile):
+        proto_txt = """
+        augment_method{
+            random_horizontal_flip{
+                per_example : true
+            }
+        }
+        augment_method{
+            random_gray_scale{
+                keep_channels : true
+                per_example : true
+            }
+        }
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        msg.jit_compile = jit_compile
+        inputs = self._inputs()
+        input_signature = [tf.TensorSpec.from_tensor(t) for t in inputs]
+        augmentation_fn = build_augmentations(msg,
+                                              input_signature=input_signature)
+        if not jit_compile:
+            augmentation_fn = tf.function(augmentation_fn)
+        return augmentation_fn, inputs
+
+    def _run(self, name, jit_compile):
+        augmentation_fn, inputs = self._build(jit_compile)
+        # Warm up, tracing and compiling outside the timed region.
+        tf.nest.map_structure(lambda t: t.numpy(), augmentation_fn(inputs))
+        start = time.time()
+        for _ in range(NUM_ITERS):
+            outputs = augmentation_fn(inputs)
+        tf.nest.map_structure(lambda t: t.numpy(), outputs)
+        wall_time = (time.time() - start) / NUM_ITERS
+        self.report_benchmark(
+            name=name,
+            iters=NUM_ITERS,
+            wall_time=wall_time,
+            extras={'images_per_sec': BATCH_SIZE / wall_time}
+        )
+
+    def benchmark_unfused_chain(self):
+        self._run('unfused_chain', jit_compile=False)
+
+    def benchmark_xla_fused_chain(self):
+        self._run('xla_fused_chain', jit_compile=True)
+
+
+if __name__ == "__main__":
+    tf.test.main()
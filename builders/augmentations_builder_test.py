@@ -0,0 +1,301 @@
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.augmentations_builder import (build_augmentations,
+                                            plan_augmentations)
+from protos import augmentations_pb2
+
+
+class AugmentationsBuildTest(tf.test.TestCase):
+    def test_jit_compiled_chain(self):
+        proto_txt = """
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 1.0
+                per_example : true
+            }
+        }
+        augment_method{
+            random_gray_scale{
+                gray_probability : 0.0
+                keep_channels : true
+                per_example : true
+            }
+        }
+        augment_method{
+            random_affine{
+            }
+        }
+        jit_compile : true
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        images = tf.random.uniform([2, 4, 5, 3])
+        boxes = tf.constant([[[0.1, 0.2, 0.5, 0.6]],
+                             [[0.0, 0.0, 1.0, 0.3]]])
+        input_signature = [tf.TensorSpec.from_tensor(images),
+                           tf.TensorSpec([2, 3]),
+                           tf.TensorSpec.from_tensor(boxes),
+                           tf.TensorSpec([2, 1, 4, 5])]
+        augmentation_fn = build_augmentations(msg,
+                                              input_signature=input_signature)
+        augmented = augmentation_fn(
+            (images, tf.zeros([2, 3]), boxes, tf.zeros([2, 1, 4, 5])))
+        self.assertAllClose(augmented[0], images[:, :, ::-1, :])
+        self.assertAllClose(augmented[2], [[[0.1, 0.4, 0.5, 0.8]],
+                                           [[0.0, 0.7, 1.0, 1.0]]])
+
+    def test_plan_drops_cancels_and_merges(self):
+        proto_txt = """
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 0.0
+            }
+        }
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 1.0
+            }
+        }
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 1.0
+                per_example : true
+            }
+        }
+        augment_method{
+            random_gray_scale{
+                gray_probability : 0.5
+            }
+        }
+        augment_method{
+            random_gray_scale{
+                gray_probability : 0.5
+            }
+        }
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 0.5
+            }
+        }
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        plan, deferred_plan = plan_augmentations(msg.augment_method)
+        self.assertEqual([step[0] for step in plan],
+                         ['random_gray_scale', 'random_horizontal_flip'])
+        self.assertAlmostEqual(plan[0][1].gray_probability, 0.75)
+        self.assertEqual(deferred_plan, [])
+
+    def test_plan_merges_across_cancelled_flips(self):
+        proto_txt = """
+        augment_method{
+            random_gray_scale{
+                gray_probability : 0.5
+            }
+        }
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 1.0
+            }
+        }
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 1.0
+            }
+        }
+        augment_method{
+            random_gray_scale{
+                gray_probability : 0.5
+            }
+        }
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        plan, _ = plan_augmentations(msg.augment_method)
+        self.assertEqual([step[0] for step in plan], ['random_gray_scale'])
+        self.assertAlmostEqual(plan[0][1].gray_probability, 0.75)
+
+    def test_plan_merges_unconditional_color_jitters(self):
+        proto_txt = """
+        augment_method{
+            random_color_jitter{
+                max_brightness_delta : 0.1
+                min_contrast : 0.5
+                max_contrast : 2.0
+            }
+        }
+        augment_method{
+            random_color_jitter{
+                max_brightness_delta : 0.2
+                min_contrast : 0.5
+                max_hue_delta : 0.1
+            }
+        }
+        augment_method{
+            random_color_jitter{
+                max_brightness_delta : 0.2
+                jitter_probability : 0.5
+            }
+        }
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        plan, _ = plan_augmentations(msg.augment_method)
+        self.assertEqual([step[0] for step in plan],
+                         ['random_color_jitter'] * 2)
+        merged = plan[0][1]
+        self.assertAlmostEqual(merged.max_brightness_delta, 0.3)
+        self.assertAlmostEqual(merged.min_contrast, 0.25)
+        self.assertAlmostEqual(merged.max_contrast, 2.0)
+        self.assertAlmostEqual(merged.max_hue_delta, 0.1)
+        self.assertAlmostEqual(plan[1][1].jitter_probability, 0.5)
+
+    def test_plan_defers_flips_after_resize(self):
+        proto_txt = """
+        augment_method{
+            random_horizontal_flip{
+            }
+        }
+        augment_method{
+            random_affine{
+                max_rotation_degrees : 10.0
+            }
+        }
+        augment_method{
+            random_horizontal_flip{
+            }
+        }
+        augment_method{
+            random_gray_scale{
+                gray_probability : 1.0
+            }
+        }
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        plan, deferred_plan = plan_augmentations(msg.augment_method,
+                                                 defer_geometric=True)
+        self.assertEqual([step[0] for step in plan],
+                         ['random_horizontal_flip', 'random_affine',
+                          'gray_scale'])
+        self.assertEqual([step[0] for step in deferred_plan],
+                         ['random_horizontal_flip'])
+
+    def test_resize_folded_into_augmentations(self):
+        proto_txt = """
+        augment_method{
+            random_horizontal_flip{
+                flip_probability : 1.0
+            }
+        }
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+
+        def resize_fn(images, *args):
+            return (tf.image.resize(images, [2, 3]),) + args
+
+        augmentation_fn = build_augmentations(msg, resize_fn=resize_fn)
+        images = tf.random.uniform([1, 4, 6, 3])
+        augmented = augmentation_fn((images, None, None, None))
+        self.assertAllClose(augmented[0],
+                            tf.image.resize(images, [2, 3])[:, :, ::-1, :])
+
+    def test_seeded_augmentations_are_reproducible(self):
+        proto_txt = """
+        augment_method{
+            random_horizontal_flip{
+                per_example : true
+            }
+        }
+        augment_method{
+            random_affine{
+                max_rotation_degrees : 30.0
+            }
+        }
+        augment_method{
+            random_color_jitter{
+                max_brightness_delta : 0.3
+            }
+        }
+        seed : 42
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        augmentation_fn = build_augmentations(msg)
+        images = tf.random.uniform([4, 8, 8, 3])
+        boxes = tf.random.uniform([4, 2, 4])
+        x = (images, None, boxes, None)
+        first = augmentation_fn(x, example_id=3, epoch=1)
+        tf.random.uniform([])
+        second = augmentation_fn(x, example_id=3, epoch=1)
+        other_epoch = augmentation_fn(x, example_id=3, epoch=2)
+        self.assertAllEqual(first[0], second[0])
+        self.assertAllEqual(first[2], second[2])
+        self.assertNotAllClose(first[0], other_epoch[0])
+
+    def test_seeded_batch_augmentations_compile(self):
+        proto_txt = """
+        augment_method{
+            mosaic{
+            }
+        }
+        augment_method{
+            mixup{
+                alpha : 0.5
+            }
+        }
+        jit_compile : true
+        seed : 7
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        images = tf.random.uniform([4, 8, 8, 3])
+        labels = tf.one_hot(tf.range(4), 4)
+        boxes = tf.random.uniform([4, 2, 4])
+        input_signature = [tf.TensorSpec.from_tensor(images),
+                           tf.TensorSpec.from_tensor(labels),
+                           tf.TensorSpec.from_tensor(boxes),
+                           tf.TensorSpec([4, 2, 8, 8])]
+        augmentation_fn = build_augmentations(msg,
+                                              input_signature=input_signature)
+        x = (images, labels, boxes, tf.ones([4, 2, 8, 8]))
+        example_id = tf.constant(0, tf.int64)
+        epoch = tf.constant(0, tf.int64)
+        first = augmentation_fn(x, example_id, epoch)
+        second = augmentation_fn(x, example_id, epoch)
+        self.assertEqual(first[2].shape, [4, 16, 4])
+        self.assertEqual(first[3].shape, [4, 16, 8, 8])
+        self.assertAllClose(tf.reduce_sum(first[1], axis=-1), tf.ones([4]))
+        self.assertAllEqual(first[0], second[0])
+
+    def test_rand_augment(self):
+        proto_txt = """
+        augment_method{
+            rand_augment{
+                num_layers : 3
+                magnitude : 0.5
+                augmentations : GRAY_SCALE
+                augmentations : BRIGHTNESS
+            }
+        }
+        """
+        msg = augmentations_pb2.Augmentations()
+        text_format.Merge(proto_txt, msg)
+        augmentation_fn = build_augmentations(msg)
+        images = tf.random.uniform([8, 4, 4, 3])
+        augmented = augmentation_fn((images, None, None, None))
+        self.assertEqual(augmented[0].shape, images.shape)
+        # Compiled, entries run on the whole batch and are selected.
+        msg.jit_compile = True
+        augmentation_fn = build_augmentations(msg)
+        augmented = augmentation_fn((images, None, None, None))
+        self.assertEqual(augmented[0].shape, images.shape)
+        msg.augment_method[0].rand_augment.magnitude = 2.0
+        with self.assertRaises(ValueError):
+            build_augmentations(msg)
+
+
+if __name__ == "__main__":
+    tf.test.main()
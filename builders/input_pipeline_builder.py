@@ -0,0 +1,361 @@
+import functools
+import hashlib
+import os
+import types
+
+import tensorflow as tf
+from loguru import logger
+
+from builders.preprocessing_builder import (build_bucket_shapes,
+                                            build_image_size,
+                                            build_preprocessing,
+                                            build_resizing_phase_end)
+
+# Example ids are file_index * _RECORDS_PER_FILE + record_index.
+_RECORDS_PER_FILE = 2 ** 32
+
+
+def build_input_pipeline(input_pipeline_proto, decode_fn, step=0,
+                         batches_per_step=1):
+    # decode_fn maps a serialized record to an (images, labels, boxes, masks)
+    # tuple, with encoded JPEG images when preprocessing.decode_jpeg is set.
+    # The returned dataset yields batches of resized and augmented
+    # tuples.
+    # Seeded augmentations get an example_id fixed by the file and record
+    # the example was read from and the epoch it is read in, so they do not
+    # depend on shuffling or on the order of parallel maps. With
+    # batch_before_augment a batch gets the smallest of both in it.
+    # batches_per_step is the number of batches every training step
+    # consumes, the gradient_accumulation_steps of the optimizer. The
+    # examples of the steps before step are skipped, so a pipeline built
+    # again at a later step continues the stream instead of restarting it.
+    # With shuffling this only holds when shuffle_seed is set and the
+    # pipeline is deterministic, otherwise the skipped examples are drawn
+    # from a new order.
+    # With progressive resizing the dataset yields the batches of the
+    # resolution used at step and ends at its last step. The pipeline is
+    # then built again for the next step, so every resolution has static
+    # shapes.
+    logger.debug('Building input pipeline.')
+    file_patterns = list(input_pipeline_proto.file_pattern)
+    batch_size = input_pipeline_proto.batch_size
+    if not file_patterns or batch_size <= 0 or batches_per_step <= 0:
+        logger.error('An input pipeline needs file patterns and a positive '
+                     'batch size and batches per step.')
+        raise ValueError('Please see the log message above.')
+    num_parallel_calls = input_pipeline_proto.num_parallel_calls
+    deterministic = input_pipeline_proto.deterministic
+    resize_fn, augmentation_fn = build_preprocessing(
+        input_pipeline_proto.preprocessing, step,
+        augment_after_resize=input_pipeline_proto.batch_before_augment,
+        cached_resize=bool(input_pipeline_proto.cache_dir))
+    seeded = input_pipeline_proto.preprocessing.augmentations.HasField('seed')
+    cache_dir = input_pipeline_proto.cache_dir
+    resize_step = resize_fn
+
+    map_kwargs = dict(num_parallel_calls=num_parallel_calls,
+                      deterministic=deterministic)
+    consumed_examples = step * batches_per_step * batch_size
+    # Keyed examples carry their example id, and their epoch once repeated,
+    # as a last element. Cached examples always keep their id, so the cache
+    # serves seeded and unseeded pipelines alike.
+    dataset = build_records(input_pipeline_proto,
+                            example_ids=seeded or bool(cache_dir))
+    if cache_dir:
+        # Decoding and resizing are deterministic, so they are done once and
+        # saved; only the augmentations run on every pass. They keep the
+        # order of the records, so the cache is written in a fixed order.
+        cache_map_kwargs = dict(num_parallel_calls=num_parallel_calls,
+                                deterministic=True)
+        dataset = dataset.map(_keyed(decode_fn), **cache_map_kwargs)
+        if resize_step is not None:
+            dataset = dataset.map(_keyed(resize_step), **cache_map_kwargs)
+            resize_step = None
+        dataset = build_cached_examples(
+            dataset, build_cache_path(input_pipeline_proto, decode_fn, step))
+        if not seeded:
+            dataset = dataset.map(lambda *x: x[:-1], **map_kwargs)
+        dataset = build_shuffle_and_repeat(dataset, input_pipeline_proto,
+                                           epochs=seeded,
+                                           skip=consumed_examples)
+    else:
+        dataset = build_shuffle_and_repeat(dataset, input_pipeline_proto,
+                                           epochs=seeded,
+                                           skip=consumed_examples)
+        dataset = dataset.map(_keyed(decode_fn, seeded), **map_kwargs)
+    # Encoded JPEGs are decoded by the resize, so it goes first.
+    batch_before_augment = input_pipeline_proto.batch_before_augment
+    resize_first = (batch_before_augment or
+                    input_pipeline_proto.preprocessing.decode_jpeg)
+    if resize_first and resize_step is not None:
+        dataset = dataset.map(_keyed(resize_step, seeded), **map_kwargs)
+    if batch_before_augment:
+        dataset = build_batching(dataset, input_pipeline_proto, step)
+    dataset = _map_augmentations(dataset, augmentation_fn, seeded,
+                                 batched=batch_before_augment, **map_kwargs)
+    if not resize_first and resize_step is not None:
+        dataset = dataset.map(resize_step, **map_kwargs)
+    if not batch_before_augment:
+        dataset = build_batching(dataset, input_pipeline_proto, step)
+    phase_end = build_resizing_phase_end(input_pipeline_proto.preprocessing,
+                                         step)
+    if phase_end is not None:
+        logger.debug('Resolution changes after step {}.'.format(phase_end))
+        dataset = dataset.take((phase_end - step + 1) * batches_per_step)
+    dataset = dataset.prefetch(input_pipeline_proto.prefetch_buffer_size)
+    return dataset.with_options(
+        build_data_options(input_pipeline_proto.options, deterministic))
+
+
+def build_records(input_pipeline_proto, example_ids=False):
+    # Shards are read concurrently, so throughput does not depend on any
+    # single file. When cached, files are listed in a fixed order and read
+    # deterministically whatever deterministic says, so the cache is
+    # written in a reproducible order.
+    # With example_ids every record comes with an id made of the position
+    # of its file in the sorted file list and its position in the file, so
+    # the id identifies the example however files and records are shuffled
+    # or interleaved.
+    files = tf.data.Dataset.list_files(
+        list(input_pipeline_proto.file_pattern), shuffle=False)
+    read_fn = functools.partial(
+        tf.data.TFRecordDataset,
+        compression_type=input_pipeline_proto.compression_type)
+    if example_ids:
+        files = files.enumerate()
+        read_fn = functools.partial(_read_with_example_ids, read_fn)
+    if (input_pipeline_proto.shuffle_files and
+            not input_pipeline_proto.cache_dir):
+        files = files.shuffle(files.cardinality(),
+                              seed=_shuffle_seed(input_pipeline_proto))
+    records = files.interleave(
+        read_fn,
+        cycle_length=input_pipeline_proto.cycle_length,
+        block_length=input_pipeline_proto.block_length,
+        num_parallel_calls=input_pipeline_proto.num_parallel_calls,
+        deterministic=(input_pipeline_proto.deterministic or
+                       bool(input_pipeline_proto.cache_dir))
+    )
+    return records
+
+
+def build_cached_examples(dataset, cache_path):
+    # The key in cache_path already identifies the examples, so an existing
+    # cache is loaded as is. tf.data snapshots would also key on a
+    # fingerprint of the input pipeline graph, which changes between runs.
+    # Examples are written to a partial directory that is only renamed
+    # once complete, so an interrupted run never leaves a truncated cache.
+    # A missing cache is written right away, so the call blocks on a full
+    # pass over dataset.
+    if not tf.io.gfile.exists(cache_path):
+        logger.debug('Writing preprocessed examples to {}.'.format(cache_path))
+        partial_path = '{}.partial-{}'.format(cache_path, os.getpid())
+        if tf.io.gfile.exists(partial_path):
+            tf.io.gfile.rmtree(partial_path)
+        try:
+            dataset.save(partial_path)
+        except BaseException:
+            if tf.io.gfile.exists(partial_path):
+                tf.io.gfile.rmtree(partial_path)
+            raise
+        try:
+            tf.io.gfile.rename(partial_path, cache_path)
+        except tf.errors.OpError:
+            # Another worker wrote the same examples and renamed its copy
+            # first.
+            if not tf.io.gfile.exists(cache_path):
+                raise
+            logger.debug('Using the cache written concurrently to {}.'.format(
+                cache_path))
+            tf.io.gfile.rmtree(partial_path)
+    return tf.data.Dataset.load(cache_path)
+
+
+def build_shuffle_and_repeat(dataset, input_pipeline_proto, epochs=False,
+                             skip=0):
+    # With epochs, keyed examples are repeated one pass at a time and their
+    # key becomes (example_id, epoch). The first skip examples are dropped
+    # before they are decoded.
+    num_epochs = input_pipeline_proto.num_epochs
+    if epochs:
+        examples = dataset
+        passes = (tf.data.Dataset.counter() if num_epochs < 0
+                  else tf.data.Dataset.range(num_epochs))
+        dataset = passes.flat_map(lambda epoch: examples.map(
+            lambda *x: x[:-1] + ((x[-1], epoch),)))
+    elif num_epochs != 1:
+        dataset = dataset.repeat(None if num_epochs < 0 else num_epochs)
+    if input_pipeline_proto.shuffle_buffer_size > 0:
+        dataset = dataset.shuffle(input_pipeline_proto.shuffle_buffer_size,
+                                  seed=_shuffle_seed(input_pipeline_proto))
+    if skip > 0:
+        logger.debug('Skipping {} examples of earlier steps.'.format(skip))
+        dataset = dataset.skip(skip)
+    return dataset
+
+
+def build_cache_path(input_pipeline_proto, decode_fn, step=0):
+    # The key covers everything that changes the cached examples: the
+    # preprocessing config except the augmentations and the normalization,
+    # which run after the cache, with the image size used at step, the code
+    # of decode_fn, and the names, sizes and modification times of the
+    # input files.
+    preprocessing_proto = type(input_pipeline_proto.preprocessing)()
+    preprocessing_proto.CopyFrom(input_pipeline_proto.preprocessing)
+    for field in ('augmentations', 'mean', 'stddev', 'image_dtype'):
+        preprocessing_proto.ClearField(field)
+    image_height, image_width = build_image_size(preprocessing_proto, step)
+    preprocessing_proto.ClearField('progressive_resizing')
+    preprocessing_proto.image_height = image_height
+    preprocessing_proto.image_width = image_width
+    files = sorted(tf.io.gfile.glob(list(input_pipeline_proto.file_pattern)))
+    key = hashlib.sha256()
+    key.update(preprocessing_proto.SerializeToString(deterministic=True))
+    key.update(input_pipeline_proto.compression_type.encode())
+    key.update(_function_fingerprint(decode_fn))
+    for path in files:
+        stat = tf.io.gfile.stat(path)
+        key.update('{}\0{}\0{}\0'.format(
+            path, stat.length, stat.mtime_nsec).encode())
+    cache_path = os.path.join(input_pipeline_proto.cache_dir,
+                              key.hexdigest())
+    logger.debug('Caching preprocessed examples under {}.'.format(cache_path))
+    return cache_path
+
+
+def build_batching(dataset, input_pipeline_proto, step=0):
+    batch_size = input_pipeline_proto.batch_size
+    drop_remainder = input_pipeline_proto.drop_remainder
+
+    def batch(dataset):
+        if input_pipeline_proto.ragged_batch:
+            return dataset.apply(tf.data.experimental.dense_to_ragged_batch(
+                batch_size, drop_remainder=drop_remainder))
+        return dataset.batch(
+            batch_size,
+            drop_remainder=drop_remainder,
+            num_parallel_calls=input_pipeline_proto.num_parallel_calls,
+            deterministic=input_pipeline_proto.deterministic
+        )
+
+    if input_pipeline_proto.ragged_batch:
+        logger.debug('Batching instances into ragged tensors.')
+    if not input_pipeline_proto.preprocessing.HasField(
+            'aspect_ratio_buckets'):
+        return batch(dataset)
+    # Examples are grouped by the bucket shape they were padded to, so every
+    # batch holds a single image shape.
+    logger.debug('Batching examples by aspect ratio bucket.')
+    bucket_shapes = tf.constant(
+        build_bucket_shapes(input_pipeline_proto.preprocessing, step),
+        tf.int32)
+
+    def bucket_of(images, *args):
+        return tf.argmax(tf.reduce_all(
+            tf.equal(bucket_shapes, tf.shape(images)[:2]), axis=1))
+
+    def batch_bucket(bucket, window):
+        batched = batch(window)
+        if input_pipeline_proto.ragged_batch:
+            # Bucketed images have no static shape, so ragged batching makes
+            # them ragged although all of them share the bucket shape.
+            batched = batched.map(
+                lambda images, *args: (images.to_tensor(),) + args)
+        return batched
+
+    return dataset.group_by_window(
+        key_func=bucket_of,
+        reduce_func=batch_bucket,
+        window_size=batch_size
+    )
+
+
+def build_data_options(options_proto, deterministic):
+    options = tf.data.Options()
+    options.deterministic = deterministic
+    options.autotune.enabled = True
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.parallel_batch = True
+    if options_proto.private_threadpool_size > 0:
+        options.threading.private_threadpool_size = (
+            options_proto.private_threadpool_size)
+    if options_proto.max_intra_op_parallelism > 0:
+        options.threading.max_intra_op_parallelism = (
+            options_proto.max_intra_op_parallelism)
+    if options_proto.autotune_ram_budget_mb > 0:
+        options.autotune.ram_budget = (
+            options_proto.autotune_ram_budget_mb * 1024 * 1024)
+    return options
+
+
+def _function_fingerprint(fn):
+    # The qualified name, bytecode and constants of fn, its default
+    # arguments, the values it closes over and the arguments bound by
+    # partials, so editing the decoding code or its parameters changes the
+    # cache key. Globals fn reads are not covered.
+    if isinstance(fn, functools.partial):
+        return (_function_fingerprint(fn.func) +
+                repr((fn.args, sorted(fn.keywords.items()))).encode())
+    fingerprint = '{}.{}'.format(
+        getattr(fn, '__module__', None),
+        getattr(fn, '__qualname__', type(fn).__qualname__)).encode()
+    code = getattr(fn, '__code__', None)
+    if code is not None:
+        fingerprint += _code_fingerprint(code)
+        fingerprint += repr((fn.__defaults__, fn.__kwdefaults__)).encode()
+    for cell in getattr(fn, '__closure__', None) or ():
+        value = cell.cell_contents
+        if value is fn:
+            continue
+        if callable(value):
+            fingerprint += _function_fingerprint(value)
+        else:
+            fingerprint += repr(value).encode()
+    return fingerprint
+
+
+def _code_fingerprint(code):
+    # Nested functions are code constants whose repr holds their address.
+    fingerprint = code.co_code + repr(code.co_names).encode()
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            fingerprint += _code_fingerprint(constant)
+        else:
+            fingerprint += repr(constant).encode()
+    return fingerprint
+
+
+def _shuffle_seed(input_pipeline_proto):
+    if not input_pipeline_proto.HasField('shuffle_seed'):
+        return None
+    return input_pipeline_proto.shuffle_seed
+
+
+def _read_with_example_ids(read_fn, file_index, path):
+    return read_fn(path).enumerate().map(
+        lambda index, record: (record,
+                               file_index * _RECORDS_PER_FILE + index))
+
+
+def _keyed(fn, keyed=True):
+    # Applies fn to the example of a keyed element and keeps its key.
+    if not keyed:
+        return fn
+    return lambda *x: tuple(fn(*x[:-1])) + (x[-1],)
+
+
+def _map_augmentations(dataset, augmentation_fn, seeded, batched=False,
+                       **map_kwargs):
+    if not seeded:
+        return dataset.map(lambda *x: augmentation_fn(x), **map_kwargs)
+
+    def augment(*x):
+        example_id, epoch = x[-1]
+        if batched:
+            # Unlike the first id, the smallest one does not depend on the
+            # order of the examples in the batch.
+            example_id = tf.reduce_min(example_id)
+            epoch = tf.reduce_min(epoch)
+        return augmentation_fn(x[:-1], example_id, epoch)
+
+    return dataset.map(augment, **map_kwargs)
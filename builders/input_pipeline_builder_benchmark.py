@@ -0,0 +1,115 @@
+import os
+import tempfile
+import time
+
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.input_pipeline_builder import build_input_pipeline
+from builders.preprocessing_builder import build_preprocessing
+from protos import input_pipeline_pb2
+
+NUM_SHARDS = 8
+EXAMPLES_PER_SHARD = 128
+SOURCE_SIZE = 320
+BATCH_SIZE = 64
+
+INPUT_PIPELINE_TXT = """
+batch_size : {batch_size}
+preprocessing{{
+    image_height : 224
+    image_width : 224
+    resize_protocol : BILINEAR
+    uint8_images : true
+    augmentations{{
+        augment_method{{
+            random_horizontal_flip{{
+                per_example : true
+            }}
+        }}
+        augment_method{{
+            random_color_jitter{{
+                max_brightness_delta : 0.2
+                min_contrast : 0.8
+                max_contrast : 1.2
+            }}
+        }}
+    }}
+}}
+"""
+
+
+def _decode(record):
+    images = tf.io.decode_jpeg(record, channels=3)
+    return images, None, None, None
+
+
+def _write_shards(directory):
+    image = tf.cast(tf.random.uniform([SOURCE_SIZE, SOURCE_SIZE, 3],
+                                      maxval=256, dtype=tf.int32), tf.uint8)
+    encoded = tf.io.encode_jpeg(image).numpy()
+    for shard in range(NUM_SHARDS):
+        path = os.path.join(directory, 'train-{}.tfrecord'.format(shard))
+        with tf.io.TFRecordWriter(path) as writer:
+            for _ in range(EXAMPLES_PER_SHARD):
+                writer.write(encoded)
+
+
+class InputPipelineBuilderBenchmark(tf.test.Benchmark):
+    def _run(self, name, dataset):
+        # The first batch pays for tracing and compilation and is not timed.
+        iterator = iter(dataset)
+        next(iterator)
+        num_images = 0
+        start = time.time()
+        for images, _, _, _ in iterator:
+            num_images += images.shape[0]
+        wall_time = time.time() - start
+        self.report_benchmark(
+            name=name,
+            iters=num_images // BATCH_SIZE,
+            wall_time=wall_time * BATCH_SIZE / num_images,
+            extras={'images_per_sec': num_images / wall_time}
+        )
+
+    def _msg(self, directory):
+        msg = input_pipeline_pb2.InputPipeline()
+        text_format.Merge(INPUT_PIPELINE_TXT.format(batch_size=BATCH_SIZE),
+                          msg)
+        msg.file_pattern.append(os.path.join(directory, '*.tfrecord'))
+        return msg
+
+    def benchmark_sequential_pipeline(self):
+        # What hand written pipelines often end up as: one shard at a time,
+        # sequential maps and no prefetching.
+        with tempfile.TemporaryDirectory() as directory:
+            _write_shards(directory)
+            msg = self._msg(directory)
+            resize_fn, augmentation_fn = build_preprocessing(
+                msg.preprocessing)
+            dataset = tf.data.TFRecordDataset(
+                tf.io.gfile.glob(msg.file_pattern[0]))
+            dataset = dataset.map(_decode)
+            dataset = dataset.map(lambda *x: augmentation_fn(x))
+            dataset = dataset.map(resize_fn)
+            self._run('sequential_pipeline',
+                      dataset.batch(BATCH_SIZE, drop_remainder=True))
+
+    def benchmark_built_pipeline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_shards(directory)
+            self._run('built_pipeline',
+                      build_input_pipeline(self._msg(directory),
+                                           decode_fn=_decode))
+
+    def benchmark_built_pipeline_batch_then_augment(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_shards(directory)
+            msg = self._msg(directory)
+            msg.batch_before_augment = True
+            self._run('built_pipeline_batch_then_augment',
+                      build_input_pipeline(msg, decode_fn=_decode))
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -0,0 +1,364 @@
+import os
+from unittest import mock
+
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.input_pipeline_builder import (build_cache_path,
+                                             build_cached_examples,
+                                             build_input_pipeline)
+from protos import input_pipeline_pb2
+
+
+def _write_shards(directory, num_shards, examples_per_shard):
+    # Records hold serialized uint8 images of varying size and aspect ratio
+    # with a varying number of boxes.
+    for shard in range(num_shards):
+        path = os.path.join(directory, 'train-{}.tfrecord'.format(shard))
+        with tf.io.TFRecordWriter(path) as writer:
+            for index in range(examples_per_shard):
+                image = tf.fill([6 + index, 6 + 3 * index, 3],
+                                tf.constant(shard, tf.uint8))
+                boxes = tf.fill([index % 3, 4], 0.5)
+                writer.write(tf.io.serialize_tensor(image).numpy() +
+                             b'|' + tf.io.serialize_tensor(boxes).numpy())
+
+
+def _decode(record):
+    parts = tf.strings.split(record, '|')
+    images = tf.ensure_shape(tf.io.parse_tensor(parts[0], tf.uint8),
+                             [None, None, 3])
+    boxes = tf.ensure_shape(tf.io.parse_tensor(parts[1], tf.float32),
+                            [None, 4])
+    labels = tf.one_hot(tf.cast(images[0, 0, 0], tf.int32), 3)
+    return images, labels, boxes, None
+
+
+def _decode_gray(record):
+    # Mid gray images, which brightness changes do not clip, labelled with
+    # the shard and height that identify the example.
+    images, _, boxes, _ = _decode(record)
+    labels = tf.cast(tf.stack([images[0, 0, 0],
+                               tf.cast(tf.shape(images)[0], tf.uint8)]),
+                     tf.float32)
+    images = tf.fill(tf.shape(images), tf.constant(128, tf.uint8))
+    return images, labels, boxes, None
+
+
+class InputPipelineBuildTest(tf.test.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = self.get_temp_dir()
+        _write_shards(self.directory, num_shards=3, examples_per_shard=4)
+
+    def _build(self, proto_txt, step=0, decode_fn=_decode,
+               batches_per_step=1):
+        msg = input_pipeline_pb2.InputPipeline()
+        text_format.Merge(proto_txt, msg)
+        msg.file_pattern.append(os.path.join(self.directory, '*.tfrecord'))
+        return build_input_pipeline(msg, decode_fn=decode_fn, step=step,
+                                    batches_per_step=batches_per_step)
+
+    def test_augment_then_batch(self):
+        dataset = self._build("""
+        batch_size : 4
+        ragged_batch : true
+        shuffle_buffer_size : 8
+        preprocessing{
+            image_height : 4
+            image_width : 4
+            resize_protocol : BILINEAR
+            uint8_images : true
+            augmentations{
+                augment_method{
+                    random_horizontal_flip{
+                    }
+                }
+            }
+        }
+        options{
+            private_threadpool_size : 2
+            autotune_ram_budget_mb : 64
+        }
+        """)
+        options = dataset.options()
+        self.assertEqual(options.threading.private_threadpool_size, 2)
+        self.assertEqual(options.autotune.ram_budget, 64 * 1024 * 1024)
+        batches = list(dataset)
+        self.assertLen(batches, 3)
+        images, labels, boxes, masks = batches[0]
+        self.assertEqual(images.shape, [4, 4, 4, 3])
+        self.assertAllInRange(images, 0.0, 1.0)
+        self.assertEqual(labels.shape, [4, 3])
+        self.assertIsInstance(boxes, tf.RaggedTensor)
+        self.assertIsNone(masks)
+
+    def test_batch_then_augment_seeded(self):
+        proto_txt = """
+        batch_size : 6
+        deterministic : true
+        shuffle_files : false
+        cycle_length : 1
+        batch_before_augment : true
+        ragged_batch : true
+        preprocessing{
+            image_height : 4
+            image_width : 4
+            resize_protocol : BILINEAR
+            augmentations{
+                augment_method{
+                    mixup{
+                    }
+                }
+                seed : 3
+            }
+        }
+        """
+        first = list(self._build(proto_txt))
+        second = list(self._build(proto_txt))
+        self.assertLen(first, 2)
+        self.assertEqual(first[0][0].shape, [6, 4, 4, 3])
+        self.assertAllClose(tf.reduce_sum(first[0][1], axis=-1), tf.ones([6]))
+        for first_batch, second_batch in zip(first, second):
+            self.assertAllEqual(first_batch[0], second_batch[0])
+            self.assertAllEqual(first_batch[2].flat_values,
+                                second_batch[2].flat_values)
+
+    def test_seeded_augmentations_follow_examples(self):
+        proto_txt = """
+        batch_size : 3
+        num_epochs : 2
+        ragged_batch : true
+        {}
+        preprocessing{{
+            image_height : 4
+            image_width : 4
+            resize_protocol : BILINEAR
+            uint8_images : true
+            augmentations{{
+                augment_method{{
+                    random_color_jitter{{
+                        max_brightness_delta : 0.3
+                    }}
+                }}
+                seed : 5
+            }}
+        }}
+        """
+
+        def brightness_by_example(dataset):
+            brightness = dict()
+            for images, labels, _, _ in dataset:
+                for image, label in zip(images, labels):
+                    brightness.setdefault(tuple(label.numpy()), []).append(
+                        float(tf.reduce_mean(image)))
+            return {key: sorted(value) for key, value in brightness.items()}
+
+        ordered = brightness_by_example(self._build(
+            proto_txt.format('deterministic : true shuffle_files : false '
+                             'cycle_length : 1'),
+            decode_fn=_decode_gray))
+        shuffled = brightness_by_example(self._build(
+            proto_txt.format('shuffle_buffer_size : 12'),
+            decode_fn=_decode_gray))
+        self.assertLen(ordered, 12)
+        self.assertEqual(ordered.keys(), shuffled.keys())
+        for key, values in ordered.items():
+            self.assertAllClose(values, shuffled[key])
+            # Every epoch draws again.
+            self.assertNotAlmostEqual(values[0], values[1])
+
+    def test_aspect_ratio_buckets(self):
+        dataset = self._build("""
+        batch_size : 2
+        drop_remainder : false
+        ragged_batch : true
+        preprocessing{
+            image_height : 16
+            image_width : 16
+            resize_protocol : BILINEAR
+            uint8_images : true
+            aspect_ratio_buckets{
+                aspect_ratios : 1.0
+                aspect_ratios : 2.0
+                size_multiple : 4
+            }
+        }
+        """)
+        shapes = sorted(tuple(images.shape.as_list())
+                        for images, _, _, _ in dataset)
+        self.assertEqual(shapes, [(2, 12, 24, 3)] * 3 + [(2, 16, 16, 3)] * 3)
+
+    def test_progressive_resizing(self):
+        proto_txt = """
+        batch_size : 2
+        num_epochs : -1
+        deterministic : true
+        shuffle_files : false
+        cycle_length : 1
+        ragged_batch : true
+        preprocessing{
+            resize_protocol : BILINEAR
+            progressive_resizing{
+                boundaries : 2
+                image_heights : 4
+                image_heights : 8
+                image_widths : 4
+                image_widths : 8
+            }
+        }
+        """
+        shapes = [images.shape.as_list()
+                  for images, _, _, _ in self._build(proto_txt)]
+        self.assertEqual(shapes, [[2, 4, 4, 3]] * 3)
+        # With gradient accumulation every step takes several batches.
+        self.assertLen(list(self._build(proto_txt, batches_per_step=2)), 6)
+        # The 6 examples of steps 0 to 2, all of shard 0 and half of shard 1,
+        # are skipped.
+        images, labels, _, _ = next(iter(self._build(proto_txt, step=3)))
+        self.assertEqual(images.shape, [2, 8, 8, 3])
+        self.assertAllEqual(tf.argmax(labels, axis=-1), [1, 1])
+
+    def test_resume_with_seeded_shuffle(self):
+        proto_txt = """
+        batch_size : 2
+        num_epochs : 2
+        deterministic : true
+        shuffle_buffer_size : 12
+        shuffle_seed : 7
+        ragged_batch : true
+        preprocessing{
+            image_height : 4
+            image_width : 4
+            resize_protocol : BILINEAR
+        }
+        """
+
+        def examples(dataset):
+            return [tuple(label) for _, labels, _, _ in dataset
+                    for label in labels.numpy().tolist()]
+
+        stream = examples(self._build(proto_txt, decode_fn=_decode_gray))
+        self.assertLen(stream, 24)
+        # Step 7 is in the second epoch, which is shuffled again.
+        self.assertEqual(
+            examples(self._build(proto_txt, step=7, decode_fn=_decode_gray)),
+            stream[14:])
+
+    def test_cache_is_keyed_on_deterministic_preprocessing(self):
+        proto_txt = """
+        batch_size : 4
+        deterministic : true
+        ragged_batch : true
+        cache_dir : "{}"
+        preprocessing{{
+            image_height : 4
+            image_width : 4
+            resize_protocol : BILINEAR
+            uint8_images : true
+            augmentations{{
+                augment_method{{
+                    random_horizontal_flip{{
+                    }}
+                }}
+            }}
+        }}
+        """.format(os.path.join(self.directory, 'cache'))
+        msg = input_pipeline_pb2.InputPipeline()
+        text_format.Merge(proto_txt, msg)
+        msg.file_pattern.append(os.path.join(self.directory, '*.tfrecord'))
+        cache_path = build_cache_path(msg, _decode)
+        msg.preprocessing.augmentations.augment_method[
+            0].random_horizontal_flip.flip_probability = 0.0
+        self.assertEqual(build_cache_path(msg, _decode), cache_path)
+        self.assertNotEqual(build_cache_path(msg, _decode_gray), cache_path)
+        msg.preprocessing.image_height = 8
+        self.assertNotEqual(build_cache_path(msg, _decode), cache_path)
+        msg.preprocessing.image_height = 4
+
+        def decode_with_fill(fill):
+            def decode(record):
+                images, labels, boxes, masks = _decode(record)
+                return images + fill, labels, boxes, masks
+            return decode
+
+        # Closures of the same code over other values get other keys.
+        self.assertNotEqual(build_cache_path(msg, decode_with_fill(1)),
+                            build_cache_path(msg, decode_with_fill(2)))
+        self.assertEqual(build_cache_path(msg, decode_with_fill(1)),
+                         build_cache_path(msg, decode_with_fill(1)))
+
+        first = [batch[1] for batch in self._build(proto_txt)]
+        self.assertTrue(tf.io.gfile.exists(cache_path))
+        second = [batch[1] for batch in self._build(proto_txt)]
+        self.assertAllEqual(tf.sort(tf.argmax(tf.concat(first, 0), -1)),
+                            tf.sort(tf.argmax(tf.concat(second, 0), -1)))
+        # Rewritten shards get a new key instead of the stale examples.
+        _write_shards(self.directory, num_shards=3, examples_per_shard=2)
+        self.assertNotEqual(build_cache_path(msg, _decode), cache_path)
+        self.assertLen(list(self._build(proto_txt)), 1)
+
+    def test_cache_normalizes_after_augmentations(self):
+        proto_txt = """
+        batch_size : 4
+        deterministic : true
+        ragged_batch : true
+        {}
+        preprocessing{{
+            image_height : 4
+            image_width : 4
+            resize_protocol : BILINEAR
+            uint8_images : true
+            mean : 0.0
+            stddev : 0.25
+            {}
+        }}
+        """
+        cache = 'cache_dir : "{}"'.format(
+            os.path.join(self.directory, 'cache'))
+        augmentations = """
+            augmentations{
+                augment_method{
+                    random_color_jitter{
+                        max_brightness_delta : 0.0
+                    }
+                }
+            }
+        """
+        # Mid gray is 128 / 255 / 0.25 once normalized. Cached images are
+        # not normalized, so configs with and without augmentations share
+        # them.
+        expected = tf.fill([4, 4, 4, 3], 128.0 / 255.0 / 0.25)
+        for cache_txt, augmentations_txt in ((cache, ''),
+                                             (cache, augmentations),
+                                             ('', augmentations)):
+            for images, _, _, _ in self._build(
+                    proto_txt.format(cache_txt, augmentations_txt),
+                    decode_fn=_decode_gray):
+                self.assertAllClose(images, expected)
+        self.assertLen(tf.io.gfile.listdir(
+            os.path.join(self.directory, 'cache')), 1)
+
+    def test_concurrently_written_cache(self):
+        cache_path = os.path.join(self.directory, 'cache')
+        tf.data.Dataset.range(3).save(cache_path)
+        exists = tf.io.gfile.exists
+        checked = list()
+
+        def exists_after_first_check(path):
+            # The cache appears after this writer checked for it.
+            if path == cache_path and not checked:
+                checked.append(path)
+                return False
+            return exists(path)
+
+        with mock.patch.object(tf.io.gfile, 'exists',
+                               exists_after_first_check):
+            dataset = build_cached_examples(tf.data.Dataset.range(5),
+                                            cache_path)
+        self.assertEqual(list(dataset.as_numpy_iterator()), [0, 1, 2])
+        self.assertEqual(tf.io.gfile.glob(cache_path + '.partial-*'), [])
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -1,8 +1,21 @@
+import numpy as np
 import tensorflow as tf
 from loguru import logger
 
+from ops.learning_schedule_ops import (ScaledSchedule, SequentialSchedule,
+                                       TabulatedSchedule, WarmupSchedule)
+from protos import learning_schedules_pb2
 
-def build_learning_schedule(schedule_proto):
+
+def build_learning_schedule(schedule_proto, global_batch_size=None):
+    # global_batch_size, when given, overrides the one configured for
+    # batch size scaling, e.g. with the batch size of the distribution
+    # strategy in use.
+    batch_size_scaling_proto = (schedule_proto.batch_size_scaling
+                                if schedule_proto.HasField(
+                                    'batch_size_scaling') else None)
+    warmup_proto = (schedule_proto.warmup
+                    if schedule_proto.HasField('warmup') else None)
     schedule_type = schedule_proto.WhichOneof('schedule')
     schedule_proto = eval('schedule_proto.{}'.format(schedule_type))
     if schedule_type == 'cosine_decay_schedule':
@@ -20,9 +33,21 @@ def build_learning_schedule(schedule_proto):
     elif schedule_type == 'constant_learning_rate':
         logger.debug('Building constant learning rate.')
         schedule = schedule_proto
+    elif schedule_type == 'tabulated_schedule':
+        schedule = build_tabulated_schedule(schedule_proto,
+                                            global_batch_size)
+    elif schedule_type == 'sequential_schedule':
+        schedule = build_sequential_schedule(schedule_proto,
+                                             global_batch_size)
     else:
         raise ValueError('A valid learning schedule proto was not found.')
 
+    if batch_size_scaling_proto is not None:
+        schedule = build_batch_size_scaling(batch_size_scaling_proto,
+                                            schedule,
+                                            global_batch_size)
+    if warmup_proto is not None:
+        schedule = build_warmup(warmup_proto, schedule)
     return schedule
 
 
@@ -117,3 +142,98 @@ def build_polynomial_decay_schedule(schedule_proto):
         cycle=cycle
     )
     return schedule
+
+
+def build_warmup(warmup_proto, schedule):
+    warmup_steps = warmup_proto.warmup_steps
+    method = learning_schedules_pb2.Warmup.Method.Name(
+        warmup_proto.method).lower()
+    initial_factor = warmup_proto.initial_factor
+    if warmup_steps <= 0:
+        logger.error('warmup_steps must be positive.')
+        raise ValueError('Please check the logs.')
+    if not 0.0 <= initial_factor <= 1.0 or (method == 'exponential' and
+                                            initial_factor <= 0.0):
+        logger.error('initial_factor must be in [0, 1], and positive for '
+                     'exponential warmup.')
+        raise ValueError('Please check the logs.')
+    logger.debug('Building {} warmup over {} steps.'.format(method,
+                                                            warmup_steps))
+    schedule = WarmupSchedule(
+        schedule=schedule,
+        warmup_steps=warmup_steps,
+        method=method,
+        initial_factor=initial_factor
+    )
+    return schedule
+
+
+def build_batch_size_scaling(batch_size_scaling_proto, schedule,
+                             global_batch_size=None):
+    reference_batch_size = batch_size_scaling_proto.reference_batch_size
+    if global_batch_size is None:
+        global_batch_size = batch_size_scaling_proto.global_batch_size
+    rule = batch_size_scaling_proto.rule
+    if reference_batch_size <= 0 or global_batch_size <= 0:
+        logger.error('Batch size scaling needs positive reference and global '
+                     'batch sizes.')
+        raise ValueError('Please check the logs.')
+    scale = global_batch_size / reference_batch_size
+    if rule == learning_schedules_pb2.BatchSizeScaling.SQRT:
+        scale = scale ** 0.5
+    logger.debug('Scaling the learning rate by {} for a global batch size '
+                 'of {}.'.format(scale, global_batch_size))
+    schedule = ScaledSchedule(schedule=schedule, scale=scale)
+    return schedule
+
+
+def build_sequential_schedule(schedule_proto, global_batch_size=None):
+    boundaries = list(schedule_proto.boundaries)
+    if len(schedule_proto.phases) - len(boundaries) - 1 != 0:
+        logger.error('Number of phases must be 1 more than the number of '
+                     'boundaries.')
+        raise ValueError('Please check the logs.')
+    if boundaries != sorted(set(boundaries)) or (boundaries and
+                                                 boundaries[0] <= 0):
+        logger.error('Boundaries of a sequential schedule must be positive '
+                     'and increasing.')
+        raise ValueError('Please check the logs.')
+    schedules = [build_learning_schedule(phase_proto, global_batch_size)
+                 for phase_proto in schedule_proto.phases]
+    logger.debug('Building SequentialSchedule of {} phases.'.format(
+        len(schedules)))
+    schedule = SequentialSchedule(
+        schedules=schedules,
+        boundaries=boundaries
+    )
+    return schedule
+
+
+def build_tabulated_schedule(schedule_proto, global_batch_size=None):
+    max_steps = schedule_proto.max_steps
+    if max_steps < 0:
+        logger.error('max_steps of a tabulated schedule must not be '
+                     'negative.')
+        raise ValueError('Please check the logs.')
+    logger.debug('Building TabulatedSchedule over {} steps.'.format(
+        max_steps + 1))
+    schedule = TabulatedSchedule(
+        schedule=build_learning_schedule(schedule_proto.schedule,
+                                         global_batch_size),
+        max_steps=max_steps
+    )
+    return schedule
+
+
+def evaluate_schedule(schedule_proto, steps, global_batch_size=None):
+    # Learning rates of the schedule at every step in steps, as a float32
+    # NumPy array of the same shape, evaluated in one vectorized call.
+    schedule = build_learning_schedule(schedule_proto, global_batch_size)
+    steps = np.asarray(steps, np.int64)
+    if not callable(schedule) or steps.size == 0:
+        return np.full(steps.shape, schedule if not callable(schedule)
+                       else 0.0, np.float32)
+    flat_steps = tf.reshape(tf.convert_to_tensor(steps), [-1])
+    values = tf.vectorized_map(
+        lambda step: tf.cast(schedule(step), tf.float32), flat_steps)
+    return np.reshape(values.numpy(), steps.shape)
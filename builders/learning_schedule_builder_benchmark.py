@@ -0,0 +1,138 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.learning_schedule_builder import (build_learning_schedule,
+                                                evaluate_schedule)
+from protos import learning_schedules_pb2
+
+MAX_STEPS = 1000000
+NUM_ITERS = 10000
+
+SCHEDULE_TXT = """
+cosine_decay_restarts_schedule{
+    initial_learning_rate : 0.1
+    first_decay_steps : 1000
+    t_mul : 2.0
+    m_mul : 0.9
+}
+"""
+
+SEQUENTIAL_TXT = """
+sequential_schedule{
+    phases{
+        constant_learning_rate : 0.1
+    }
+    phases{
+        cosine_decay_schedule{
+            initial_learning_rate : 0.1
+            decay_steps : 5000
+        }
+    }
+    phases{
+        polynomial_decay_schedule{
+            initial_learning_rate : 0.001
+            decay_steps : 5000
+        }
+    }
+    boundaries : [1000, 6000]
+}
+"""
+
+
+class _NestedCondSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # The hand written form of SEQUENTIAL_TXT.
+    def __init__(self, schedules, boundaries):
+        super().__init__()
+        self.schedules = schedules
+        self.boundaries = boundaries
+
+    def __call__(self, step):
+        return tf.cond(
+            step <= self.boundaries[0],
+            lambda: tf.constant(self.schedules[0], tf.float32),
+            lambda: tf.cond(
+                step <= self.boundaries[1],
+                lambda: self.schedules[1](step - self.boundaries[0] - 1),
+                lambda: self.schedules[2](step - self.boundaries[1] - 1)))
+
+
+def _msg(tabulated):
+    msg = learning_schedules_pb2.LearningRateSchedule()
+    if tabulated:
+        text_format.Merge(SCHEDULE_TXT, msg.tabulated_schedule.schedule)
+        msg.tabulated_schedule.max_steps = MAX_STEPS
+    else:
+        text_format.Merge(SCHEDULE_TXT, msg)
+    return msg
+
+
+class LearningScheduleBuilderBenchmark(tf.test.Benchmark):
+    def _run_schedule(self, name, tabulated=False, schedule=None,
+                      jit_compile=None):
+        # Cost of the learning rate computation in every training step.
+        if schedule is None:
+            schedule = build_learning_schedule(_msg(tabulated))
+        step = tf.Variable(0, dtype=tf.int64)
+
+        @tf.function(jit_compile=jit_compile)
+        def train_steps():
+            learning_rate = tf.constant(0.0)
+            for _ in tf.range(NUM_ITERS):
+                learning_rate += schedule(step)
+                step.assign_add(1)
+            return learning_rate
+
+        train_steps().numpy()
+        start = time.time()
+        train_steps().numpy()
+        wall_time = (time.time() - start) / NUM_ITERS
+        self.report_benchmark(name=name, iters=NUM_ITERS, wall_time=wall_time)
+
+    def benchmark_computed_schedule(self):
+        self._run_schedule('computed_schedule', tabulated=False)
+
+    def benchmark_tabulated_schedule(self):
+        self._run_schedule('tabulated_schedule', tabulated=True)
+
+    def benchmark_compiled_nested_cond_schedule(self):
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(SEQUENTIAL_TXT, msg)
+        phases = msg.sequential_schedule.phases
+        schedule = _NestedCondSchedule(
+            [build_learning_schedule(phase) for phase in phases],
+            list(msg.sequential_schedule.boundaries))
+        self._run_schedule('compiled_nested_cond_schedule', schedule=schedule,
+                           jit_compile=True)
+
+    def benchmark_compiled_sequential_schedule(self):
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(SEQUENTIAL_TXT, msg)
+        self._run_schedule('compiled_sequential_schedule',
+                           schedule=build_learning_schedule(msg),
+                           jit_compile=True)
+
+    def benchmark_evaluate_schedule(self):
+        # Whole schedule, as for plotting, against calling it step by step.
+        msg = _msg(tabulated=False)
+        start = time.time()
+        evaluate_schedule(msg, np.arange(MAX_STEPS + 1))
+        vectorized_time = time.time() - start
+        schedule = build_learning_schedule(msg)
+        start = time.time()
+        for step in range(NUM_ITERS):
+            float(schedule(step))
+        per_step_time = (time.time() - start) / NUM_ITERS
+        self.report_benchmark(
+            name='evaluate_schedule',
+            iters=MAX_STEPS + 1,
+            wall_time=vectorized_time,
+            extras={'per_step_calls_wall_time':
+                    per_step_time * (MAX_STEPS + 1)}
+        )
+
+
+if __name__ == "__main__":
+    tf.test.main()
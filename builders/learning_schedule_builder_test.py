@@ -1,7 +1,11 @@
+import numpy as np
 import tensorflow as tf
 from google.protobuf import text_format
 
-from builders.learning_schedule_builder import build_learning_schedule
+from builders.learning_schedule_builder import (build_learning_schedule,
+                                                evaluate_schedule)
+from ops.learning_schedule_ops import (ScaledSchedule, SequentialSchedule,
+                                       TabulatedSchedule, WarmupSchedule)
 from protos import learning_schedules_pb2
 
 
@@ -132,6 +136,164 @@ class LearningScheduleBuildTest(tf.test.TestCase):
         schedule = build_learning_schedule(msg)
         self.assertAlmostEqual(schedule, 0.001)
 
+    def test_tabulated_schedule(self):
+        proto_txt = """
+        tabulated_schedule{
+            schedule{
+                cosine_decay_restarts_schedule{
+                    initial_learning_rate : 0.1
+                    first_decay_steps : 10
+                }
+            }
+            max_steps : 100
+        }
+        """
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(proto_txt, msg)
+        schedule = build_learning_schedule(msg)
+        self.assertIsInstance(schedule, TabulatedSchedule)
+        self.assertEqual(schedule.table.shape, [101])
+        reference = build_learning_schedule(msg.tabulated_schedule.schedule)
+        for step in (0, 7, 10, 55, 100):
+            self.assertAllClose(schedule(step), reference(step))
+        self.assertAllClose(schedule(1000), reference(100))
+        self.assertAllClose(schedule(-1), reference(0))
+        # The config holds the source schedule, not the table.
+        config = schedule.get_config()
+        self.assertNotIn('table', config)
+        self.assertEqual(config['max_steps'], 100)
+        restored = TabulatedSchedule.from_config(config)
+        self.assertAllClose(restored.table, schedule.table)
+
+    def test_tabulated_schedule_global_batch_size(self):
+        proto_txt = """
+        tabulated_schedule{
+            schedule{
+                exponential_decay_schedule{
+                    initial_learning_rate : 0.1
+                    decay_steps : 10
+                    decay_rate : 0.5
+                }
+                batch_size_scaling{
+                    reference_batch_size : 256
+                    global_batch_size : 256
+                }
+            }
+            max_steps : 10
+        }
+        """
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(proto_txt, msg)
+        schedule = build_learning_schedule(msg, global_batch_size=1024)
+        self.assertAllClose(schedule(0), 0.4)
+        self.assertAllClose(schedule(10), 0.2)
+
+    def test_evaluate_schedule(self):
+        proto_txt = """
+        piecewise_constant_decay_schedule{
+            boundaries : [10, 20]
+            values : [0.1, 0.01, 0.001]
+        }
+        """
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(proto_txt, msg)
+        values = evaluate_schedule(msg, [[0, 10, 11], [20, 21, 5000]])
+        self.assertEqual(values.dtype, np.float32)
+        self.assertAllClose(values, [[0.1, 0.1, 0.01], [0.01, 0.001, 0.001]])
+        msg.constant_learning_rate = 0.5
+        self.assertAllClose(evaluate_schedule(msg, np.arange(3)),
+                            [0.5] * 3)
+
+    def test_warmup(self):
+        proto_txt = """
+        constant_learning_rate : 0.4
+        warmup{
+            warmup_steps : 4
+        }
+        """
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(proto_txt, msg)
+        schedule = build_learning_schedule(msg)
+        self.assertIsInstance(schedule, WarmupSchedule)
+        self.assertAllClose(evaluate_schedule(msg, [0, 1, 4, 8]),
+                            [0.0, 0.1, 0.4, 0.4])
+        msg.warmup.method = learning_schedules_pb2.Warmup.COSINE
+        self.assertAllClose(evaluate_schedule(msg, [0, 2, 4]),
+                            [0.0, 0.2, 0.4])
+        msg.warmup.method = learning_schedules_pb2.Warmup.EXPONENTIAL
+        with self.assertRaises(ValueError):
+            build_learning_schedule(msg)
+        msg.warmup.initial_factor = 0.01
+        self.assertAllClose(evaluate_schedule(msg, [0, 2, 4]),
+                            [0.004, 0.04, 0.4])
+
+    def test_batch_size_scaling(self):
+        proto_txt = """
+        exponential_decay_schedule{
+            initial_learning_rate : 0.1
+            decay_steps : 10
+            decay_rate : 0.5
+        }
+        batch_size_scaling{
+            reference_batch_size : 256
+            global_batch_size : 1024
+        }
+        warmup{
+            warmup_steps : 10
+            initial_factor : 0.25
+        }
+        """
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(proto_txt, msg)
+        schedule = build_learning_schedule(msg)
+        self.assertIsInstance(schedule.schedule, ScaledSchedule)
+        # Warmup rises from the reference to the scaled learning rate.
+        self.assertAllClose(evaluate_schedule(msg, [0, 10, 20]),
+                            [0.1, 0.2, 0.1])
+        msg.batch_size_scaling.rule = (
+            learning_schedules_pb2.BatchSizeScaling.SQRT)
+        self.assertAllClose(
+            evaluate_schedule(msg, [20], global_batch_size=4096), [0.1])
+
+    def test_sequential_schedule(self):
+        proto_txt = """
+        sequential_schedule{
+            phases{
+                constant_learning_rate : 0.1
+            }
+            phases{
+                cosine_decay_schedule{
+                    initial_learning_rate : 0.1
+                    decay_steps : 10
+                }
+            }
+            phases{
+                polynomial_decay_schedule{
+                    initial_learning_rate : 0.01
+                    decay_steps : 10
+                    end_learning_rate : 0.0
+                    power : 1.0
+                }
+            }
+            boundaries : [5, 15]
+        }
+        """
+        msg = learning_schedules_pb2.LearningRateSchedule()
+        text_format.Merge(proto_txt, msg)
+        schedule = build_learning_schedule(msg)
+        self.assertIsInstance(schedule, SequentialSchedule)
+        # Phases switch one step after their boundary, so steps 5 and 15
+        # still belong to the earlier phase.
+        steps = [0, 5, 6, 11, 15, 16, 21, 101]
+        expected = [0.1, 0.1, 0.1, 0.05, 0.0024472, 0.01, 0.005, 0.0]
+        self.assertAllClose(evaluate_schedule(msg, steps), expected)
+        compiled_schedule = tf.function(schedule, jit_compile=True)
+        self.assertAllClose([compiled_schedule(tf.constant(step, tf.int64))
+                             for step in steps], expected)
+        del msg.sequential_schedule.boundaries[-1]
+        with self.assertRaises(ValueError):
+            build_learning_schedule(msg)
+
 
 if __name__ == "__main__":
     tf.test.main()
@@ -2,13 +2,22 @@ import tensorflow as tf
 from loguru import logger
 
 from builders import learning_schedule_builder as ls_builder
+from ops.optimizer_ops import GradientAccumulation, Lamb, Lars
 
 
-def build_optimizer(optimizer_proto):
+def build_optimizer(optimizer_proto, global_batch_size=None):
+    # global_batch_size is the batch of a single step over all replicas. With
+    # gradient accumulation every applied update covers
+    # gradient_accumulation_steps of them, which batch size scaling has to
+    # see.
     optimizer_type = optimizer_proto.WhichOneof('optimizer')
+    gradient_accumulation_steps = optimizer_proto.gradient_accumulation_steps
+    if global_batch_size is not None and gradient_accumulation_steps > 1:
+        global_batch_size *= gradient_accumulation_steps
     optimizer_proto = eval('optimizer_proto.{}'.format(optimizer_type))
     learning_schedule = ls_builder.build_learning_schedule(
-        optimizer_proto.learning_schedule
+        optimizer_proto.learning_schedule,
+        global_batch_size=global_batch_size
     )
     if optimizer_type == 'adadelta':
         optimizer = build_adadelta(optimizer_proto, learning_schedule)
@@ -32,9 +41,18 @@ def build_optimizer(optimizer_proto):
 
     elif optimizer_type == 'sgd':
         optimizer = build_sgd(optimizer_proto, learning_schedule)
+
+    elif optimizer_type == 'lamb':
+        optimizer = build_lamb(optimizer_proto, learning_schedule)
+
+    elif optimizer_type == 'lars':
+        optimizer = build_lars(optimizer_proto, learning_schedule)
     else:
         raise ValueError('A valid optimizer proto was not found.')
 
+    if gradient_accumulation_steps != 1:
+        optimizer = build_gradient_accumulation(optimizer,
+                                                gradient_accumulation_steps)
     return optimizer
 
 
@@ -165,3 +183,63 @@ def build_sgd(optimizer_proto, learning_schedule):
     )
 
     return optimizer
+
+
+def build_lamb(optimizer_proto, learning_schedule):
+    beta_1 = optimizer_proto.beta_1
+    beta_2 = optimizer_proto.beta_2
+    epsilon = optimizer_proto.epsilon
+    weight_decay = optimizer_proto.weight_decay
+    exclude_from_weight_decay = list(optimizer_proto.exclude_from_weight_decay)
+    exclude_from_layer_adaptation = list(
+        optimizer_proto.exclude_from_layer_adaptation)
+    logger.debug('Building LAMB Optimizer.')
+    optimizer = Lamb(
+        learning_rate=learning_schedule,
+        beta_1=beta_1,
+        beta_2=beta_2,
+        epsilon=epsilon,
+        weight_decay_rate=weight_decay,
+        exclude_from_weight_decay=exclude_from_weight_decay,
+        exclude_from_layer_adaptation=exclude_from_layer_adaptation
+    )
+
+    return optimizer
+
+
+def build_lars(optimizer_proto, learning_schedule):
+    momentum = optimizer_proto.momentum
+    weight_decay = optimizer_proto.weight_decay
+    eeta = optimizer_proto.eeta
+    epsilon = optimizer_proto.epsilon
+    nesterov = optimizer_proto.nesterov
+    exclude_from_weight_decay = list(optimizer_proto.exclude_from_weight_decay)
+    exclude_from_layer_adaptation = list(
+        optimizer_proto.exclude_from_layer_adaptation)
+    logger.debug('Building LARS Optimizer.')
+    optimizer = Lars(
+        learning_rate=learning_schedule,
+        momentum=momentum,
+        weight_decay_rate=weight_decay,
+        eeta=eeta,
+        epsilon=epsilon,
+        nesterov=nesterov,
+        exclude_from_weight_decay=exclude_from_weight_decay,
+        exclude_from_layer_adaptation=exclude_from_layer_adaptation
+    )
+
+    return optimizer
+
+
+def build_gradient_accumulation(optimizer, gradient_accumulation_steps):
+    if gradient_accumulation_steps < 1:
+        logger.error('gradient_accumulation_steps must be positive, got {}.'
+                     .format(gradient_accumulation_steps))
+        raise ValueError('Please see the log message above.')
+    logger.debug('Building GradientAccumulation over {} steps.'.format(
+        gradient_accumulation_steps))
+    optimizer = GradientAccumulation(
+        optimizer,
+        accumulation_steps=gradient_accumulation_steps
+    )
+    return optimizer
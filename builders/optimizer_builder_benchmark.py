@@ -0,0 +1,150 @@
+import time
+
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.optimizer_builder import build_optimizer
+from protos import optimizers_pb2
+
+BATCH_SIZE = 4096
+NUM_FEATURES = 256
+NUM_HIDDEN = 512
+NUM_CLASSES = 10
+NUM_STEPS = 200
+
+OPTIMIZER_TXTS = {
+    'adam': """
+    adam{
+        learning_schedule{
+            constant_learning_rate : 0.01
+        }
+    }
+    """,
+    'lamb': """
+    lamb{
+        learning_schedule{
+            constant_learning_rate : 0.01
+        }
+        weight_decay : 0.0001
+        exclude_from_weight_decay : "bias"
+        exclude_from_layer_adaptation : "bias"
+    }
+    """,
+    'sgd': """
+    sgd{
+        learning_schedule{
+            constant_learning_rate : 0.5
+        }
+        momentum : 0.9
+    }
+    """,
+    'sgd_accumulation': """
+    sgd{
+        learning_schedule{
+            constant_learning_rate : 0.5
+        }
+        momentum : 0.9
+    }
+    gradient_accumulation_steps : 4
+    """,
+    'lars': """
+    lars{
+        learning_schedule{
+            constant_learning_rate : 5.0
+        }
+        momentum : 0.9
+        weight_decay : 0.0001
+        exclude_from_weight_decay : "bias"
+        exclude_from_layer_adaptation : "bias"
+    }
+    """,
+}
+
+
+def _data():
+    # Labels of a random teacher network, so the task is learnable.
+    features = tf.random.stateless_normal([BATCH_SIZE * 4, NUM_FEATURES],
+                                          seed=[0, 1])
+    teacher = tf.random.stateless_normal([NUM_FEATURES, NUM_CLASSES],
+                                         seed=[0, 2])
+    labels = tf.argmax(tf.tanh(features @ teacher), axis=-1)
+    return features, labels
+
+
+def _variables():
+    return [
+        tf.Variable(tf.random.stateless_normal(
+            [NUM_FEATURES, NUM_HIDDEN], seed=[1, 0]) * NUM_FEATURES ** -0.5,
+            name='kernel_0'),
+        tf.Variable(tf.zeros([NUM_HIDDEN]), name='bias_0'),
+        tf.Variable(tf.random.stateless_normal(
+            [NUM_HIDDEN, NUM_CLASSES], seed=[1, 1]) * NUM_HIDDEN ** -0.5,
+            name='kernel_1'),
+        tf.Variable(tf.zeros([NUM_CLASSES]), name='bias_1'),
+    ]
+
+
+def _loss(variables, features, labels):
+    hidden = tf.nn.relu(features @ variables[0] + variables[1])
+    logits = hidden @ variables[2] + variables[3]
+    return tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=labels, logits=logits))
+
+
+class OptimizerBuilderBenchmark(tf.test.Benchmark):
+    def _run(self, name, proto_name=None, batch_size=BATCH_SIZE):
+        msg = optimizers_pb2.Optimizer()
+        text_format.Merge(OPTIMIZER_TXTS[proto_name or name], msg)
+        optimizer = build_optimizer(msg)
+        variables = _variables()
+        features, labels = _data()
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (features, labels)).repeat().batch(batch_size)
+        iterator = iter(dataset)
+
+        @tf.function
+        def train_step(features, labels):
+            with tf.GradientTape() as tape:
+                loss = _loss(variables, features, labels)
+            gradients = tape.gradient(loss, variables)
+            optimizer.apply_gradients(zip(gradients, variables))
+            return loss
+
+        train_step(*next(iterator))
+        start = time.time()
+        for _ in range(NUM_STEPS - 1):
+            loss = train_step(*next(iterator))
+        loss = float(loss)
+        wall_time = (time.time() - start) / (NUM_STEPS - 1)
+        self.report_benchmark(
+            name=name,
+            iters=NUM_STEPS,
+            wall_time=wall_time,
+            extras={'final_loss': loss,
+                    'full_data_loss': float(_loss(variables, features,
+                                                  labels))}
+        )
+
+    def benchmark_adam(self):
+        self._run('adam')
+
+    def benchmark_lamb(self):
+        self._run('lamb')
+
+    def benchmark_sgd(self):
+        self._run('sgd')
+
+    def benchmark_lars(self):
+        self._run('lars')
+
+    # Steps on a quarter of the batch, plain and accumulated over 4 steps,
+    # give the per micro-batch cost of the accumulation buffers.
+    def benchmark_sgd_micro_batch(self):
+        self._run('sgd_micro_batch', 'sgd', BATCH_SIZE // 4)
+
+    def benchmark_sgd_accumulation(self):
+        self._run('sgd_accumulation', batch_size=BATCH_SIZE // 4)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -2,6 +2,7 @@ import tensorflow as tf
 from google.protobuf import text_format
 
 from builders.optimizer_builder import build_optimizer
+from ops.optimizer_ops import GradientAccumulation, Lamb, Lars
 from protos import optimizers_pb2
 
 
@@ -218,6 +219,157 @@ class TestOptimizerBuild(tf.test.TestCase):
         self.assertEqual(opt._hyper['momentum'], 0.1)
         self.assertEqual(opt.nesterov, False)
 
+    def test_lamb(self):
+        proto_txt = """
+        lamb{
+            learning_schedule{
+                constant_learning_rate : 0.1
+            }
+            weight_decay : 0.01
+            exclude_from_weight_decay : "bias"
+        }
+        """
+        msg = optimizers_pb2.Optimizer()
+        text_format.Merge(proto_txt, msg)
+        opt = build_optimizer(msg)
+        self.assertIsInstance(opt, Lamb)
+        self.assertEqual(opt.weight_decay_rate, 0.01)
+        self.assertEqual(opt.exclude_from_weight_decay, ['bias'])
+        var = tf.Variable([3.0, 4.0], name='bias')
+        opt.apply_gradients([(tf.constant([1.0, 1.0]), var)])
+        # The first Adam update is about the gradient sign, scaled to
+        # ||w|| / ||update|| = 5 / sqrt(2).
+        self.assertAllClose(var,
+                            tf.constant([3.0, 4.0]) - 0.1 * 5.0 / 2.0 ** 0.5,
+                            atol=1e-5)
+
+    def test_lars(self):
+        proto_txt = """
+        lars{
+            learning_schedule{
+                constant_learning_rate : 0.1
+            }
+            momentum : 0.9
+            eeta : 0.001
+        }
+        """
+        msg = optimizers_pb2.Optimizer()
+        text_format.Merge(proto_txt, msg)
+        opt = build_optimizer(msg)
+        self.assertIsInstance(opt, Lars)
+        self.assertEqual(opt.momentum, 0.9)
+        self.assertEqual(opt.eeta, 0.001)
+        var = tf.Variable([3.0, 4.0])
+        grad = tf.constant([0.6, 0.8])
+        opt.apply_gradients([(grad, var)])
+        opt.apply_gradients([(grad, var)])
+        # Trust ratio eeta * ||w|| / ||g|| of about 0.005 on both steps.
+        self.assertAllClose(var,
+                            tf.constant([3.0, 4.0]) - 0.1 * 0.005 * 2.9 * grad,
+                            rtol=1e-4)
+
+    def test_gradient_accumulation(self):
+        proto_txt = """
+        sgd{
+            learning_schedule{
+                piecewise_constant_decay_schedule{
+                    boundaries : 1
+                    values : [1.0, 0.5]
+                }
+            }
+        }
+        gradient_accumulation_steps : 2
+        """
+        msg = optimizers_pb2.Optimizer()
+        text_format.Merge(proto_txt, msg)
+        opt = build_optimizer(msg)
+        self.assertIsInstance(opt, GradientAccumulation)
+        var = tf.Variable([1.0, 2.0])
+        embeddings = tf.Variable(tf.ones([3, 2]))
+
+        @tf.function
+        def step(grad):
+            opt.apply_gradients([
+                (grad, var),
+                (tf.IndexedSlices(tf.ones([1, 2]), tf.constant([1])),
+                 embeddings)])
+
+        for grad, expected in (([1.0, 1.0], [1.0, 2.0]),
+                               ([3.0, 3.0], [-1.0, 0.0]),
+                               ([2.0, 2.0], [-1.0, 0.0]),
+                               ([2.0, 2.0], [-3.0, -2.0])):
+            step(tf.constant(grad))
+            self.assertAllClose(var, expected)
+        # The schedule sees 2 applied steps, counting 4 micro-batches would
+        # have halved the second learning rate.
+        self.assertEqual(opt.iterations, 4)
+        self.assertEqual(opt.optimizer.iterations, 2)
+        self.assertAllClose(embeddings, [[1.0, 1.0], [-1.0, -1.0],
+                                         [1.0, 1.0]])
+        msg.gradient_accumulation_steps = 0
+        with self.assertRaises(ValueError):
+            build_optimizer(msg)
+
+    def test_gradient_accumulation_scales_learning_rate(self):
+        proto_txt = """
+        sgd{
+            learning_schedule{
+                constant_learning_rate : 0.1
+                batch_size_scaling{
+                    reference_batch_size : 256
+                }
+            }
+        }
+        gradient_accumulation_steps : 4
+        """
+        msg = optimizers_pb2.Optimizer()
+        text_format.Merge(proto_txt, msg)
+        # Every update covers 4 steps of 256 examples.
+        opt = build_optimizer(msg, global_batch_size=256)
+        self.assertAllClose(opt.learning_rate, 0.4)
+        msg.gradient_accumulation_steps = 1
+        opt = build_optimizer(msg, global_batch_size=256)
+        self.assertAllClose(opt.learning_rate, 0.1)
+
+    def test_gradient_accumulation_under_strategy(self):
+        proto_txt = """
+        sgd{
+            learning_schedule{
+                constant_learning_rate : 1.0
+            }
+        }
+        gradient_accumulation_steps : 2
+        """
+        msg = optimizers_pb2.Optimizer()
+        text_format.Merge(proto_txt, msg)
+        strategy = tf.distribute.MirroredStrategy(['/cpu:0'])
+        with strategy.scope():
+            opt = build_optimizer(msg)
+            var = tf.Variable([1.0, 2.0])
+
+        @tf.function
+        def step(grad):
+            strategy.run(opt.apply_gradients, args=([(grad, var)],))
+
+        step(tf.constant([1.0, 1.0]))
+        self.assertAllClose(var, [1.0, 2.0])
+        step(tf.constant([3.0, 3.0]))
+        self.assertAllClose(var, [-1.0, 0.0])
+        self.assertEqual(opt.iterations, 2)
+        self.assertEqual(opt.optimizer.iterations, 1)
+
+        # Keras trains with it like with any optimizer.
+        with strategy.scope():
+            model = tf.keras.Sequential([
+                tf.keras.layers.Dense(1, kernel_initializer='zeros',
+                                      use_bias=False)])
+            model.compile(optimizer=build_optimizer(msg), loss='mse')
+        model.fit(tf.fill([4, 1], 0.5), tf.ones([4, 1]), batch_size=1,
+                  verbose=0)
+        self.assertEqual(model.optimizer.iterations, 4)
+        self.assertEqual(model.optimizer.optimizer.iterations, 2)
+        self.assertAllClose(model.weights[0], [[1.5]])
+
 
 if __name__ == "__main__":
     tf.test.main()
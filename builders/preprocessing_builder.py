@@ -1,3 +1,4 @@
+import bisect
 import functools
 
 import tensorflow as tf
@@ -7,20 +8,104 @@ from builders import augmentations_builder as aug_builder
 from protos import preprocessing_pb2
 
 
-def build_preprocessing(preprocessing_proto):
-    image_height = preprocessing_proto.image_height
-    image_width = preprocessing_proto.image_width
+def build_preprocessing(preprocessing_proto, step=0,
+                        augment_after_resize=False, cached_resize=False):
+    # Every resize function takes and returns an (images, labels, boxes,
+    # masks) example, like the augmentations, with keypoints appended when
+    # they are passed.
+    # With progressive resizing the target size is the one of the training
+    # step given, so a new resize function is built for every resolution.
+    # augment_after_resize tells that the caller runs the augmentations on
+    # resized images, as decode_jpeg always does. Normalization then moves
+    # from the resize to the end of the augmentations, which expect images
+    # in [0, 1].
+    # cached_resize tells that the caller caches the resized images before
+    # the augmentations. The resize then never normalizes, so the cached
+    # images do not depend on where normalization runs, and normalization
+    # follows the augmentations even when there are none.
+    image_height, image_width = build_image_size(preprocessing_proto, step)
     resize_protocol_value = preprocessing_proto.resize_protocol
     resize_protocol = build_resize_protocol(resize_protocol_value)
-    resize_fn = build_resize_preprocessing_fn(image_height=image_height,
-                                              image_width=image_width,
-                                              resize_protocol=resize_protocol)
+    mask_resize_protocol = build_mask_resize_protocol(
+        preprocessing_proto.mask_resize_protocol)
+    uint8_images = preprocessing_proto.uint8_images
+    letterbox = preprocessing_proto.letterbox
     augmentations_proto = preprocessing_proto.augmentations
+    normalization = build_normalization(preprocessing_proto)
+    normalize_after_augmentations = (
+        normalization is not None and
+        not preprocessing_proto.defer_geometric_augmentations and
+        (cached_resize or
+         ((augment_after_resize or preprocessing_proto.decode_jpeg) and
+          len(augmentations_proto.augment_method) > 0)))
+    resize_normalization = (None if normalize_after_augmentations
+                            else normalization)
+    if preprocessing_proto.HasField('aspect_ratio_buckets'):
+        if (preprocessing_proto.decode_jpeg or letterbox or
+                preprocessing_proto.defer_geometric_augmentations):
+            logger.error('Aspect ratio buckets cannot be combined with '
+                         'decode_jpeg, letterbox or '
+                         'defer_geometric_augmentations.')
+            raise ValueError('Please see the log message above.')
+        resize_fn = functools.partial(
+            resize_to_bucket,
+            bucket_shapes=build_bucket_shapes(preprocessing_proto, step),
+            method=resize_protocol,
+            mask_method=mask_resize_protocol,
+            uint8_images=uint8_images,
+            normalization=resize_normalization
+        )
+    elif preprocessing_proto.decode_jpeg:
+        if preprocessing_proto.defer_geometric_augmentations:
+            logger.error('JPEGs are decoded and resized before any '
+                         'augmentation, defer_geometric_augmentations does '
+                         'not apply.')
+            raise ValueError('Please see the log message above.')
+        resize_fn = build_decode_jpeg_preprocessing_fn(
+            image_height=image_height,
+            image_width=image_width,
+            resize_protocol=resize_protocol,
+            central_crop_fraction=preprocessing_proto.central_crop_fraction,
+            mask_resize_protocol=mask_resize_protocol,
+            letterbox=letterbox,
+            normalization=resize_normalization)
+    else:
+        resize_fn = build_resize_preprocessing_fn(
+            image_height=image_height,
+            image_width=image_width,
+            resize_protocol=resize_protocol,
+            uint8_images=uint8_images,
+            mask_resize_protocol=mask_resize_protocol,
+            letterbox=letterbox,
+            normalization=resize_normalization)
+    if resize_fn is None and resize_normalization is not None:
+        logger.error('Normalization is done by the resize and needs a '
+                     'target size.')
+        raise ValueError('Please see the log message above.')
+    if (preprocessing_proto.defer_geometric_augmentations and
+            resize_fn is not None):
+        augmentation_fn = aug_builder.build_augmentations(
+            augmentations_proto=augmentations_proto,
+            resize_fn=resize_fn)
+        return None, augmentation_fn
     augmentation_fn = aug_builder.build_augmentations(
         augmentations_proto=augmentations_proto)
+    if normalize_after_augmentations:
+        logger.debug('Normalizing images after the augmentations.')
+        augmentation_fn = _normalized(augmentation_fn, normalization)
     return resize_fn, augmentation_fn
 
 
+def _normalized(augmentation_fn, normalization):
+    # Images that were not resized may still be uint8.
+    def normalized_augmentation_fn(x, *args):
+        x = augmentation_fn(x, *args)
+        images = tf.image.convert_image_dtype(x[0], tf.float32)
+        return (normalize_images(images, *normalization),) + tuple(x[1:])
+
+    return normalized_augmentation_fn
+
+
 def build_resize_protocol(protocol_value):
     protocol_name = preprocessing_pb2._RESIZEPROTOCOL.values_by_number[
         protocol_value].name
@@ -47,15 +132,435 @@ def build_resize_protocol(protocol_value):
     return protocol
 
 
-def build_resize_preprocessing_fn(image_height, image_width, resize_protocol):
+def build_image_dtype(dtype_value):
+    dtype_name = preprocessing_pb2._IMAGEDTYPE.values_by_number[
+        dtype_value].name
+    logger.debug('Using image dtype : {}.'.format(dtype_name))
+    if dtype_name == 'FLOAT32':
+        dtype = tf.float32
+    elif dtype_name == 'BFLOAT16':
+        dtype = tf.bfloat16
+    elif dtype_name == 'FLOAT16':
+        dtype = tf.float16
+    else:
+        logger.error('Unsupported image dtype.')
+        raise ValueError('Please refer to the log message above.')
+    return dtype
+
+
+def build_normalization(preprocessing_proto):
+    # Returns (scale, offset, dtype) such that normalized images are
+    # images * scale + offset in dtype, for images in [0, 1], or None when
+    # the resize outputs float32 images in [0, 1].
+    mean = list(preprocessing_proto.mean)
+    stddev = list(preprocessing_proto.stddev)
+    dtype = build_image_dtype(preprocessing_proto.image_dtype)
+    if not mean and not stddev and dtype == tf.float32:
+        return None
+    if mean and stddev and len(mean) != len(stddev):
+        logger.error('mean and stddev need one value per channel each.')
+        raise ValueError('Please see the log message above.')
+    mean = mean or [0.0] * max(len(stddev), 1)
+    stddev = stddev or [1.0] * len(mean)
+    if min(stddev) <= 0.0:
+        logger.error('stddev must be positive.')
+        raise ValueError('Please see the log message above.')
+    logger.debug('Normalizing images with mean {} and stddev {}.'.format(
+        mean, stddev))
+    scale = [1.0 / s for s in stddev]
+    offset = [-m / s for m, s in zip(mean, stddev)]
+    return scale, offset, dtype
+
+
+def build_mask_resize_protocol(protocol_value):
+    protocol = build_resize_protocol(protocol_value)
+    if protocol not in (tf.image.ResizeMethod.NEAREST_NEIGHBOR,
+                        tf.image.ResizeMethod.AREA):
+        logger.error('Masks can only be resized with NEAREST_NEIGHBOR or '
+                     'AREA.')
+        raise ValueError('Please see the log message above.')
+    return protocol
+
+
+def build_resize_preprocessing_fn(image_height, image_width, resize_protocol,
+                                  uint8_images=False,
+                                  mask_resize_protocol=(
+                                      tf.image.ResizeMethod.NEAREST_NEIGHBOR),
+                                  letterbox=False,
+                                  normalization=None):
     if image_height == 0 or image_width == 0:
         logger.debug('No resizing will be done during preprocessing.')
         return None
 
+    if uint8_images:
+        logger.debug('Converting uint8 images to float32 during resize.')
+    if letterbox:
+        logger.debug('Letterboxing images to keep their aspect ratio.')
     resize_fn = functools.partial(
-        tf.image.resize,
+        resize_examples,
         size=[image_height, image_width],
-        method=resize_protocol
+        method=resize_protocol,
+        mask_method=mask_resize_protocol,
+        letterbox=letterbox,
+        uint8_images=uint8_images,
+        normalization=normalization
     )
+    return resize_fn
+
+
+def resize_examples(images, labels=None, boxes=None, masks=None,
+                    keypoints=None,
+                    size=None,
+                    method=tf.image.ResizeMethod.BILINEAR,
+                    mask_method=tf.image.ResizeMethod.NEAREST_NEIGHBOR,
+                    letterbox=False,
+                    uint8_images=False,
+                    normalization=None):
+    # Accepts a single example or a batch of equally sized ones. Dense
+    # [(batch,) N, height, width] masks of all instances are resized in a
+    # single op. Letterboxing resizes keeping the aspect ratio and pads
+    # around the image to size, moving normalized boxes, polygon vertices
+    # and keypoints with it; a plain resize leaves them unchanged.
+    # normalization, from build_normalization, is applied to the resized
+    # images in the same pass that scales uint8 images to [0, 1].
+    if not letterbox:
+        images = _resize_images(images, size=size, method=method,
+                                uint8_images=uint8_images,
+                                normalization=normalization)
+        masks = _resize_masks(masks, size=size, method=mask_method)
+        return _examples(images, labels, boxes, masks, keypoints)
+    shape = tf.shape(images)
+    height = tf.cast(shape[-3], tf.float32)
+    width = tf.cast(shape[-2], tf.float32)
+    padded_shape = tf.constant(size, tf.int32)
+    scale = tf.minimum(size[0] / height, size[1] / width)
+    resized_shape = tf.minimum(
+        tf.maximum(tf.cast(tf.round(tf.stack([height, width]) * scale),
+                           tf.int32), 1),
+        padded_shape)
+    return _resize_and_pad(images, labels, boxes, masks, keypoints,
+                           resized_shape=resized_shape,
+                           padded_shape=padded_shape,
+                           offset=(padded_shape - resized_shape) // 2,
+                           method=method,
+                           mask_method=mask_method,
+                           uint8_images=uint8_images,
+                           normalization=normalization)
+
+
+def build_image_size(preprocessing_proto, step=0):
+    if not preprocessing_proto.HasField('progressive_resizing'):
+        return (preprocessing_proto.image_height,
+                preprocessing_proto.image_width)
+    phase = build_resizing_phase(preprocessing_proto, step)
+    progressive_resizing_proto = preprocessing_proto.progressive_resizing
+    return (progressive_resizing_proto.image_heights[phase],
+            progressive_resizing_proto.image_widths[phase])
+
+
+def build_resizing_phase(preprocessing_proto, step=0):
+    # Index of the resolution used at step, with the boundary semantics of
+    # PiecewiseConstantDecay: the first resolution up to and including
+    # boundaries[0], the second one up to boundaries[1] and so on.
+    progressive_resizing_proto = preprocessing_proto.progressive_resizing
+    boundaries = list(progressive_resizing_proto.boundaries)
+    image_heights = progressive_resizing_proto.image_heights
+    image_widths = progressive_resizing_proto.image_widths
+    if (len(image_heights) - len(boundaries) - 1 != 0 or
+            len(image_widths) - len(boundaries) - 1 != 0):
+        logger.error('Number of elements in image_heights and image_widths '
+                     'must be 1 more than those in boundaries.')
+        raise ValueError('Please see the log message above.')
+    if boundaries != sorted(set(boundaries)):
+        logger.error('Progressive resizing boundaries must be increasing.')
+        raise ValueError('Please see the log message above.')
+    if min(image_heights) <= 0 or min(image_widths) <= 0:
+        logger.error('Progressive resizing needs positive image sizes.')
+        raise ValueError('Please see the log message above.')
+    return bisect.bisect_left(boundaries, step)
+
+
+def build_resizing_phase_end(preprocessing_proto, step=0):
+    # Last step of the resolution used at step, or None when it is kept
+    # until the end of training.
+    if not preprocessing_proto.HasField('progressive_resizing'):
+        return None
+    boundaries = preprocessing_proto.progressive_resizing.boundaries
+    phase = build_resizing_phase(preprocessing_proto, step)
+    if phase == len(boundaries):
+        return None
+    return boundaries[phase]
+
 
+def build_bucket_shapes(preprocessing_proto, step=0):
+    # [height, width] of every aspect ratio bucket.
+    buckets_proto = preprocessing_proto.aspect_ratio_buckets
+    image_height, image_width = build_image_size(preprocessing_proto, step)
+    area = image_height * image_width
+    size_multiple = buckets_proto.size_multiple
+    if (area <= 0 or size_multiple <= 0 or not buckets_proto.aspect_ratios or
+            min(buckets_proto.aspect_ratios) <= 0.0):
+        logger.error('Aspect ratio buckets need a target size, positive '
+                     'aspect ratios and a positive size_multiple.')
+        raise ValueError('Please see the log message above.')
+    bucket_shapes = list()
+    for aspect_ratio in buckets_proto.aspect_ratios:
+        height = (area / aspect_ratio) ** 0.5
+        bucket_shapes.append([
+            max(int(round(height / size_multiple)), 1) * size_multiple,
+            max(int(round(height * aspect_ratio / size_multiple)), 1) *
+            size_multiple
+        ])
+    logger.debug('Using aspect ratio buckets : {}.'.format(bucket_shapes))
+    return bucket_shapes
+
+
+def resize_to_bucket(images, labels=None, boxes=None, masks=None,
+                     keypoints=None,
+                     bucket_shapes=None,
+                     method=tf.image.ResizeMethod.BILINEAR,
+                     mask_method=tf.image.ResizeMethod.NEAREST_NEIGHBOR,
+                     uint8_images=False,
+                     normalization=None):
+    # Resizes a single [height, width, channels] image, keeping its aspect
+    # ratio, to fit in the bucket with the closest aspect ratio and pads it
+    # to the bucket shape. Batches of one bucket then need no further
+    # padding and only len(bucket_shapes) image shapes are ever produced.
+    shape = tf.shape(images)
+    height = tf.cast(shape[0], tf.float32)
+    width = tf.cast(shape[1], tf.float32)
+    bucket_shapes = tf.constant(bucket_shapes, tf.int32)
+    bucket_sizes = tf.cast(bucket_shapes, tf.float32)
+    bucket = tf.argmin(tf.abs(
+        tf.math.log(bucket_sizes[:, 1] / bucket_sizes[:, 0]) -
+        tf.math.log(width / height)))
+    bucket_shape = tf.gather(bucket_shapes, bucket)
+    bucket_size = tf.gather(bucket_sizes, bucket)
+    scale = tf.minimum(bucket_size[0] / height, bucket_size[1] / width)
+    resized_shape = tf.minimum(
+        tf.maximum(tf.cast(tf.round(tf.stack([height, width]) * scale),
+                           tf.int32), 1),
+        bucket_shape)
+    return _resize_and_pad(images, labels, boxes, masks, keypoints,
+                           resized_shape=resized_shape,
+                           padded_shape=bucket_shape,
+                           offset=tf.zeros([2], tf.int32),
+                           method=method,
+                           mask_method=mask_method,
+                           uint8_images=uint8_images,
+                           normalization=normalization)
+
+
+def _resize_and_pad(images, labels, boxes, masks, keypoints, resized_shape,
+                    padded_shape, offset, method, mask_method, uint8_images,
+                    normalization=None):
+    # Resizes to resized_shape and pads to padded_shape with the resized
+    # image at offset. Normalized boxes, polygon vertices and keypoints are
+    # moved to the padded image. Padding is zero after normalization, so
+    # it takes the mean colour.
+    images = tf.image.pad_to_bounding_box(
+        _resize_images(images, size=resized_shape, method=method,
+                       uint8_images=uint8_images,
+                       normalization=normalization),
+        offset[0], offset[1], padded_shape[0], padded_shape[1])
+    if masks is not None and not isinstance(masks, tf.RaggedTensor):
+        masks = _resize_masks(masks, size=resized_shape, method=mask_method,
+                              offset=offset, padded_shape=padded_shape)
+    padded_size = tf.cast(padded_shape, tf.float32)
+    boxes, masks, keypoints = _transform_annotations(
+        boxes, masks, keypoints,
+        scale=tf.cast(resized_shape, tf.float32) / padded_size,
+        offset=tf.cast(offset, tf.float32) / padded_size)
+    return _examples(images, labels, boxes, masks, keypoints)
+
+
+def _resize_images(images, size, method, uint8_images, normalization=None):
+    if normalization is None:
+        if uint8_images:
+            return resize_uint8_images(images, size=size, method=method)
+        return tf.image.resize(images, size=size, method=method)
+    scale, offset, dtype = normalization
+    if uint8_images:
+        if images.dtype != tf.uint8:
+            raise ValueError('Expected uint8 images, got {}.'.format(
+                images.dtype))
+        # Folds the conversion to [0, 1] into the normalization.
+        scale = [s / 255.0 for s in scale]
+    return normalize_images(
+        tf.image.resize(images, size=size, method=method), scale, offset,
+        dtype)
+
+
+def normalize_images(images, scale, offset, dtype=tf.float32):
+    # Per channel images * scale + offset, computed in float32 and cast once
+    # to dtype.
+    images = tf.cast(images, tf.float32) * tf.constant(scale) + tf.constant(
+        offset)
+    return tf.cast(images, dtype)
+
+
+def _resize_masks(masks, size, method, offset=None, padded_shape=None):
+    # Instances are resized together as the channels of a single image.
+    # Masks of other dtypes than float keep their dtype, area resampled ones
+    # are rounded back to it.
+    if masks is None or isinstance(masks, tf.RaggedTensor):
+        return masks
+    dtype = masks.dtype
+    batched = masks.shape.rank == 4
+    to_channels = [0, 2, 3, 1] if batched else [1, 2, 0]
+    from_channels = [0, 3, 1, 2] if batched else [2, 0, 1]
+    resized_masks = tf.image.resize(
+        tf.transpose(tf.cast(masks, tf.uint8) if dtype == tf.bool else masks,
+                     to_channels),
+        size=size,
+        method=method)
+    if padded_shape is not None:
+        resized_masks = tf.image.pad_to_bounding_box(
+            resized_masks, offset[0], offset[1], padded_shape[0],
+            padded_shape[1])
+    resized_masks = tf.transpose(resized_masks, from_channels)
+    if dtype == tf.bool:
+        return tf.greater_equal(tf.cast(resized_masks, tf.float32), 0.5)
+    if dtype.is_integer:
+        return tf.saturate_cast(tf.round(resized_masks), dtype)
+    return tf.cast(resized_masks, dtype)
+
+
+def _transform_annotations(boxes, masks, keypoints, scale, offset):
+    # Maps normalized (y, x) points to points * scale + offset. Polygon masks
+    # move like keypoints, dense masks are left alone.
+    if boxes is not None:
+        boxes = boxes * tf.tile(scale, [2]) + tf.tile(offset, [2])
+    if isinstance(masks, tf.RaggedTensor):
+        masks = masks * scale + offset
+    if keypoints is not None:
+        keypoints = keypoints * scale + offset
+    return boxes, masks, keypoints
+
+
+def _examples(images, labels, boxes, masks, keypoints):
+    if keypoints is None:
+        return images, labels, boxes, masks
+    return images, labels, boxes, masks, keypoints
+
+
+def build_decode_jpeg_preprocessing_fn(image_height, image_width,
+                                       resize_protocol,
+                                       central_crop_fraction=1.0,
+                                       mask_resize_protocol=(
+                                           tf.image.ResizeMethod
+                                           .NEAREST_NEIGHBOR),
+                                       letterbox=False,
+                                       normalization=None):
+    if image_height <= 0 or image_width <= 0:
+        logger.error('Decoding JPEGs to size needs a target size.')
+        raise ValueError('Please see the log message above.')
+    if not 0.0 < central_crop_fraction <= 1.0:
+        logger.error('central_crop_fraction must be in (0, 1].')
+        raise ValueError('Please see the log message above.')
+    logger.debug('Decoding JPEGs with DCT downscaling during resize.')
+    resize_fn = functools.partial(
+        decode_and_resize_jpeg,
+        size=[image_height, image_width],
+        method=resize_protocol,
+        mask_method=mask_resize_protocol,
+        letterbox=letterbox,
+        central_crop_fraction=central_crop_fraction,
+        normalization=normalization
+    )
     return resize_fn
+
+
+def decode_and_resize_jpeg(contents, labels=None, boxes=None, masks=None,
+                           keypoints=None,
+                           size=None,
+                           method=tf.image.ResizeMethod.BILINEAR,
+                           mask_method=tf.image.ResizeMethod.NEAREST_NEIGHBOR,
+                           letterbox=False,
+                           central_crop_fraction=1.0,
+                           channels=3,
+                           normalization=None):
+    # Takes a scalar JPEG string, or a [batch] of them without boxes, masks
+    # or keypoints. libjpeg can scale by 1/2, 1/4 or 1/8 in the DCT domain
+    # while decoding, which skips most of the work of decoding full
+    # resolution pixels only for the resize to throw them away. The largest
+    # ratio that still leaves at least the target size decodes the central
+    # crop and resize_examples finishes the resize. Annotations of the full
+    # image are cropped along.
+    if contents.shape.rank == 1:
+        if boxes is not None or masks is not None or keypoints is not None:
+            raise ValueError('Batched JPEGs take no boxes, masks or '
+                             'keypoints, decode them per example.')
+        images = tf.map_fn(
+            lambda contents: decode_and_resize_jpeg(
+                contents,
+                size=size,
+                method=method,
+                letterbox=letterbox,
+                central_crop_fraction=central_crop_fraction,
+                channels=channels,
+                normalization=normalization)[0],
+            contents,
+            fn_output_signature=(tf.float32 if normalization is None
+                                 else normalization[2]))
+        return images, labels, None, None
+    jpeg_shape = tf.image.extract_jpeg_shape(contents)
+    height = jpeg_shape[0]
+    width = jpeg_shape[1]
+    crop_height = tf.maximum(tf.cast(
+        central_crop_fraction * tf.cast(height, tf.float64), tf.int32), 1)
+    crop_width = tf.maximum(tf.cast(
+        central_crop_fraction * tf.cast(width, tf.float64), tf.int32), 1)
+    crop_window = tf.stack([(height - crop_height) // 2,
+                            (width - crop_width) // 2,
+                            crop_height,
+                            crop_width])
+    ratios = (1, 2, 4, 8)
+    ratio_index = tf.reduce_sum(tf.cast(tf.logical_and(
+        crop_height >= tf.constant(ratios[1:]) * size[0],
+        crop_width >= tf.constant(ratios[1:]) * size[1]), tf.int32))
+
+    def decode(ratio):
+        # The crop window of a downscaled decode is in downscaled pixels.
+        return tf.image.decode_and_crop_jpeg(
+            contents,
+            crop_window=tf.maximum(crop_window // ratio, [0, 0, 1, 1]),
+            channels=channels,
+            ratio=ratio)
+
+    images = tf.switch_case(
+        ratio_index,
+        [functools.partial(decode, ratio) for ratio in ratios])
+
+    if central_crop_fraction < 1.0:
+        image_size = tf.cast(tf.stack([height, width]), tf.float32)
+        crop_size = tf.cast(crop_window[2:], tf.float32)
+        boxes, masks, keypoints = _transform_annotations(
+            boxes, masks, keypoints,
+            scale=image_size / crop_size,
+            offset=-tf.cast(crop_window[:2], tf.float32) / crop_size)
+        if boxes is not None:
+            boxes = tf.clip_by_value(boxes, 0.0, 1.0)
+        if masks is not None and not isinstance(masks, tf.RaggedTensor):
+            masks = masks[:,
+                          crop_window[0]:crop_window[0] + crop_window[2],
+                          crop_window[1]:crop_window[1] + crop_window[3]]
+    return resize_examples(images, labels, boxes, masks, keypoints,
+                           size=size,
+                           method=method,
+                           mask_method=mask_method,
+                           letterbox=letterbox,
+                           uint8_images=True,
+                           normalization=normalization)
+
+
+def resize_uint8_images(images, size, method):
+    # tf.image.resize already produces float32 for every method but nearest
+    # neighbour, so scaling to [0, 1] costs one pass over the resized, not the
+    # full resolution, images.
+    if images.dtype != tf.uint8:
+        raise ValueError('Expected uint8 images, got {}.'.format(images.dtype))
+    resized_images = tf.image.resize(images, size=size, method=method)
+    if resized_images.dtype == tf.uint8:
+        return tf.image.convert_image_dtype(resized_images, tf.float32)
+    return resized_images * (1.0 / 255.0)
@@ -0,0 +1,223 @@
+import multiprocessing
+import resource
+import time
+
+import tensorflow as tf
+from google.protobuf import text_format
+
+BATCH_SIZE = 256
+SOURCE_SIZE = 320
+TARGET_SIZE = 224
+NUM_ITERS = 10
+NUM_INSTANCES = 64
+
+PREPROCESSING_TXT = """
+image_height : {target_size}
+image_width : {target_size}
+resize_protocol : BILINEAR
+uint8_images : {uint8_images}
+augmentations{{
+    augment_method{{
+        random_horizontal_flip{{
+            per_example : true
+        }}
+    }}
+    augment_method{{
+        random_gray_scale{{
+            keep_channels : true
+            per_example : true
+        }}
+    }}
+}}
+"""
+
+
+def _measure(uint8_images):
+    # Runs in a fresh process so ru_maxrss reflects only this configuration.
+    from builders.preprocessing_builder import build_preprocessing
+    from protos import preprocessing_pb2
+
+    msg = preprocessing_pb2.PreProcessing()
+    text_format.Merge(PREPROCESSING_TXT.format(
+        target_size=TARGET_SIZE,
+        uint8_images='true' if uint8_images else 'false'), msg)
+    resize_fn, augmentation_fn = build_preprocessing(msg)
+
+    @tf.function
+    def preprocess(images):
+        if not uint8_images:
+            images = tf.image.convert_image_dtype(images, tf.float32)
+        images = augmentation_fn((images, None, None, None))[0]
+        return resize_fn(images)[0]
+
+    images = tf.cast(
+        tf.random.uniform([BATCH_SIZE, SOURCE_SIZE, SOURCE_SIZE, 3],
+                          maxval=256, dtype=tf.int32),
+        tf.uint8)
+    preprocess(images).numpy()
+    start = time.time()
+    for _ in range(NUM_ITERS):
+        outputs = preprocess(images)
+    outputs.numpy()
+    wall_time = (time.time() - start) / NUM_ITERS
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return wall_time, peak_memory_mb
+
+
+def _measure_jpeg(decode_jpeg):
+    from builders.preprocessing_builder import build_preprocessing
+    from protos import preprocessing_pb2
+
+    msg = preprocessing_pb2.PreProcessing()
+    text_format.Merge(
+        'image_height : {0} image_width : {0} resize_protocol : BILINEAR '
+        'uint8_images : true decode_jpeg : {1}'.format(
+            TARGET_SIZE, 'true' if decode_jpeg else 'false'), msg)
+    resize_fn, _ = build_preprocessing(msg)
+
+    def decode_and_resize_fn(contents):
+        if not decode_jpeg:
+            contents = tf.io.decode_jpeg(contents, channels=3)
+        return resize_fn(contents)[0]
+
+    @tf.function
+    def preprocess(contents):
+        return tf.map_fn(decode_and_resize_fn, contents,
+                         fn_output_signature=tf.float32)
+
+    # Smooth content compresses like a photograph; uniform noise would make
+    # the entropy decoding, which no downscaling avoids, dominate.
+    image = tf.cast(tf.image.resize(
+        tf.random.uniform([32, 32, 3], maxval=255.0),
+        [4 * SOURCE_SIZE, 4 * SOURCE_SIZE]), tf.uint8)
+    contents = tf.fill([BATCH_SIZE // 8], tf.io.encode_jpeg(image))
+    preprocess(contents).numpy()
+    start = time.time()
+    for _ in range(NUM_ITERS):
+        outputs = preprocess(contents)
+    outputs.numpy()
+    wall_time = (time.time() - start) / NUM_ITERS
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return wall_time, peak_memory_mb
+
+
+def _measure_masks(batched_masks):
+    from builders.preprocessing_builder import build_preprocessing
+    from protos import preprocessing_pb2
+
+    msg = preprocessing_pb2.PreProcessing()
+    text_format.Merge(
+        'image_height : {0} image_width : {0} resize_protocol : BILINEAR '
+        'mask_resize_protocol : AREA'.format(TARGET_SIZE), msg)
+    resize_fn, _ = build_preprocessing(msg)
+
+    @tf.function
+    def preprocess(images, masks):
+        if batched_masks:
+            return resize_fn(images, masks=masks)[3]
+        # One resize per instance, as when masks are resized like images.
+        return tf.map_fn(
+            lambda mask: tf.image.resize(mask[..., tf.newaxis],
+                                         [TARGET_SIZE, TARGET_SIZE],
+                                         method='area')[..., 0],
+            masks)
+
+    images = tf.random.uniform([SOURCE_SIZE, SOURCE_SIZE, 3])
+    masks = tf.cast(tf.random.uniform([NUM_INSTANCES, SOURCE_SIZE,
+                                       SOURCE_SIZE]) > 0.5, tf.float32)
+    preprocess(images, masks).numpy()
+    start = time.time()
+    for _ in range(NUM_ITERS):
+        outputs = preprocess(images, masks)
+    outputs.numpy()
+    wall_time = (time.time() - start) / NUM_ITERS
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return wall_time, peak_memory_mb
+
+
+def _measure_normalization(fused):
+    from builders.preprocessing_builder import build_preprocessing
+    from protos import preprocessing_pb2
+
+    msg = preprocessing_pb2.PreProcessing()
+    text_format.Merge(
+        'image_height : {0} image_width : {0} resize_protocol : BILINEAR '
+        'uint8_images : true'.format(TARGET_SIZE), msg)
+    if fused:
+        text_format.Merge('mean : [0.485, 0.456, 0.406] '
+                          'stddev : [0.229, 0.224, 0.225] '
+                          'image_dtype : BFLOAT16', msg)
+    resize_fn, _ = build_preprocessing(msg)
+
+    @tf.function
+    def preprocess(images):
+        images = resize_fn(images)[0]
+        if fused:
+            return images
+        # The separate pass pipelines otherwise add after the resize.
+        images = (images - [0.485, 0.456, 0.406]) / [0.229, 0.224, 0.225]
+        return tf.cast(images, tf.bfloat16)
+
+    images = tf.cast(
+        tf.random.uniform([BATCH_SIZE, SOURCE_SIZE, SOURCE_SIZE, 3],
+                          maxval=256, dtype=tf.int32),
+        tf.uint8)
+    preprocess(images).numpy()
+    start = time.time()
+    for _ in range(NUM_ITERS):
+        outputs = preprocess(images)
+    outputs.numpy()
+    wall_time = (time.time() - start) / NUM_ITERS
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return wall_time, peak_memory_mb
+
+
+class PreprocessingBuilderBenchmark(tf.test.Benchmark):
+    def _run(self, name, uint8_images, measure_fn=_measure,
+             batch_size=BATCH_SIZE):
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1) as pool:
+            wall_time, peak_memory_mb = pool.apply(measure_fn, (uint8_images,))
+        self.report_benchmark(
+            name=name,
+            iters=NUM_ITERS,
+            wall_time=wall_time,
+            extras={
+                'images_per_sec': batch_size / wall_time,
+                'peak_host_memory_mb': peak_memory_mb
+            }
+        )
+
+    def benchmark_float32_augmentations(self):
+        self._run('float32_augmentations', uint8_images=False)
+
+    def benchmark_uint8_augmentations(self):
+        self._run('uint8_augmentations', uint8_images=True)
+
+    def benchmark_decode_then_resize_jpeg(self):
+        self._run('decode_then_resize_jpeg', False, measure_fn=_measure_jpeg,
+                  batch_size=BATCH_SIZE // 8)
+
+    def benchmark_fused_decode_resize_jpeg(self):
+        self._run('fused_decode_resize_jpeg', True, measure_fn=_measure_jpeg,
+                  batch_size=BATCH_SIZE // 8)
+
+    def benchmark_per_instance_mask_resize(self):
+        self._run('per_instance_mask_resize', False,
+                  measure_fn=_measure_masks, batch_size=1)
+
+    def benchmark_batched_mask_resize(self):
+        self._run('batched_mask_resize', True, measure_fn=_measure_masks,
+                  batch_size=1)
+
+    def benchmark_separate_normalization(self):
+        self._run('separate_normalization', False,
+                  measure_fn=_measure_normalization)
+
+    def benchmark_fused_normalization(self):
+        self._run('fused_normalization', True,
+                  measure_fn=_measure_normalization)
+
+
+if __name__ == "__main__":
+    tf.test.main()
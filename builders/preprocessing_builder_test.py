@@ -0,0 +1,302 @@
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.preprocessing_builder import (build_preprocessing,
+                                            build_resizing_phase_end)
+from protos import preprocessing_pb2
+
+
+class PreprocessingBuildTest(tf.test.TestCase):
+    def test_uint8_images(self):
+        proto_txt = """
+        image_height : 4
+        image_width : 6
+        resize_protocol : BILINEAR
+        uint8_images : true
+        augmentations{
+            augment_method{
+                random_horizontal_flip{
+                    per_example : true
+                }
+            }
+        }
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, augmentation_fn = build_preprocessing(msg)
+        images = tf.cast(tf.random.uniform([2, 8, 12, 3], maxval=256,
+                                           dtype=tf.int32), tf.uint8)
+        augmented = augmentation_fn((images, None, None, None))
+        self.assertEqual(augmented[0].dtype, tf.uint8)
+        resized_images = resize_fn(*augmented)[0]
+        self.assertEqual(resized_images.dtype, tf.float32)
+        self.assertEqual(resized_images.shape, [2, 4, 6, 3])
+        self.assertAllInRange(resized_images, 0.0, 1.0)
+
+    def test_uint8_images_nearest_neighbor(self):
+        proto_txt = """
+        image_height : 1
+        image_width : 1
+        resize_protocol : NEAREST_NEIGHBOR
+        uint8_images : true
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, _ = build_preprocessing(msg)
+        images = tf.fill([1, 2, 2, 3], tf.constant(255, tf.uint8))
+        self.assertAllClose(resize_fn(images)[0], tf.ones([1, 1, 1, 3]))
+
+    def test_defer_geometric_augmentations(self):
+        proto_txt = """
+        image_height : 2
+        image_width : 3
+        resize_protocol : BILINEAR
+        defer_geometric_augmentations : true
+        augmentations{
+            augment_method{
+                random_horizontal_flip{
+                    flip_probability : 1.0
+                }
+            }
+        }
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, augmentation_fn = build_preprocessing(msg)
+        self.assertIsNone(resize_fn)
+        images = tf.random.uniform([1, 4, 6, 3])
+        augmented = augmentation_fn((images, None, None, None))
+        self.assertEqual(augmented[0].shape, [1, 2, 3, 3])
+
+    def test_decode_jpeg(self):
+        proto_txt = """
+        image_height : 8
+        image_width : 6
+        resize_protocol : BILINEAR
+        decode_jpeg : true
+        central_crop_fraction : 0.5
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, _ = build_preprocessing(msg)
+        # A horizontal ramp, so any crop or scaling error shows in the means.
+        ramp = tf.cast(tf.linspace(0.0, 255.0, 200), tf.uint8)
+        image = tf.tile(ramp[tf.newaxis, :, tf.newaxis], [160, 1, 3])
+        contents = tf.io.encode_jpeg(image, quality=100)
+        expected = tf.image.resize(
+            tf.image.convert_image_dtype(image[40:120, 50:150], tf.float32),
+            [8, 6])
+        for contents in (contents, tf.stack([contents, contents])):
+            decoded = tf.reshape(resize_fn(contents)[0], [-1, 8, 6, 3])
+            for image in decoded:
+                self.assertAllClose(tf.reduce_mean(image, axis=[0, 2]),
+                                    tf.reduce_mean(expected, axis=[0, 2]),
+                                    atol=0.03)
+
+    def test_aspect_ratio_buckets(self):
+        proto_txt = """
+        image_height : 24
+        image_width : 24
+        resize_protocol : BILINEAR
+        aspect_ratio_buckets{
+            aspect_ratios : 0.5
+            aspect_ratios : 1.0
+            aspect_ratios : 2.0
+        }
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, _ = build_preprocessing(msg)
+        images = tf.ones([30, 100, 3])
+        boxes = tf.constant([[0.0, 0.0, 1.0, 1.0]])
+        masks = tf.ones([1, 30, 100], tf.bool)
+        resized_images, _, resized_boxes, resized_masks = resize_fn(
+            images, boxes=boxes, masks=masks)
+        # 30x100 goes to the 2:1 bucket of 16x32 as a 10x32 image.
+        self.assertEqual(resized_images.shape, [16, 32, 3])
+        self.assertAllClose(resized_images[:10], tf.ones([10, 32, 3]))
+        self.assertAllClose(resized_images[10:], tf.zeros([6, 32, 3]))
+        self.assertAllClose(resized_boxes, [[0.0, 0.0, 0.625, 1.0]])
+        self.assertAllEqual(resized_masks[0, :, 0],
+                            [True] * 10 + [False] * 6)
+
+    def test_masks_resized_together(self):
+        proto_txt = """
+        image_height : 2
+        image_width : 2
+        resize_protocol : BILINEAR
+        mask_resize_protocol : AREA
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, _ = build_preprocessing(msg)
+        images = tf.zeros([2, 4, 4, 3])
+        masks = tf.stack([
+            tf.tile(tf.constant([[1, 1, 0, 0]], tf.uint8), [4, 1]),
+            tf.constant([[1, 1, 1, 1]] * 3 + [[0, 0, 0, 0]], tf.uint8)])
+        boxes = tf.constant([[[0.0, 0.0, 1.0, 0.5],
+                              [0.0, 0.0, 0.75, 1.0]]] * 2)
+        _, _, resized_boxes, resized_masks = resize_fn(
+            images, boxes=boxes, masks=tf.stack([masks, masks]))
+        self.assertEqual(resized_masks.dtype, tf.uint8)
+        self.assertAllEqual(resized_masks[1], [[[1, 0], [1, 0]],
+                                               [[1, 1], [0, 0]]])
+        self.assertAllEqual(resized_boxes, boxes)
+
+    def test_letterbox(self):
+        proto_txt = """
+        image_height : 8
+        image_width : 8
+        resize_protocol : BILINEAR
+        letterbox : true
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, _ = build_preprocessing(msg)
+        images = tf.ones([4, 8, 3])
+        boxes = tf.constant([[0.0, 0.0, 1.0, 1.0], [0.5, 0.5, 1.0, 1.0]])
+        masks = tf.ones([2, 4, 8], tf.bool)
+        keypoints = tf.constant([[[0.5, 0.5]], [[1.0, 0.0]]])
+        resized_images, _, resized_boxes, resized_masks, resized_keypoints = (
+            resize_fn(images, boxes=boxes, masks=masks, keypoints=keypoints))
+        # The 4x8 image fills rows 2 to 6 of the 8x8 output.
+        self.assertAllClose(tf.reduce_mean(resized_images, axis=[1, 2]),
+                            [0.0] * 2 + [1.0] * 4 + [0.0] * 2)
+        self.assertAllEqual(resized_masks[0, :, 0],
+                            [False] * 2 + [True] * 4 + [False] * 2)
+        self.assertAllClose(resized_boxes, [[0.25, 0.0, 0.75, 1.0],
+                                            [0.5, 0.5, 0.75, 1.0]])
+        self.assertAllClose(resized_keypoints, [[[0.5, 0.5]], [[0.75, 0.0]]])
+        polygons = tf.ragged.constant([[[0.0, 0.0], [1.0, 1.0], [1.0, 0.0]]],
+                                      ragged_rank=1)
+        resized_polygons = resize_fn(images, masks=polygons)[3]
+        self.assertAllClose(resized_polygons.flat_values,
+                            [[0.25, 0.0], [0.75, 1.0], [0.75, 0.0]])
+
+    def test_decode_jpeg_crops_boxes(self):
+        proto_txt = """
+        image_height : 4
+        image_width : 4
+        resize_protocol : BILINEAR
+        decode_jpeg : true
+        central_crop_fraction : 0.5
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, _ = build_preprocessing(msg)
+        contents = tf.io.encode_jpeg(tf.zeros([16, 16, 3], tf.uint8))
+        boxes = tf.constant([[0.25, 0.25, 0.5, 1.0]])
+        masks = tf.pad(tf.ones([1, 4, 8], tf.uint8), [[0, 0], [4, 8], [4, 4]])
+        _, _, cropped_boxes, cropped_masks = resize_fn(
+            contents, boxes=boxes, masks=masks)
+        self.assertAllClose(cropped_boxes, [[0.0, 0.0, 0.5, 1.0]])
+        self.assertAllEqual(cropped_masks[0], [[1] * 4] * 2 + [[0] * 4] * 2)
+        with self.assertRaises(ValueError):
+            resize_fn(tf.stack([contents, contents]), boxes=boxes)
+
+    def test_progressive_resizing(self):
+        proto_txt = """
+        resize_protocol : BILINEAR
+        progressive_resizing{
+            boundaries : 10
+            boundaries : 20
+            image_heights : 2
+            image_heights : 4
+            image_heights : 6
+            image_widths : 3
+            image_widths : 5
+            image_widths : 7
+        }
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        images = tf.zeros([1, 8, 8, 3])
+        for step, shape, phase_end in ((0, [2, 3], 10), (10, [2, 3], 10),
+                                       (11, [4, 5], 20), (21, [6, 7], None)):
+            resize_fn, _ = build_preprocessing(msg, step=step)
+            self.assertEqual(resize_fn(images)[0].shape, [1] + shape + [3])
+            self.assertEqual(build_resizing_phase_end(msg, step), phase_end)
+        del msg.progressive_resizing.image_widths[-1]
+        with self.assertRaises(ValueError):
+            build_preprocessing(msg)
+
+    def test_normalization(self):
+        proto_txt = """
+        image_height : 2
+        image_width : 2
+        resize_protocol : BILINEAR
+        uint8_images : true
+        mean : [0.5, 0.25, 0.0]
+        stddev : [0.5, 0.25, 1.0]
+        image_dtype : BFLOAT16
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, _ = build_preprocessing(msg)
+        images = tf.fill([1, 4, 4, 3], tf.constant(255, tf.uint8))
+        normalized_images = resize_fn(images)[0]
+        self.assertEqual(normalized_images.dtype, tf.bfloat16)
+        self.assertAllClose(tf.cast(normalized_images, tf.float32),
+                            tf.tile([[[[1.0, 3.0, 1.0]]]], [1, 2, 2, 1]))
+        del msg.stddev[-1]
+        with self.assertRaises(ValueError):
+            build_preprocessing(msg)
+
+    def test_normalization_after_augmentations(self):
+        proto_txt = """
+        image_height : 4
+        image_width : 4
+        resize_protocol : BILINEAR
+        decode_jpeg : true
+        mean : 0.5
+        augmentations{
+            augment_method{
+                random_color_jitter{
+                    max_brightness_delta : 0.0
+                }
+            }
+        }
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        resize_fn, augmentation_fn = build_preprocessing(msg)
+        contents = tf.io.encode_jpeg(tf.zeros([8, 8, 3], tf.uint8))
+        resized = resize_fn(contents)
+        self.assertAllClose(resized[0], tf.zeros([4, 4, 3]))
+        self.assertAllClose(augmentation_fn(resized)[0],
+                            tf.fill([4, 4, 3], -0.5))
+
+    def test_normalization_without_resize(self):
+        proto_txt = """
+        uint8_images : true
+        mean : 0.5
+        augmentations{
+            augment_method{
+                random_color_jitter{
+                    max_brightness_delta : 0.0
+                }
+            }
+        }
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        images = tf.fill([1, 4, 4, 3], tf.constant(255, tf.uint8))
+        # Normalization follows the augmentations, which need no target
+        # size.
+        resize_fn, augmentation_fn = build_preprocessing(
+            msg, augment_after_resize=True)
+        self.assertIsNone(resize_fn)
+        self.assertAllClose(augmentation_fn((images, None, None, None))[0],
+                            tf.fill([1, 4, 4, 3], 0.5))
+        msg.ClearField('augmentations')
+        resize_fn, augmentation_fn = build_preprocessing(msg,
+                                                         cached_resize=True)
+        self.assertIsNone(resize_fn)
+        self.assertAllClose(augmentation_fn((images, None, None, None))[0],
+                            tf.fill([1, 4, 4, 3], 0.5))
+        with self.assertRaises(ValueError):
+            build_preprocessing(msg)
+
+
+if __name__ == "__main__":
+    tf.test.main()
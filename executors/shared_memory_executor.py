@@ -0,0 +1,248 @@
+import multiprocessing
+import queue
+import traceback
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+import tensorflow as tf
+from loguru import logger
+
+from builders.preprocessing_builder import build_preprocessing
+from protos import preprocessing_pb2
+
+_ALIGNMENT = 64
+# Seconds between checks that a worker is still alive while waiting for it.
+_POLL_INTERVAL = 5.0
+
+
+class SharedMemoryExecutor(object):
+    # Runs the functions returned by build_preprocessing in a pool of worker
+    # processes, so Python and NumPy work in example_fn is not serialized by
+    # the GIL. Every worker owns num_slots slots of a shared memory ring
+    # buffer and writes whole batches into them, so batches are never
+    # pickled. This is a one-copy transport, not a zero-copy one: the
+    # generator copies every batch out of its slot for tf.data, which would
+    # otherwise alias the slot the worker reuses. Worker w builds the
+    # batches w, w + num_workers, ... in order, which keeps the output order
+    # deterministic.
+    # example_fn(index) returns the (images, labels, boxes, masks) tuple of
+    # an example as NumPy arrays and must be picklable, like a module level
+    # function. output_signature holds one tf.TensorSpec with a fully
+    # defined [batch_size, ...] shape for each leading element of the
+    # preprocessed examples that is batched, usually images and labels.
+    # The slots are shared by all generators, so only one generator, or
+    # iterator over dataset(), can run at a time.
+    # close(), or leaving the executor as a context manager, stops the
+    # workers and unlinks the shared memory. An executor that is garbage
+    # collected or still open at exit is closed as well, so the segment
+    # does not leak in /dev/shm.
+    def __init__(self, preprocessing_proto, example_fn, num_examples,
+                 output_signature, num_workers=None, num_slots=2, step=0):
+        output_signature = tuple(output_signature)
+        if (not output_signature or
+                not all(spec.shape.is_fully_defined()
+                        for spec in output_signature) or
+                len(set(spec.shape[0] for spec in output_signature)) != 1):
+            logger.error('Shared memory slots need fully defined shapes with '
+                         'the same batch size.')
+            raise ValueError('Please see the log message above.')
+        if num_slots <= 0:
+            logger.error('Workers need at least one slot.')
+            raise ValueError('Please see the log message above.')
+        self.output_signature = output_signature
+        self.batch_size = output_signature[0].shape[0]
+        self.num_batches = num_examples // self.batch_size
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.num_slots = num_slots
+        self.epoch = 0
+        self._running = False
+        self._specs = [(spec.shape.as_list(), spec.dtype.as_numpy_dtype)
+                       for spec in output_signature]
+        self._slot_offsets, slot_size = _slot_layout(self._specs)
+        self._slot_size = slot_size
+        num_buffers = self.num_workers * num_slots
+        logger.debug('Starting {} preprocessing workers with {} MB of shared '
+                     'memory.'.format(self.num_workers,
+                                      num_buffers * slot_size / 2 ** 20))
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=num_buffers * slot_size)
+        context = multiprocessing.get_context('spawn')
+        self._tasks = [context.Queue() for _ in range(self.num_workers)]
+        self._results = [context.Queue() for _ in range(self.num_workers)]
+        self._pending = [0] * self.num_workers
+        self._workers = list()
+        # Holds no reference to self, so it can run when self is collected.
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self._tasks, self._workers, self._shm)
+        self._workers.extend(
+            context.Process(
+                target=_run_worker,
+                args=(preprocessing_proto.SerializeToString(), step,
+                      example_fn, self.batch_size, self._specs,
+                      self._shm.name, self._slot_offsets, slot_size,
+                      self._tasks[worker], self._results[worker]),
+                daemon=True)
+            for worker in range(self.num_workers))
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def generator(self):
+        # Yields tuples of NumPy arrays copied out of the ring buffer; the
+        # slot then goes straight back to its worker.
+        if self._running:
+            logger.error('Only one generator of a SharedMemoryExecutor can '
+                         'run at a time.')
+            raise ValueError('Please see the log message above.')
+        self._running = True
+        epoch = self.epoch
+        self.epoch += 1
+        try:
+            self._drain()
+            num_buffers = self.num_workers * self.num_slots
+            for batch_index in range(min(num_buffers, self.num_batches)):
+                self._submit(batch_index, batch_index % num_buffers, epoch)
+            for batch_index in range(self.num_batches):
+                worker = batch_index % self.num_workers
+                result_index, slot, error = self._get_result(worker)
+                if error is not None:
+                    raise RuntimeError(
+                        'Preprocessing worker {} failed:\n{}'.format(
+                            worker, error))
+                views = _slot_views(self._shm.buf, slot * self._slot_size,
+                                    self._specs, self._slot_offsets)
+                batch = tuple(np.array(view) for view in views)
+                del views
+                next_index = result_index + num_buffers
+                if next_index < self.num_batches:
+                    self._submit(next_index, slot, epoch)
+                yield batch
+        finally:
+            self._drain()
+            self._running = False
+
+    def dataset(self):
+        return tf.data.Dataset.from_generator(
+            self.generator, output_signature=self.output_signature)
+
+    def close(self):
+        self._finalizer()
+
+    def _submit(self, batch_index, slot, epoch):
+        worker = batch_index % self.num_workers
+        self._tasks[worker].put((batch_index, slot, epoch))
+        self._pending[worker] += 1
+
+    def _get_result(self, worker):
+        # A worker killed by the OS, e.g. out of memory, never reports back,
+        # so the queue is polled and the worker checked between polls.
+        while True:
+            try:
+                result = self._results[worker].get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                if not self._workers[worker].is_alive():
+                    self._pending[worker] = 0
+                    raise RuntimeError(
+                        'Preprocessing worker {} exited with code {}.'.format(
+                            worker, self._workers[worker].exitcode))
+                continue
+            self._pending[worker] -= 1
+            return result
+
+    def _drain(self):
+        # Discards batches still in flight when a generator is closed early,
+        # so the next epoch starts from empty queues. Dead workers are left
+        # to the next generator, which raises on them.
+        for worker in range(self.num_workers):
+            while self._pending[worker] > 0:
+                try:
+                    self._get_result(worker)
+                except RuntimeError:
+                    break
+
+
+def _shutdown(tasks, workers, shm):
+    for worker_tasks in tasks:
+        worker_tasks.put(None)
+    for worker in workers:
+        worker.join(timeout=10)
+        if worker.is_alive():
+            worker.terminate()
+    del workers[:]
+    shm.close()
+    shm.unlink()
+
+
+def _slot_layout(specs):
+    offsets = list()
+    size = 0
+    for shape, dtype in specs:
+        offsets.append(size)
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        size += -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+    return offsets, size
+
+
+def _slot_views(buffer, slot_offset, specs, offsets):
+    return [np.ndarray(shape, dtype=dtype, buffer=buffer,
+                       offset=slot_offset + offset)
+            for (shape, dtype), offset in zip(specs, offsets)]
+
+
+def _run_worker(preprocessing_bytes, step, example_fn, batch_size, specs,
+                shm_name, slot_offsets, slot_size, tasks, results):
+    # Every worker runs single threaded ops, parallelism comes from the
+    # number of workers.
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    preprocessing_proto = preprocessing_pb2.PreProcessing.FromString(
+        preprocessing_bytes)
+    decode_jpeg = preprocessing_proto.decode_jpeg
+    resize_fn, augmentation_fn = build_preprocessing(
+        preprocessing_proto, step, augment_after_resize=decode_jpeg)
+    seeded = preprocessing_proto.augmentations.HasField('seed')
+
+    @tf.function(reduce_retracing=True)
+    def preprocess(x, example_id, epoch):
+        if decode_jpeg and resize_fn is not None:
+            x = resize_fn(*x)
+        if seeded:
+            x = augmentation_fn(x, example_id, epoch)
+        else:
+            x = augmentation_fn(x)
+        if not decode_jpeg and resize_fn is not None:
+            x = resize_fn(*x)
+        return x[:len(specs)]
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            batch_index, slot, epoch = task
+            try:
+                views = _slot_views(shm.buf, slot * slot_size, specs,
+                                    slot_offsets)
+                for index in range(batch_size):
+                    example_id = batch_index * batch_size + index
+                    example = preprocess(
+                        tuple(None if value is None
+                              else tf.convert_to_tensor(value)
+                              for value in example_fn(example_id)),
+                        tf.constant(example_id, tf.int64),
+                        tf.constant(epoch, tf.int64))
+                    for view, value in zip(views, example):
+                        view[index] = value.numpy()
+                del views
+                results.put((batch_index, slot, None))
+            except Exception:
+                results.put((batch_index, slot, traceback.format_exc()))
+    finally:
+        shm.close()
@@ -0,0 +1,116 @@
+import multiprocessing
+import time
+
+import numpy as np
+import tensorflow as tf
+from google.protobuf import text_format
+
+from builders.preprocessing_builder import build_preprocessing
+from executors.shared_memory_executor import SharedMemoryExecutor
+from protos import preprocessing_pb2
+
+BATCH_SIZE = 32
+NUM_BATCHES = 16
+SOURCE_SIZE = 320
+TARGET_SIZE = 224
+
+PREPROCESSING_TXT = """
+image_height : {0}
+image_width : {0}
+resize_protocol : BILINEAR
+uint8_images : true
+mean : [0.485, 0.456, 0.406]
+stddev : [0.229, 0.224, 0.225]
+image_dtype : BFLOAT16
+augmentations{{
+    augment_method{{
+        random_horizontal_flip{{
+        }}
+    }}
+}}
+""".format(TARGET_SIZE)
+
+
+def _example(index):
+    # NumPy work that holds the GIL for most of its time, like hand written
+    # decoders and augmentations.
+    rng = np.random.default_rng(index)
+    images = rng.integers(0, 256, [SOURCE_SIZE, SOURCE_SIZE, 3], np.uint8)
+    for _ in range(4):
+        images = np.sort(images, axis=int(rng.integers(0, 2)))
+    labels = np.eye(10, dtype=np.float32)[index % 10]
+    return images, labels, None, None
+
+
+def _output_signature():
+    return (tf.TensorSpec([BATCH_SIZE, TARGET_SIZE, TARGET_SIZE, 3],
+                          tf.bfloat16),
+            tf.TensorSpec([BATCH_SIZE, 10], tf.float32))
+
+
+class SharedMemoryExecutorBenchmark(tf.test.Benchmark):
+    def _run(self, name, dataset, num_workers):
+        # The first batch pays for worker start up and tracing and is not
+        # timed.
+        iterator = iter(dataset)
+        next(iterator)
+        num_batches = 0
+        start = time.time()
+        for _ in iterator:
+            num_batches += 1
+        wall_time = (time.time() - start) / num_batches
+        self.report_benchmark(
+            name=name,
+            iters=num_batches,
+            wall_time=wall_time,
+            extras={'images_per_sec': BATCH_SIZE / wall_time,
+                    'num_workers': num_workers,
+                    'num_cpus': multiprocessing.cpu_count()}
+        )
+
+    def benchmark_in_process(self):
+        # The NumPy work runs under the GIL of the training process, however
+        # many parallel calls tf.data makes.
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(PREPROCESSING_TXT, msg)
+        resize_fn, augmentation_fn = build_preprocessing(msg)
+
+        def load(index):
+            images, labels, _, _ = _example(int(index))
+            return images, labels
+
+        dataset = tf.data.Dataset.range(BATCH_SIZE * NUM_BATCHES).map(
+            lambda index: tf.numpy_function(load, [index],
+                                            [tf.uint8, tf.float32]),
+            num_parallel_calls=tf.data.AUTOTUNE)
+        dataset = dataset.map(
+            lambda images, labels: resize_fn(*augmentation_fn(
+                (tf.ensure_shape(images, [SOURCE_SIZE, SOURCE_SIZE, 3]),
+                 labels, None, None)))[:2],
+            num_parallel_calls=tf.data.AUTOTUNE)
+        self._run('in_process',
+                  dataset.batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE), 0)
+
+    def _run_executor(self, num_workers):
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(PREPROCESSING_TXT, msg)
+        with SharedMemoryExecutor(msg, _example,
+                                  num_examples=BATCH_SIZE * NUM_BATCHES,
+                                  output_signature=_output_signature(),
+                                  num_workers=num_workers) as executor:
+            self._run('shared_memory_{}_workers'.format(num_workers),
+                      executor.dataset().prefetch(tf.data.AUTOTUNE),
+                      num_workers)
+
+    def benchmark_shared_memory_1_worker(self):
+        self._run_executor(1)
+
+    def benchmark_shared_memory_2_workers(self):
+        self._run_executor(2)
+
+    def benchmark_shared_memory_4_workers(self):
+        self._run_executor(4)
+
+
+if __name__ == "__main__":
+    tf.test.main()
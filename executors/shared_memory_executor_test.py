@@ -0,0 +1,119 @@
+import gc
+import os
+from multiprocessing import shared_memory
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+from google.protobuf import text_format
+
+from executors import shared_memory_executor
+from executors.shared_memory_executor import SharedMemoryExecutor
+from protos import preprocessing_pb2
+
+
+def _example(index):
+    # Module level, so spawned workers can unpickle it.
+    images = np.full([6 + index % 3, 8, 3], index, np.uint8)
+    labels = np.eye(4, dtype=np.float32)[index % 4]
+    return images, labels, None, None
+
+
+def _failing_example(index):
+    raise IOError('Cannot read example {}.'.format(index))
+
+
+def _killed_example(index):
+    # Exits like a worker killed by the OS, without reporting back.
+    os._exit(9)
+
+
+class SharedMemoryExecutorTest(tf.test.TestCase):
+    def _msg(self):
+        proto_txt = """
+        image_height : 4
+        image_width : 4
+        resize_protocol : BILINEAR
+        uint8_images : true
+        image_dtype : BFLOAT16
+        augmentations{
+            augment_method{
+                random_horizontal_flip{
+                }
+            }
+        }
+        """
+        msg = preprocessing_pb2.PreProcessing()
+        text_format.Merge(proto_txt, msg)
+        return msg
+
+    def test_batches_in_order(self):
+        output_signature = (tf.TensorSpec([2, 4, 4, 3], tf.bfloat16),
+                            tf.TensorSpec([2, 4], tf.float32))
+        with SharedMemoryExecutor(self._msg(), _example, num_examples=11,
+                                  output_signature=output_signature,
+                                  num_workers=2) as executor:
+            dataset = executor.dataset()
+            for _ in range(2):
+                batches = list(dataset)
+                self.assertLen(batches, 5)
+                images = tf.cast(tf.concat([b[0] for b in batches], 0),
+                                 tf.float32)
+                labels = tf.concat([b[1] for b in batches], 0)
+                self.assertAllClose(tf.reduce_mean(images, axis=[1, 2, 3]),
+                                    np.arange(10) / 255.0, rtol=1e-2)
+                self.assertAllEqual(tf.argmax(labels, -1),
+                                    np.arange(10) % 4)
+            # A generator closed early leaves no batches in flight.
+            self.assertLen(list(dataset.take(1)), 1)
+            self.assertLen(list(dataset), 5)
+
+    def test_worker_errors_are_raised(self):
+        output_signature = (tf.TensorSpec([2, 4, 4, 3], tf.bfloat16),)
+        with SharedMemoryExecutor(self._msg(), _failing_example,
+                                  num_examples=4,
+                                  output_signature=output_signature,
+                                  num_workers=1) as executor:
+            with self.assertRaisesRegex(Exception, 'Cannot read example'):
+                list(executor.generator())
+
+    def test_dead_workers_are_raised(self):
+        output_signature = (tf.TensorSpec([2, 4, 4, 3], tf.bfloat16),)
+        with mock.patch.object(shared_memory_executor, '_POLL_INTERVAL',
+                               0.1):
+            with SharedMemoryExecutor(self._msg(), _killed_example,
+                                      num_examples=4,
+                                      output_signature=output_signature,
+                                      num_workers=1) as executor:
+                with self.assertRaisesRegex(RuntimeError, 'exited'):
+                    list(executor.generator())
+
+    def test_one_generator_at_a_time(self):
+        output_signature = (tf.TensorSpec([2, 4, 4, 3], tf.bfloat16),)
+        with SharedMemoryExecutor(self._msg(), _example, num_examples=8,
+                                  output_signature=output_signature,
+                                  num_workers=1) as executor:
+            first = executor.generator()
+            next(first)
+            with self.assertRaises(ValueError):
+                next(executor.generator())
+            first.close()
+            self.assertLen(list(executor.generator()), 4)
+
+    def test_shared_memory_unlinked_without_close(self):
+        output_signature = (tf.TensorSpec([2, 4, 4, 3], tf.bfloat16),)
+        executor = SharedMemoryExecutor(self._msg(), _example, num_examples=8,
+                                        output_signature=output_signature,
+                                        num_workers=1)
+        name = executor._shm.name
+        with self.assertRaises(RuntimeError):
+            for _ in executor.generator():
+                raise RuntimeError('Training failed.')
+        del executor
+        gc.collect()
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -1,63 +1,288 @@
+import functools
+
 import tensorflow as tf
 
 
 def random_grayscale(images, labels=None, boxes=None, masks=None,
                      keypoints=None,
-                     gray_probability=0.5):
-    if keypoints is not None:
-        raise NotImplementedError('Currently keypoints are not supported.')
-    do_gray = tf.random.uniform(shape=(), name='do_gray')
+                     gray_probability=0.5,
+                     keep_channels=False,
+                     per_example=False,
+                     seed=None):
+    if per_example and not keep_channels:
+        raise ValueError('Per example graying requires keep_channels, as '
+                         'grayed and untouched images must share a shape.')
+    if per_example:
+        with tf.name_scope('Per_example_grayscale'):
+            do_gray = _per_example_decisions(images=images,
+                                             probability=gray_probability,
+                                             seed=seed,
+                                             name='do_gray')
+            grayed_images = _select_per_example(
+                do_gray, _to_grayscale(images, keep_channels=True), images)
+        return _outputs(grayed_images, labels, boxes, masks, keypoints)
+
+    do_gray = _random_uniform(shape=(), seed=seed, name='do_gray')
 
     def perform_graying():
-        grayed_images = tf.image.rgb_to_grayscale(images=images,
-                                                  name='to_grayscale')
-        return grayed_images, labels, boxes, masks
+        return grayscale(images, labels, boxes, masks, keypoints,
+                         keep_channels=keep_channels)
 
     def no_graying():
         with tf.name_scope('No_graying'):
-            return images, labels, boxes, masks
+            return _outputs(images, labels, boxes, masks, keypoints)
 
-    grayed_images, labels, boxes, masks = tf.cond(
+    return tf.cond(
         tf.greater(do_gray, 1.0 - gray_probability),
         lambda: perform_graying(),
         lambda: no_graying()
     )
 
-    return grayed_images, labels, boxes, masks
+
+def grayscale(images, labels=None, boxes=None, masks=None, keypoints=None,
+              keep_channels=False):
+    grayed_images = _to_grayscale(images, keep_channels=keep_channels)
+    return _outputs(grayed_images, labels, boxes, masks, keypoints)
+
+
+def _to_grayscale(images, keep_channels):
+    grayed_images = tf.image.rgb_to_grayscale(images=images,
+                                              name='to_grayscale')
+    if keep_channels:
+        grayed_images = tf.image.grayscale_to_rgb(images=grayed_images,
+                                                  name='to_rgb')
+    return grayed_images
+
+
+def random_color_jitter(images, labels=None, boxes=None, masks=None,
+                        keypoints=None,
+                        max_brightness_delta=0.0,
+                        min_contrast=1.0,
+                        max_contrast=1.0,
+                        min_saturation=1.0,
+                        max_saturation=1.0,
+                        max_hue_delta=0.0,
+                        jitter_probability=1.0,
+                        seed=None):
+    # Accepts a single RGB image or a batch, of any dtype accepted by
+    # tf.image.convert_image_dtype. Adjustments are drawn per example and
+    # examples that are not jittered get identity adjustments.
+    batched = images.shape.rank == 4
+    if not batched:
+        images = images[tf.newaxis]
+    with tf.name_scope('Random_color_jitter'):
+        batch_size = tf.shape(images)[0]
+        seeds = _split_seed(seed, num=5)
+        do_jitter = _per_example_decisions(images=images,
+                                           probability=jitter_probability,
+                                           seed=seeds[0],
+                                           name='do_jitter')
+        brightness = _random_uniform([batch_size],
+                                     minval=-max_brightness_delta,
+                                     maxval=max_brightness_delta,
+                                     seed=seeds[1],
+                                     name='brightness')
+        contrast = _random_uniform([batch_size], minval=min_contrast,
+                                   maxval=max_contrast, seed=seeds[2],
+                                   name='contrast')
+        saturation = _random_uniform([batch_size], minval=min_saturation,
+                                     maxval=max_saturation, seed=seeds[3],
+                                     name='saturation')
+        hue = _random_uniform([batch_size], minval=-max_hue_delta,
+                              maxval=max_hue_delta, seed=seeds[4],
+                              name='hue')
+        jittered_images = _color_jitter(
+            images=images,
+            brightness=tf.where(do_jitter, brightness, 0.0),
+            contrast=tf.where(do_jitter, contrast, 1.0),
+            saturation=tf.where(do_jitter, saturation, 1.0),
+            hue=tf.where(do_jitter, hue, 0.0),
+            adjust_hsv=(min_saturation != 1.0 or max_saturation != 1.0 or
+                        max_hue_delta != 0.0)
+        )
+    if not batched:
+        jittered_images = jittered_images[0]
+    return _outputs(jittered_images, labels, boxes, masks, keypoints)
+
+
+def _color_jitter(images, brightness, contrast, saturation, hue, adjust_hsv):
+    # Brightness followed by contrast around the per channel mean is a single
+    # multiply-add per pixel:
+    #   c * (x + b - mean(x + b)) + mean(x + b) = c * x + (1 - c) * mean(x) + b
+    # Saturation and hue share one RGB<->HSV round trip, skipped entirely
+    # when adjust_hsv is False. Compiled with the augmentation chain, XLA
+    # fuses all of it into one loop over the pixels.
+    dtype = images.dtype
+    images = tf.image.convert_image_dtype(images, tf.float32)
+    contrast = contrast[:, tf.newaxis, tf.newaxis, tf.newaxis]
+    offset = ((1.0 - contrast) *
+              tf.reduce_mean(images, axis=[1, 2], keepdims=True) +
+              brightness[:, tf.newaxis, tf.newaxis, tf.newaxis])
+    images = tf.clip_by_value(contrast * images + offset, 0.0, 1.0)
+    if adjust_hsv:
+        hsv_images = tf.image.rgb_to_hsv(images)
+        hue_channel, saturation_channel, value_channel = tf.unstack(
+            hsv_images, num=3, axis=-1)
+        hue_channel = tf.math.floormod(
+            hue_channel + hue[:, tf.newaxis, tf.newaxis], 1.0)
+        saturation_channel = tf.clip_by_value(
+            saturation_channel * saturation[:, tf.newaxis, tf.newaxis],
+            0.0, 1.0)
+        images = tf.image.hsv_to_rgb(tf.stack(
+            [hue_channel, saturation_channel, value_channel], axis=-1))
+    return tf.image.convert_image_dtype(images, dtype, saturate=True)
 
 
 def random_horizontal_flip(images, labels=None, boxes=None, masks=None,
                            keypoints=None,
-                           flip_probability=0.5):
-    if keypoints is not None:
-        raise NotImplementedError('Currently keypoints are not supported.')
-    do_flip = tf.random.uniform(shape=(), name='do_flip')
+                           flip_probability=0.5,
+                           per_example=False,
+                           seed=None):
+    if per_example:
+        return _random_horizontal_flip_per_example(
+            images=images,
+            labels=labels,
+            boxes=boxes,
+            masks=masks,
+            keypoints=keypoints,
+            flip_probability=flip_probability,
+            seed=seed
+        )
+    do_flip = _random_uniform(shape=(), seed=seed, name='do_flip')
 
     def perform_flip():
-        with tf.name_scope('Horizontal_flip'):
-            with tf.name_scope('image'):
-                flipped_images = tf.image.flip_left_right(image=images)
-            with tf.name_scope('boxes'):
-                flipped_boxes = _flip_boxes_left_right(boxes=boxes)
-            with tf.name_scope('masks'):
-                flipped_masks = _flip_masks_left_right(masks=masks)
-        return flipped_images, labels, flipped_boxes, flipped_masks
+        return horizontal_flip(images, labels, boxes, masks, keypoints)
 
     def no_flip():
         with tf.name_scope('No_flip'):
-            return images, labels, boxes, masks
+            return _outputs(images, labels, boxes, masks, keypoints)
 
-    flipped_images, labels, flipped_boxes, flipped_masks = tf.cond(
+    return tf.cond(
         tf.greater(do_flip, 1.0 - flip_probability, name='test_if_do_flip'),
         lambda: perform_flip(),
         lambda: no_flip()
     )
-    return flipped_images, labels, flipped_boxes, flipped_masks
+
+
+def horizontal_flip(images, labels=None, boxes=None, masks=None,
+                    keypoints=None):
+    with tf.name_scope('Horizontal_flip'):
+        with tf.name_scope('image'):
+            flipped_images = tf.image.flip_left_right(image=images)
+        with tf.name_scope('boxes'):
+            flipped_boxes = _flip_boxes_left_right(boxes=boxes)
+        with tf.name_scope('masks'):
+            flipped_masks = _flip_masks_left_right(masks=masks)
+        with tf.name_scope('keypoints'):
+            flipped_keypoints = _flip_keypoints_left_right(
+                keypoints=keypoints)
+    return _outputs(flipped_images, labels, flipped_boxes, flipped_masks,
+                    flipped_keypoints)
+
+
+def _random_horizontal_flip_per_example(images, labels, boxes, masks,
+                                        keypoints, flip_probability, seed):
+    # Images are [batch, height, width, channels], boxes [batch, N, 4],
+    # masks [batch, N, height, width] and keypoints [batch, N, K, 2]. Boxes
+    # and keypoints may be ragged over N. Both the flipped and the original
+    # tensors are computed and picked per example with a masked select, so
+    # the op stays branch free and can run after `Dataset.batch()`.
+    with tf.name_scope('Per_example_horizontal_flip'):
+        do_flip = _per_example_decisions(images=images,
+                                         probability=flip_probability,
+                                         seed=seed,
+                                         name='do_flip')
+        with tf.name_scope('image'):
+            flipped_images = _select_per_example(
+                do_flip, tf.image.flip_left_right(image=images), images)
+        with tf.name_scope('boxes'):
+            flipped_boxes = None
+            if boxes is not None:
+                flipped_boxes = _select_per_example(
+                    do_flip, _flip_boxes_left_right(boxes=boxes), boxes)
+        with tf.name_scope('masks'):
+            flipped_masks = None
+            if masks is not None:
+                flipped_masks = _select_per_example(
+                    do_flip, _flip_masks_left_right(masks=masks), masks)
+        with tf.name_scope('keypoints'):
+            flipped_keypoints = None
+            if keypoints is not None:
+                flipped_keypoints = _select_per_example(
+                    do_flip, _flip_keypoints_left_right(keypoints=keypoints),
+                    keypoints)
+    return _outputs(flipped_images, labels, flipped_boxes, flipped_masks,
+                    flipped_keypoints)
+
+
+def _outputs(images, labels, boxes, masks, keypoints):
+    # Keypoints are only returned when they were passed in, so chains of
+    # augmentations keep the arity of their inputs.
+    if keypoints is None:
+        return images, labels, boxes, masks
+    return images, labels, boxes, masks, keypoints
+
+
+def _per_example_decisions(images, probability, seed, name):
+    batch_size = tf.shape(images)[0]
+    draws = _random_uniform(shape=[batch_size], seed=seed, name=name)
+    return tf.greater(draws, 1.0 - probability)
+
+
+def _random_uniform(shape, seed, minval=0.0, maxval=1.0, name=None):
+    # A seed of shape [2] makes the draw stateless: it then depends only on
+    # the seed, not on op seeds or on the order in which ops execute.
+    if seed is None:
+        return tf.random.uniform(shape=shape, minval=minval, maxval=maxval,
+                                 name=name)
+    return tf.random.stateless_uniform(shape=shape, seed=seed, minval=minval,
+                                       maxval=maxval, name=name)
+
+
+def _split_seed(seed, num):
+    if seed is None:
+        return [None] * num
+    return tf.unstack(tf.random.experimental.stateless_split(seed, num=num))
+
+
+def _select_per_example(condition, x, y):
+    # Broadcasts a [batch] boolean over the trailing dimensions of x and y.
+    # Ragged x and y must share their row partitions; the select then runs
+    # on the flat values with the decision of the row each value belongs to.
+    if isinstance(x, tf.RaggedTensor):
+        return x.with_flat_values(
+            _select_per_example(
+                tf.gather(condition, _flat_values_batch_index(x)),
+                x.flat_values,
+                y.flat_values
+            )
+        )
+    return tf.where(_broadcastable(condition, x), x, y)
+
+
+def _broadcastable(values, x):
+    # Reshapes [batch] values to broadcast over the trailing dimensions of x.
+    return tf.reshape(
+        values,
+        tf.concat([tf.shape(values), tf.ones([tf.rank(x) - 1], tf.int32)],
+                  axis=0)
+    )
+
+
+def _flat_values_batch_index(ragged):
+    # Index of the outermost row each flat value belongs to.
+    value_rowids = ragged.nested_value_rowids()
+    batch_index = value_rowids[-1]
+    for rowids in reversed(value_rowids[:-1]):
+        batch_index = tf.gather(rowids, batch_index)
+    return batch_index
 
 
 def _flip_boxes_left_right(boxes):
     if boxes is None:
         return None
+    if isinstance(boxes, tf.RaggedTensor):
+        return tf.ragged.map_flat_values(_flip_boxes_left_right, boxes)
     ymin, xmin, ymax, xmax = tf.split(value=boxes,
                                       num_or_size_splits=4,
                                       axis=-1
@@ -79,4 +304,774 @@ def _flip_boxes_left_right(boxes):
 def _flip_masks_left_right(masks):
     if masks is None:
         return None
-    return masks[:, :, ::-1]
+    if isinstance(masks, tf.RaggedTensor):
+        # Polygon masks flip like keypoints.
+        return _flip_keypoints_left_right(keypoints=masks)
+    return masks[..., ::-1]
+
+
+def _flip_keypoints_left_right(keypoints):
+    # Keypoints are normalized [..., 2] (y, x) pairs.
+    if keypoints is None:
+        return None
+    if isinstance(keypoints, tf.RaggedTensor):
+        return tf.ragged.map_flat_values(_flip_keypoints_left_right,
+                                         keypoints)
+    y, x = tf.split(value=keypoints, num_or_size_splits=2, axis=-1)
+    return tf.concat([y, tf.subtract(1.0, x)], axis=-1)
+
+
+def random_affine(images, labels=None, boxes=None, masks=None,
+                  keypoints=None,
+                  flip_probability=0.0,
+                  min_scale=1.0,
+                  max_scale=1.0,
+                  max_translation=0.0,
+                  max_rotation_degrees=0.0,
+                  max_shear_degrees=0.0,
+                  fill_value=0.0,
+                  seed=None,
+                  in_xla=False):
+    # Accepts a single image [height, width, channels] or a batch
+    # [batch, height, width, channels] with boxes [(batch,) N, 4], masks
+    # [(batch,) N, height, width] and keypoints [(batch,) N, K, 2]. Batched
+    # boxes and keypoints may be ragged over N. Masks may also be polygons,
+    # see polygons_to_masks. One transform is drawn per example.
+    # in_xla selects a gather based warp for callers compiled with XLA.
+    batched = images.shape.rank == 4
+    if not batched:
+        images = images[tf.newaxis]
+        boxes = None if boxes is None else boxes[tf.newaxis]
+        masks = None if masks is None else masks[tf.newaxis]
+        keypoints = None if keypoints is None else keypoints[tf.newaxis]
+
+    with tf.name_scope('Random_affine'):
+        images_shape = tf.shape(images)
+        height = tf.cast(images_shape[1], tf.float32)
+        width = tf.cast(images_shape[2], tf.float32)
+        matrices = _random_affine_matrices(
+            batch_size=images_shape[0],
+            height=height,
+            width=width,
+            flip_probability=flip_probability,
+            min_scale=min_scale,
+            max_scale=max_scale,
+            max_translation=max_translation,
+            max_rotation_degrees=max_rotation_degrees,
+            max_shear_degrees=max_shear_degrees,
+            seed=seed
+        )
+        with tf.name_scope('image'):
+            images = _warp_images(images=images,
+                                  matrices=matrices,
+                                  interpolation='BILINEAR',
+                                  fill_value=fill_value,
+                                  in_xla=in_xla)
+        normalized_matrices = _normalized_matrices(matrices=matrices,
+                                                   height=height,
+                                                   width=width)
+        with tf.name_scope('boxes'):
+            boxes = _transform_boxes(boxes=boxes,
+                                     matrices=normalized_matrices)
+        with tf.name_scope('masks'):
+            if isinstance(masks, tf.RaggedTensor):
+                masks = _transform_keypoints(keypoints=masks,
+                                             matrices=normalized_matrices)
+            else:
+                masks = _warp_masks(masks=masks, matrices=matrices,
+                                    in_xla=in_xla)
+        with tf.name_scope('keypoints'):
+            keypoints = _transform_keypoints(keypoints=keypoints,
+                                             matrices=normalized_matrices)
+
+    if not batched:
+        images = images[0]
+        boxes = None if boxes is None else boxes[0]
+        masks = None if masks is None else masks[0]
+        keypoints = None if keypoints is None else keypoints[0]
+    return _outputs(images, labels, boxes, masks, keypoints)
+
+
+def _random_affine_matrices(batch_size, height, width, flip_probability,
+                            min_scale, max_scale, max_translation,
+                            max_rotation_degrees, max_shear_degrees, seed):
+    # Builds [batch, 3, 3] matrices mapping input to output points in
+    # continuous pixel coordinates (x, y), where the image spans
+    # [0, width] x [0, height]. Transforms are composed around the image
+    # centre as translate . rotate . shear . scale . flip.
+    seeds = _split_seed(seed, num=5)
+    flip = tf.where(
+        tf.greater(_random_uniform([batch_size], seed=seeds[0],
+                                   name='do_flip'),
+                   1.0 - flip_probability),
+        -1.0, 1.0)
+    scale = _random_uniform([batch_size], minval=min_scale,
+                            maxval=max_scale, seed=seeds[1], name='scale')
+    translation = _random_uniform([2, batch_size],
+                                  minval=-max_translation,
+                                  maxval=max_translation,
+                                  seed=seeds[2],
+                                  name='translation')
+    rotation = _degrees_to_radians(_random_uniform(
+        [batch_size], minval=-max_rotation_degrees,
+        maxval=max_rotation_degrees, seed=seeds[3], name='rotation'))
+    shear = tf.tan(_degrees_to_radians(_random_uniform(
+        [batch_size], minval=-max_shear_degrees, maxval=max_shear_degrees,
+        seed=seeds[4], name='shear')))
+
+    zeros = tf.zeros([batch_size])
+    ones = tf.ones([batch_size])
+    cos = tf.cos(rotation)
+    sin = tf.sin(rotation)
+    center_x = 0.5 * width
+    center_y = 0.5 * height
+    linear = tf.linalg.matmul(
+        tf.linalg.matmul(
+            _affine_matrices(cos, -sin, zeros, sin, cos, zeros),
+            _affine_matrices(ones, shear, zeros, zeros, ones, zeros)),
+        _affine_matrices(scale * flip, zeros, zeros, zeros, scale, zeros)
+    )
+    to_center = _affine_matrices(ones, zeros, -center_x * ones,
+                                 zeros, ones, -center_y * ones)
+    from_center = _affine_matrices(ones, zeros,
+                                   center_x + translation[0] * width,
+                                   zeros, ones,
+                                   center_y + translation[1] * height)
+    return tf.linalg.matmul(from_center, tf.linalg.matmul(linear, to_center))
+
+
+def _affine_matrices(a, b, c, d, e, f):
+    zeros = tf.zeros_like(a)
+    ones = tf.ones_like(a)
+    return tf.reshape(
+        tf.stack([a, b, c, d, e, f, zeros, zeros, ones], axis=-1),
+        tf.concat([tf.shape(a), [3, 3]], axis=0)
+    )
+
+
+def _degrees_to_radians(degrees):
+    return degrees * (3.141592653589793 / 180.0)
+
+
+def _warp_images(images, matrices, interpolation, fill_value, in_xla=False):
+    # ImageProjectiveTransformV3 maps every output pixel index to an input
+    # pixel index, so it needs the inverse transform expressed on pixel
+    # indices, whose centres sit at half-integer continuous coordinates.
+    batch_size = tf.shape(matrices)[0]
+    ones = tf.ones([batch_size])
+    zeros = tf.zeros([batch_size])
+    to_continuous = _affine_matrices(ones, zeros, 0.5 * ones,
+                                     zeros, ones, 0.5 * ones)
+    to_index = _affine_matrices(ones, zeros, -0.5 * ones,
+                                zeros, ones, -0.5 * ones)
+    inverse = tf.linalg.matmul(
+        to_index, tf.linalg.matmul(tf.linalg.inv(matrices), to_continuous))
+    if in_xla:
+        # ImageProjectiveTransformV3 has no XLA kernel.
+        return _sample_images(images=images,
+                              inverse=inverse,
+                              interpolation=interpolation,
+                              fill_value=fill_value)
+    transforms = tf.reshape(inverse, [batch_size, 9])[:, :8]
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.shape(images)[1:3],
+        fill_value=tf.cast(fill_value, tf.float32),
+        interpolation=interpolation,
+        fill_mode='CONSTANT'
+    )
+
+
+def _sample_images(images, inverse, interpolation, fill_value):
+    # Gather based equivalent of ImageProjectiveTransformV3 with constant
+    # fill. Bilinear sampling blends the four neighbouring pixels, each
+    # replaced by fill_value when it falls outside the image.
+    images_shape = tf.shape(images)
+    height = images_shape[1]
+    width = images_shape[2]
+    grid_y, grid_x = tf.meshgrid(tf.range(tf.cast(height, tf.float32)),
+                                 tf.range(tf.cast(width, tf.float32)),
+                                 indexing='ij')
+    grid = tf.stack([grid_x, grid_y, tf.ones_like(grid_x)], axis=-1)
+    source = tf.einsum('bij,hwj->bhwi', inverse, grid)
+    source_x = source[..., 0]
+    source_y = source[..., 1]
+    dtype = images.dtype
+    images = tf.cast(images, tf.float32)
+    fill_value = tf.cast(fill_value, tf.float32)
+
+    def gather(y, x):
+        inside = tf.logical_and(
+            tf.logical_and(tf.greater_equal(x, 0.0),
+                           tf.less_equal(x, tf.cast(width - 1, tf.float32))),
+            tf.logical_and(tf.greater_equal(y, 0.0),
+                           tf.less_equal(y, tf.cast(height - 1, tf.float32))))
+        indices = tf.stack([
+            tf.clip_by_value(tf.cast(y, tf.int32), 0, height - 1),
+            tf.clip_by_value(tf.cast(x, tf.int32), 0, width - 1)
+        ], axis=-1)
+        values = tf.gather_nd(images, indices, batch_dims=1)
+        return tf.where(inside[..., tf.newaxis], values, fill_value)
+
+    if interpolation == 'NEAREST':
+        outputs = gather(tf.round(source_y), tf.round(source_x))
+    else:
+        y0 = tf.floor(source_y)
+        x0 = tf.floor(source_x)
+        weight_y = (source_y - y0)[..., tf.newaxis]
+        weight_x = (source_x - x0)[..., tf.newaxis]
+        top = ((1.0 - weight_x) * gather(y0, x0) +
+               weight_x * gather(y0, x0 + 1.0))
+        bottom = ((1.0 - weight_x) * gather(y0 + 1.0, x0) +
+                  weight_x * gather(y0 + 1.0, x0 + 1.0))
+        outputs = (1.0 - weight_y) * top + weight_y * bottom
+    if dtype.is_integer:
+        outputs = tf.round(outputs)
+    return tf.cast(outputs, dtype)
+
+
+def _warp_masks(masks, matrices, in_xla=False):
+    if masks is None:
+        return None
+    # Instances are warped together as channels of a single resample.
+    dtype = masks.dtype
+    if dtype == tf.bool:
+        masks = tf.cast(masks, tf.uint8)
+    warped_masks = tf.transpose(
+        _warp_images(images=tf.transpose(masks, [0, 2, 3, 1]),
+                     matrices=matrices,
+                     interpolation='NEAREST',
+                     fill_value=0.0,
+                     in_xla=in_xla),
+        [0, 3, 1, 2]
+    )
+    return tf.cast(warped_masks, dtype)
+
+
+def _normalized_matrices(matrices, height, width):
+    # Moves pixel space matrices to normalized image coordinates.
+    normalize = tf.linalg.diag(tf.stack([1.0 / width, 1.0 / height, 1.0]))
+    denormalize = tf.linalg.diag(tf.stack([width, height, 1.0]))
+    return tf.linalg.matmul(normalize,
+                            tf.linalg.matmul(matrices, denormalize))
+
+
+def _transform_points(points_x, points_y, matrices):
+    # points_x and points_y are [batch, ...] or ragged [batch, (N), ...].
+    # Ragged points are transformed on their flat values, each with the
+    # matrix of the example it belongs to.
+    if isinstance(points_x, tf.RaggedTensor):
+        flat_matrices = tf.gather(matrices,
+                                  _flat_values_batch_index(points_x))
+        transformed_x, transformed_y = _transform_points(
+            points_x.flat_values, points_y.flat_values, flat_matrices)
+        return (points_x.with_flat_values(transformed_x),
+                points_y.with_flat_values(transformed_y))
+    points = tf.stack([points_x, points_y, tf.ones_like(points_x)], axis=-1)
+    transformed = tf.einsum('bij,b...j->b...i', matrices, points)
+    return transformed[..., 0], transformed[..., 1]
+
+
+def _transform_boxes(boxes, matrices):
+    if boxes is None:
+        return None
+    # Maps the four corners of every box and keeps the enclosing axis
+    # aligned box.
+    ymin, xmin, ymax, xmax = tf.unstack(_flat_or_dense(boxes), num=4,
+                                        axis=-1)
+    corners_x = tf.stack([xmin, xmax, xmin, xmax], axis=-1)
+    corners_y = tf.stack([ymin, ymin, ymax, ymax], axis=-1)
+    if isinstance(boxes, tf.RaggedTensor):
+        corners_x = boxes.with_flat_values(corners_x)
+        corners_y = boxes.with_flat_values(corners_y)
+    transformed_x, transformed_y = _transform_points(corners_x, corners_y,
+                                                     matrices)
+    transformed_x = _flat_or_dense(transformed_x)
+    transformed_y = _flat_or_dense(transformed_y)
+    transformed_boxes = tf.clip_by_value(
+        tf.stack(
+            [
+                tf.reduce_min(transformed_y, axis=-1),
+                tf.reduce_min(transformed_x, axis=-1),
+                tf.reduce_max(transformed_y, axis=-1),
+                tf.reduce_max(transformed_x, axis=-1)
+            ],
+            axis=-1
+        ),
+        0.0, 1.0
+    )
+    if isinstance(boxes, tf.RaggedTensor):
+        return boxes.with_flat_values(transformed_boxes)
+    return transformed_boxes
+
+
+def _transform_keypoints(keypoints, matrices):
+    # Keypoints are normalized [..., 2] (y, x) pairs.
+    if keypoints is None:
+        return None
+    y, x = tf.unstack(_flat_or_dense(keypoints), num=2, axis=-1)
+    if isinstance(keypoints, tf.RaggedTensor):
+        x = keypoints.with_flat_values(x)
+        y = keypoints.with_flat_values(y)
+    transformed_x, transformed_y = _transform_points(x, y, matrices)
+    transformed_keypoints = tf.stack(
+        [_flat_or_dense(transformed_y), _flat_or_dense(transformed_x)],
+        axis=-1)
+    if isinstance(keypoints, tf.RaggedTensor):
+        return keypoints.with_flat_values(transformed_keypoints)
+    return transformed_keypoints
+
+
+def _flat_or_dense(tensor):
+    if isinstance(tensor, tf.RaggedTensor):
+        return tensor.flat_values
+    return tensor
+
+
+def polygons_to_masks(polygons, height, width, dtype=tf.uint8):
+    # Augmentations accept instance masks as polygons: a tf.RaggedTensor
+    # [(batch,) N, (V), 2] of normalized (y, x) vertices, one polygon per
+    # instance. They are flipped and warped by moving their vertices, which
+    # is much cheaper than touching dense [N, height, width] masks, and only
+    # need to be densified here, where the loss consumes them.
+    # Returns [N, height, width] masks, or [batch, (N), height, width] for
+    # batched polygons. A pixel belongs to a polygon when its centre is inside
+    # it under the even-odd rule.
+    if polygons.ragged_rank > 1:
+        return tf.RaggedTensor.from_row_splits(
+            polygons_to_masks(polygons.values, height, width, dtype=dtype),
+            polygons.row_splits)
+    with tf.name_scope('Polygons_to_masks'):
+        lengths = tf.cast(polygons.row_lengths(), tf.int32)
+        vertices = polygons.to_tensor()
+        num_vertices = tf.shape(vertices)[1]
+        vertex_index = tf.range(num_vertices)
+        next_index = tf.math.floormod(
+            vertex_index[tf.newaxis] + 1,
+            tf.maximum(lengths, 1)[:, tf.newaxis])
+        next_vertices = tf.gather(vertices, next_index, batch_dims=1)
+        valid_edges = vertex_index[tf.newaxis] < lengths[:, tf.newaxis]
+
+        # Every edge crossing the horizontal line through a row of pixel
+        # centres contributes one crossing x coordinate to that row.
+        y1 = vertices[:, tf.newaxis, :, 0]
+        x1 = vertices[:, tf.newaxis, :, 1]
+        y2 = next_vertices[:, tf.newaxis, :, 0]
+        x2 = next_vertices[:, tf.newaxis, :, 1]
+        rows = (tf.range(height, dtype=vertices.dtype) + 0.5) / tf.cast(
+            height, vertices.dtype)
+        rows = rows[tf.newaxis, :, tf.newaxis]
+        spans_row = tf.logical_and(
+            tf.not_equal(y1 > rows, y2 > rows),
+            valid_edges[:, tf.newaxis, :])
+        crossings = x1 + (rows - y1) * tf.math.divide_no_nan(
+            x2 - x1, y2 - y1)
+        crossings = tf.sort(
+            tf.where(spans_row, crossings, tf.fill(tf.shape(crossings),
+                                                   vertices.dtype.min)),
+            axis=-1)
+
+        # A pixel is inside when an odd number of crossings lies right of it.
+        columns = (tf.range(width, dtype=vertices.dtype) + 0.5) / tf.cast(
+            width, vertices.dtype)
+        num_polygons = tf.shape(vertices)[0]
+        columns = tf.broadcast_to(columns[tf.newaxis, tf.newaxis],
+                                  [num_polygons, height, width])
+        crossings_left = tf.searchsorted(crossings, columns, side='right')
+        crossings_right = num_vertices - crossings_left
+        inside = tf.equal(tf.math.floormod(crossings_right, 2), 1)
+        return tf.cast(inside, dtype)
+
+
+def mixup(images, labels=None, boxes=None, masks=None, keypoints=None,
+          alpha=0.2,
+          seed=None):
+    # Batch level MixUp over [batch, height, width, channels] images. Every
+    # example is blended with the example a random permutation of the batch
+    # pairs it with, weighted by lambda ~ Beta(alpha, alpha). Labels
+    # [batch, num_classes] are blended with the same weights. Both examples
+    # stay visible, so their boxes, masks and keypoints are concatenated
+    # along the instance dimension.
+    with tf.name_scope('Mixup'):
+        seeds = _split_seed(seed, num=2)
+        batch_size = tf.shape(images)[0]
+        permutation = _random_permutations(batch_size, num=1,
+                                           seed=seeds[0])[0]
+        weights = _random_beta([batch_size], alpha=alpha, seed=seeds[1],
+                               name='mixup_weight')
+        images = _blend(images, tf.gather(images, permutation), weights)
+        labels = _blend_labels(labels, permutation, weights)
+        boxes = _concat_instances(
+            [boxes, _gather_examples(boxes, permutation)])
+        masks = _concat_instances(
+            [masks, _gather_examples(masks, permutation)])
+        keypoints = _concat_instances(
+            [keypoints, _gather_examples(keypoints, permutation)])
+    return _outputs(images, labels, boxes, masks, keypoints)
+
+
+def cutmix(images, labels=None, boxes=None, masks=None, keypoints=None,
+           alpha=1.0,
+           seed=None):
+    # Batch level CutMix over [batch, height, width, channels] images. Every
+    # example gets a rectangle of the example a random permutation pairs it
+    # with pasted in. The rectangle covers about 1 - lambda of the image,
+    # lambda ~ Beta(alpha, alpha), and labels are blended by the area it
+    # actually covers. Boxes and dense masks of the pasted example are cut
+    # to the rectangle and appended along the instance dimension; boxes
+    # left outside it become empty. Polygon masks and keypoints cannot be
+    # cut and are not supported.
+    if isinstance(masks, tf.RaggedTensor) or keypoints is not None:
+        raise ValueError('CutMix does not support polygon masks or '
+                         'keypoints, as they cannot be cut to the pasted '
+                         'rectangle.')
+    with tf.name_scope('Cutmix'):
+        seeds = _split_seed(seed, num=3)
+        images_shape = tf.shape(images)
+        batch_size = images_shape[0]
+        permutation = _random_permutations(batch_size, num=1,
+                                           seed=seeds[0])[0]
+        weights = _random_beta([batch_size], alpha=alpha, seed=seeds[1],
+                               name='cutmix_weight')
+        cut_size = tf.sqrt(1.0 - weights)
+        centers = _random_uniform([2, batch_size], seed=seeds[2],
+                                  name='cut_center')
+        windows = tf.clip_by_value(
+            tf.stack([centers[0] - 0.5 * cut_size,
+                      centers[1] - 0.5 * cut_size,
+                      centers[0] + 0.5 * cut_size,
+                      centers[1] + 0.5 * cut_size], axis=-1),
+            0.0, 1.0)
+
+        # A pixel is pasted when its centre lies inside the window.
+        rows = _pixel_centers(images_shape[1])
+        columns = _pixel_centers(images_shape[2])
+        in_rows = tf.logical_and(rows >= windows[:, 0:1],
+                                 rows < windows[:, 2:3])
+        in_columns = tf.logical_and(columns >= windows[:, 1:2],
+                                    columns < windows[:, 3:4])
+        pasted = tf.logical_and(in_rows[:, :, tf.newaxis],
+                                in_columns[:, tf.newaxis, :])
+        images = tf.where(pasted[..., tf.newaxis],
+                          tf.gather(images, permutation), images)
+        weights = 1.0 - tf.reduce_mean(tf.cast(pasted, tf.float32),
+                                       axis=[1, 2])
+        labels = _blend_labels(labels, permutation, weights)
+        boxes = _concat_instances(
+            [boxes,
+             _clip_boxes(_gather_examples(boxes, permutation), windows)])
+        if masks is not None:
+            pasted_masks = pasted[:, tf.newaxis]
+            masks = _concat_instances([
+                tf.where(pasted_masks, tf.zeros_like(masks), masks),
+                tf.where(pasted_masks, tf.gather(masks, permutation),
+                         tf.zeros_like(masks))
+            ])
+    return _outputs(images, labels, boxes, masks, keypoints)
+
+
+def mosaic(images, labels=None, boxes=None, masks=None, keypoints=None,
+           seed=None):
+    # Batch level 4 image Mosaic over [batch, height, width, channels]
+    # images. Every example is tiled with three others, picked by random
+    # permutations of the batch, in a 2x2 grid of half size tiles; the
+    # example itself is the top left tile. Labels [batch, num_classes] are
+    # averaged over the tiles, and boxes, masks and keypoints of all four
+    # tiles are scaled into their tile and concatenated along the instance
+    # dimension.
+    with tf.name_scope('Mosaic'):
+        images_shape = tf.shape(images)
+        batch_size = images_shape[0]
+        height = images_shape[1]
+        width = images_shape[2]
+        tile_height = height // 2
+        tile_width = width // 2
+        indices = tf.concat([
+            tf.range(batch_size)[tf.newaxis],
+            _random_permutations(batch_size, num=3, seed=seed)
+        ], axis=0)
+
+        # All 4 * batch tiles are resized together.
+        tiles = _cast_back(
+            tf.image.resize(tf.gather(images, tf.reshape(indices, [-1])),
+                            tf.stack([tile_height, tile_width])),
+            images.dtype)
+        tiles = tf.reshape(
+            tiles,
+            tf.concat([[4, batch_size, tile_height, tile_width],
+                       images_shape[3:]], axis=0))
+        grid = tf.concat([tf.concat([tiles[0], tiles[1]], axis=2),
+                          tf.concat([tiles[2], tiles[3]], axis=2)], axis=1)
+        mosaic_images = tf.ensure_shape(
+            tf.pad(grid, [[0, 0], [0, height - 2 * tile_height],
+                          [0, width - 2 * tile_width], [0, 0]]),
+            images.shape)
+
+        if labels is not None:
+            labels = tf.reduce_mean(tf.gather(labels, indices), axis=0)
+        scale = tf.stack([tf.cast(tile_height, tf.float32) /
+                          tf.cast(height, tf.float32),
+                          tf.cast(tile_width, tf.float32) /
+                          tf.cast(width, tf.float32)])
+        tile_boxes = list()
+        tile_masks = list()
+        tile_keypoints = list()
+        for tile in range(4):
+            # Offsets of the tile in normalized and in pixel coordinates.
+            row, column = divmod(tile, 2)
+            offset = scale * tf.constant([row, column], tf.float32)
+            pixel_offset = [row * tile_height, column * tile_width]
+            tile_boxes.append(_scale_points(
+                _gather_examples(boxes, indices[tile]),
+                tf.tile(scale, [2]), tf.tile(offset, [2])))
+            tile_keypoints.append(_scale_points(
+                _gather_examples(keypoints, indices[tile]), scale, offset))
+            if isinstance(masks, tf.RaggedTensor):
+                tile_masks.append(_scale_points(
+                    tf.gather(masks, indices[tile]), scale, offset))
+            elif masks is not None:
+                tile_masks.append(_tile_masks(
+                    tf.gather(masks, indices[tile]),
+                    tile_size=[tile_height, tile_width],
+                    offset=pixel_offset,
+                    size=[height, width]))
+        boxes = _concat_instances(tile_boxes)
+        masks = _concat_instances(tile_masks)
+        keypoints = _concat_instances(tile_keypoints)
+    return _outputs(mosaic_images, labels, boxes, masks, keypoints)
+
+
+def _random_permutations(batch_size, num, seed):
+    # [num, batch] independent permutations of range(batch).
+    return tf.argsort(
+        _random_uniform([num, batch_size], seed=seed, name='permutation'),
+        axis=-1)
+
+
+def _random_beta(shape, alpha, seed, name=None):
+    # Beta(alpha, alpha) as the ratio of two Gamma(alpha) draws.
+    seeds = _split_seed(seed, num=2)
+    gammas = [_random_gamma(shape, alpha=alpha, seed=s) for s in seeds]
+    return tf.identity(gammas[0] / (gammas[0] + gammas[1]), name=name)
+
+
+def _random_gamma(shape, alpha, seed, num_attempts=16):
+    # Marsaglia and Tsang's rejection sampler with a fixed number of
+    # vectorized attempts, keeping the first accepted one. Unlike
+    # tf.random.gamma it compiles with XLA. Every attempt is accepted with
+    # probability above 0.95, so running out of attempts is negligible;
+    # such a draw falls back to d, close to the median.
+    # alpha < 1 is sampled as Gamma(alpha + 1) * U ** (1 / alpha).
+    seeds = _split_seed(seed, num=3)
+    boosted = alpha < 1.0
+    d = (alpha + 1.0 if boosted else alpha) - 1.0 / 3.0
+    c = 1.0 / (9.0 * d) ** 0.5
+    attempts_shape = [num_attempts] + list(shape)
+    x = _random_normal(attempts_shape, seed=seeds[0])
+    u = _random_uniform(attempts_shape, seed=seeds[1])
+    v = (1.0 + c * x) ** 3
+    accepted = tf.logical_and(
+        v > 0.0,
+        tf.math.log(u) < (0.5 * x ** 2 + d - d * v +
+                          d * tf.math.log(tf.maximum(v, 1e-12))))
+    first_accepted = tf.one_hot(
+        tf.argmax(tf.cast(accepted, tf.int32), axis=0), num_attempts, axis=0)
+    gammas = d * tf.reduce_sum(first_accepted * tf.where(accepted, v, 1.0),
+                               axis=0)
+    if boosted:
+        gammas *= _random_uniform(shape, seed=seeds[2]) ** (1.0 / alpha)
+    return gammas
+
+
+def _random_normal(shape, seed, name=None):
+    if seed is None:
+        return tf.random.normal(shape=shape, name=name)
+    return tf.random.stateless_normal(shape=shape, seed=seed, name=name)
+
+
+def _blend(x, y, weights):
+    # weights [batch] of x, broadcast over the trailing dimensions.
+    weights = _broadcastable(weights, x)
+    blended = (weights * tf.cast(x, tf.float32) +
+               (1.0 - weights) * tf.cast(y, tf.float32))
+    return _cast_back(blended, x.dtype)
+
+
+def _blend_labels(labels, permutation, weights):
+    if labels is None:
+        return None
+    return _blend(labels, tf.gather(labels, permutation), weights)
+
+
+def _cast_back(x, dtype):
+    if dtype.is_integer:
+        return tf.saturate_cast(tf.round(x), dtype)
+    return tf.cast(x, dtype)
+
+
+def _gather_examples(x, indices):
+    if x is None:
+        return None
+    return tf.gather(x, indices)
+
+
+def _concat_instances(tensors):
+    # Concatenates dense or ragged [batch, N, ...] tensors along N.
+    if not tensors or tensors[0] is None:
+        return None
+    return tf.concat(tensors, axis=1)
+
+
+def _pixel_centers(size):
+    size = tf.cast(size, tf.float32)
+    return (tf.range(size) + 0.5) / size
+
+
+def _clip_boxes(boxes, windows):
+    # Clips [batch, N, 4] or ragged [batch, (N), 4] boxes to one
+    # [ymin, xmin, ymax, xmax] window per example.
+    if boxes is None:
+        return None
+    if isinstance(boxes, tf.RaggedTensor):
+        return boxes.with_flat_values(
+            _clip_boxes(boxes.flat_values,
+                        tf.gather(windows, _flat_values_batch_index(boxes))))
+    if boxes.shape.rank == 3:
+        windows = windows[:, tf.newaxis]
+    return tf.clip_by_value(boxes,
+                            tf.concat([windows[..., :2]] * 2, axis=-1),
+                            tf.concat([windows[..., 2:]] * 2, axis=-1))
+
+
+def _scale_points(points, scale, offset):
+    # points * scale + offset on the last dimension of dense or ragged
+    # boxes, keypoints and polygons.
+    if points is None:
+        return None
+    if isinstance(points, tf.RaggedTensor):
+        return tf.ragged.map_flat_values(_scale_points, points, scale, offset)
+    return points * scale + offset
+
+
+def _tile_masks(masks, tile_size, offset, size):
+    # Resizes [batch, N, height, width] masks into a tile of a zero canvas.
+    dtype = masks.dtype
+    if dtype == tf.bool:
+        masks = tf.cast(masks, tf.uint8)
+    tiled_masks = tf.image.resize(
+        tf.transpose(masks, [0, 2, 3, 1]),
+        tf.stack(tile_size),
+        method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+    tiled_masks = tf.pad(
+        tiled_masks,
+        [[0, 0],
+         [offset[0], size[0] - offset[0] - tile_size[0]],
+         [offset[1], size[1] - offset[1] - tile_size[1]],
+         [0, 0]])
+    return tf.cast(tf.transpose(tiled_masks, [0, 3, 1, 2]), dtype)
+
+
+def random_augment(images, labels=None, boxes=None, masks=None,
+                   keypoints=None,
+                   num_layers=2,
+                   magnitude=0.3,
+                   augmentations=None,
+                   seed=None,
+                   in_xla=False):
+    # RandAugment over [batch, height, width, channels] images. Each of
+    # num_layers layers picks one entry of the table per example, and every
+    # entry runs only on the examples that picked it, gathered into a
+    # smaller batch and scattered back. Inside XLA, which cannot compile
+    # data dependent shapes, entries run on the whole batch and the result
+    # is selected per example instead; callers compiling with XLA pass
+    # in_xla.
+    # magnitude in [0, 1] scales the strength of every entry, augmentations
+    # names the entries to pick from and defaults to the whole table.
+    table = _rand_augment_table(magnitude, in_xla)
+    augment_fns = [table[name] for name in (augmentations or list(table))]
+    with tf.name_scope('Random_augment'):
+        batch_size = tf.shape(images)[0]
+        for layer_seed in _split_seed(seed, num=num_layers):
+            seeds = _split_seed(layer_seed, num=len(augment_fns) + 1)
+            choices = tf.cast(
+                _random_uniform([batch_size], seed=seeds[0],
+                                maxval=float(len(augment_fns)),
+                                name='choice'),
+                tf.int32)
+            for index, augment_fn in enumerate(augment_fns):
+                if augment_fn is None:
+                    continue
+                selected = tf.equal(choices, index)
+                x = (images, boxes, masks, keypoints)
+                if in_xla:
+                    augmented = _call_table_entry(augment_fn, x,
+                                                  seed=seeds[index + 1])
+                    x = [None if a is None else _select_per_example(
+                        selected, a, b) for a, b in zip(augmented, x)]
+                else:
+                    x = _augment_examples(augment_fn, x, selected,
+                                          seed=seeds[index + 1])
+                images, boxes, masks, keypoints = x
+    return _outputs(images, labels, boxes, masks, keypoints)
+
+
+def _rand_augment_table(magnitude, in_xla=False):
+    # Table entries take (images, labels, boxes, masks, keypoints, seed) and
+    # keep the shapes of their inputs.
+    def unseeded(fn):
+        return lambda *args, seed=None: fn(*args)
+
+    return {
+        'identity': None,
+        'horizontal_flip': unseeded(horizontal_flip),
+        'gray_scale': unseeded(functools.partial(grayscale,
+                                                 keep_channels=True)),
+        'rotate': functools.partial(random_affine,
+                                    max_rotation_degrees=30.0 * magnitude,
+                                    in_xla=in_xla),
+        'shear': functools.partial(random_affine,
+                                   max_shear_degrees=17.0 * magnitude,
+                                   in_xla=in_xla),
+        'translate': functools.partial(random_affine,
+                                       max_translation=0.3 * magnitude,
+                                       in_xla=in_xla),
+        'brightness': functools.partial(
+            random_color_jitter, max_brightness_delta=0.4 * magnitude),
+        'contrast': functools.partial(random_color_jitter,
+                                      min_contrast=1.0 - 0.9 * magnitude,
+                                      max_contrast=1.0 + 0.9 * magnitude),
+        'saturation': functools.partial(random_color_jitter,
+                                        min_saturation=1.0 - 0.9 * magnitude,
+                                        max_saturation=1.0 + 0.9 * magnitude),
+        'hue': functools.partial(random_color_jitter,
+                                 max_hue_delta=0.1 * magnitude),
+    }
+
+
+def _call_table_entry(augment_fn, x, seed):
+    images, boxes, masks, keypoints = x
+    outputs = augment_fn(images, None, boxes, masks, keypoints, seed=seed)
+    return outputs[0], outputs[2], outputs[3], (
+        outputs[4] if len(outputs) > 4 else None)
+
+
+def _augment_examples(augment_fn, x, selected, seed):
+    indices = tf.where(selected)[:, 0]
+    augmented = _call_table_entry(
+        augment_fn, [_gather_examples(a, indices) for a in x], seed=seed)
+    return [_update_examples(a, indices, selected, updates)
+            for a, updates in zip(x, augmented)]
+
+
+def _update_examples(x, indices, selected, updates):
+    # Scatters the augmented examples back. Ragged rows keep their lengths,
+    # so their flat values are scattered to the positions of the rows they
+    # came from.
+    if x is None:
+        return None
+    if isinstance(x, tf.RaggedTensor):
+        positions = tf.where(tf.gather(selected, _flat_values_batch_index(x)))
+        return x.with_flat_values(tf.tensor_scatter_nd_update(
+            x.flat_values, positions, updates.flat_values))
+    return tf.tensor_scatter_nd_update(x, indices[:, tf.newaxis], updates)
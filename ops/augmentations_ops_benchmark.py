@@ -0,0 +1,90 @@
+import time
+
+import tensorflow as tf
+
+from ops import augmentations_ops as aug_ops
+
+BATCH_SIZE = 64
+IMAGE_SIZE = 224
+NUM_ITERS = 20
+
+JITTER_KWARGS = dict(
+    max_brightness_delta=0.2,
+    min_contrast=0.8,
+    max_contrast=1.2,
+    min_saturation=0.8,
+    max_saturation=1.2,
+    max_hue_delta=0.05
+)
+
+
+def _chained_color_jitter(images):
+    # Four tf.image calls per example, each a full pass over the image.
+    def jitter(image):
+        image = tf.image.random_brightness(
+            image, JITTER_KWARGS['max_brightness_delta'])
+        image = tf.image.random_contrast(image, JITTER_KWARGS['min_contrast'],
+                                         JITTER_KWARGS['max_contrast'])
+        image = tf.image.random_saturation(image,
+                                           JITTER_KWARGS['min_saturation'],
+                                           JITTER_KWARGS['max_saturation'])
+        image = tf.image.random_hue(image, JITTER_KWARGS['max_hue_delta'])
+        return tf.clip_by_value(image, 0.0, 1.0)
+
+    return tf.map_fn(jitter, images)
+
+
+def _stacked_rand_augment(images):
+    # Every table entry runs on the whole batch and each example keeps the
+    # result of the entry it picked.
+    augment_fns = list(aug_ops._rand_augment_table(0.3).values())
+    x = (images, None, None, None)
+    for _ in range(2):
+        choices = tf.random.uniform([BATCH_SIZE], maxval=len(augment_fns),
+                                    dtype=tf.int32)
+        for index, augment_fn in enumerate(augment_fns):
+            if augment_fn is None:
+                continue
+            augmented = aug_ops._call_table_entry(augment_fn, x, seed=None)
+            x = (aug_ops._select_per_example(tf.equal(choices, index),
+                                             augmented[0], x[0]),) + x[1:]
+    return x[0]
+
+
+class AugmentationsOpsBenchmark(tf.test.Benchmark):
+    def _run(self, name, jitter_fn):
+        images = tf.random.uniform([BATCH_SIZE, IMAGE_SIZE, IMAGE_SIZE, 3])
+        jitter_fn(images).numpy()
+        start = time.time()
+        for _ in range(NUM_ITERS):
+            outputs = jitter_fn(images)
+        outputs.numpy()
+        wall_time = (time.time() - start) / NUM_ITERS
+        self.report_benchmark(
+            name=name,
+            iters=NUM_ITERS,
+            wall_time=wall_time,
+            extras={'images_per_sec': BATCH_SIZE / wall_time}
+        )
+
+    def benchmark_chained_color_jitter(self):
+        self._run('chained_color_jitter', tf.function(_chained_color_jitter))
+
+    def benchmark_fused_color_jitter(self):
+        jitter_fn = tf.function(
+            lambda images: aug_ops.random_color_jitter(images,
+                                                       **JITTER_KWARGS)[0],
+            jit_compile=True)
+        self._run('fused_color_jitter', jitter_fn)
+
+    def benchmark_stacked_rand_augment(self):
+        self._run('stacked_rand_augment', tf.function(_stacked_rand_augment))
+
+    def benchmark_rand_augment(self):
+        augment_fn = tf.function(
+            lambda images: aug_ops.random_augment(images, num_layers=2)[0])
+        self._run('rand_augment', augment_fn)
+
+
+if __name__ == "__main__":
+    tf.test.main()
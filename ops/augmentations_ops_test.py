@@ -0,0 +1,361 @@
+import functools
+
+import numpy as np
+import tensorflow as tf
+
+from ops import augmentations_ops as aug_ops
+
+
+class RandomHorizontalFlipTest(tf.test.TestCase):
+    def _batch(self):
+        images = tf.reshape(tf.range(2 * 2 * 3 * 3, dtype=tf.float32),
+                            [2, 2, 3, 3])
+        boxes = tf.constant([[[0.1, 0.2, 0.5, 0.6]],
+                             [[0.0, 0.0, 1.0, 0.3]]])
+        masks = tf.reshape(tf.range(2 * 1 * 2 * 3), [2, 1, 2, 3])
+        return images, boxes, masks
+
+    def test_per_example_always_flips(self):
+        images, boxes, masks = self._batch()
+        flipped_images, _, flipped_boxes, flipped_masks = \
+            aug_ops.random_horizontal_flip(images, boxes=boxes, masks=masks,
+                                           flip_probability=1.0,
+                                           per_example=True)
+        self.assertAllEqual(flipped_images, images[:, :, ::-1, :])
+        self.assertAllClose(flipped_boxes, [[[0.1, 0.4, 0.5, 0.8]],
+                                            [[0.0, 0.7, 1.0, 1.0]]])
+        self.assertAllEqual(flipped_masks, masks[..., ::-1])
+
+    def test_per_example_never_flips(self):
+        images, boxes, masks = self._batch()
+        flipped_images, _, flipped_boxes, flipped_masks = \
+            aug_ops.random_horizontal_flip(images, boxes=boxes, masks=masks,
+                                           flip_probability=0.0,
+                                           per_example=True)
+        self.assertAllEqual(flipped_images, images)
+        self.assertAllEqual(flipped_boxes, boxes)
+        self.assertAllEqual(flipped_masks, masks)
+
+    def test_per_example_decisions_are_independent(self):
+        tf.random.set_seed(1)
+        images = tf.tile(tf.reshape(tf.range(4, dtype=tf.float32),
+                                    [1, 1, 4, 1]), [64, 1, 1, 1])
+        flipped_images, _, _, _ = aug_ops.random_horizontal_flip(
+            images, flip_probability=0.5, per_example=True)
+        flipped = np.equal(flipped_images.numpy()[:, 0, 0, 0], 3.0)
+        self.assertTrue(flipped.any())
+        self.assertFalse(flipped.all())
+
+    def test_per_example_ragged_boxes_and_keypoints(self):
+        images = tf.zeros([2, 4, 4, 3])
+        boxes = tf.ragged.constant([[[0.1, 0.2, 0.5, 0.6]],
+                                    [[0.0, 0.0, 1.0, 0.3],
+                                     [0.2, 0.5, 0.4, 0.75]]],
+                                   ragged_rank=1)
+        keypoints = tf.ragged.constant([[[[0.5, 0.25]]],
+                                        [[[0.1, 0.1]], [[0.3, 0.6]]]],
+                                       ragged_rank=1)
+        flipped = aug_ops.random_horizontal_flip(
+            images, boxes=boxes, keypoints=keypoints, flip_probability=1.0,
+            per_example=True)
+        self.assertLen(flipped, 5)
+        self.assertIsInstance(flipped[2], tf.RaggedTensor)
+        self.assertAllClose(flipped[2].to_list(),
+                            [[[0.1, 0.4, 0.5, 0.8]],
+                             [[0.0, 0.7, 1.0, 1.0],
+                              [0.2, 0.25, 0.4, 0.5]]])
+        self.assertAllClose(flipped[4].to_list(),
+                            [[[[0.5, 0.75]]],
+                             [[[0.1, 0.9]], [[0.3, 0.4]]]])
+
+    def test_ragged_boxes_in_cond(self):
+        boxes = tf.ragged.constant([[[0.1, 0.2, 0.5, 0.6]], []],
+                                   ragged_rank=1, inner_shape=(4,))
+        flipped = aug_ops.random_horizontal_flip(
+            tf.zeros([2, 4, 4, 3]), boxes=boxes, flip_probability=1.0)
+        self.assertAllClose(flipped[2].to_list(),
+                            [[[0.1, 0.4, 0.5, 0.8]], []])
+
+
+class RandomGrayscaleTest(tf.test.TestCase):
+    def test_keep_channels_static_shape(self):
+        images = tf.random.uniform([4, 5, 6, 3])
+        grayed_images, _, _, _ = aug_ops.random_grayscale(
+            images, gray_probability=0.5, keep_channels=True)
+        self.assertEqual(grayed_images.shape, images.shape)
+
+    def test_per_example_always_grays(self):
+        images = tf.random.uniform([4, 5, 6, 3])
+        grayed_images, _, _, _ = aug_ops.random_grayscale(
+            images, gray_probability=1.0, keep_channels=True,
+            per_example=True)
+        expected = tf.image.grayscale_to_rgb(
+            tf.image.rgb_to_grayscale(images))
+        self.assertEqual(grayed_images.shape, images.shape)
+        self.assertAllClose(grayed_images, expected)
+
+    def test_per_example_requires_keep_channels(self):
+        images = tf.random.uniform([4, 5, 6, 3])
+        with self.assertRaises(ValueError):
+            aug_ops.random_grayscale(images, per_example=True)
+
+
+class RandomAffineTest(tf.test.TestCase):
+    def test_identity(self):
+        images = tf.random.uniform([2, 6, 8, 3])
+        boxes = tf.constant([[[0.1, 0.2, 0.5, 0.6]],
+                             [[0.0, 0.0, 1.0, 0.3]]])
+        masks = tf.cast(tf.random.uniform([2, 1, 6, 8]) > 0.5, tf.uint8)
+        warped_images, _, warped_boxes, warped_masks = aug_ops.random_affine(
+            images, boxes=boxes, masks=masks)
+        self.assertAllClose(warped_images, images)
+        self.assertAllClose(warped_boxes, boxes)
+        self.assertAllEqual(warped_masks, masks)
+
+    def test_flip_matches_horizontal_flip(self):
+        images = tf.random.uniform([2, 6, 8, 3])
+        boxes = tf.constant([[[0.1, 0.2, 0.5, 0.6]],
+                             [[0.0, 0.0, 1.0, 0.3]]])
+        masks = tf.cast(tf.random.uniform([2, 1, 6, 8]) > 0.5, tf.uint8)
+        warped = aug_ops.random_affine(images, boxes=boxes, masks=masks,
+                                       flip_probability=1.0)
+        flipped = aug_ops.random_horizontal_flip(images, boxes=boxes,
+                                                 masks=masks,
+                                                 flip_probability=1.0,
+                                                 per_example=True)
+        self.assertAllClose(warped[0], flipped[0])
+        self.assertAllClose(warped[2], flipped[2])
+        self.assertAllEqual(warped[3], flipped[3])
+
+    def test_single_image_scale(self):
+        image = tf.reshape(tf.range(4 * 4, dtype=tf.float32), [4, 4, 1])
+        boxes = tf.constant([[0.25, 0.25, 0.5, 0.5]])
+        warped_image, _, warped_boxes, _ = aug_ops.random_affine(
+            image, boxes=boxes, min_scale=2.0, max_scale=2.0)
+        self.assertEqual(warped_image.shape, image.shape)
+        self.assertAllClose(warped_image[:, :, 0],
+                            [[3.75, 4.25, 4.75, 5.25],
+                             [5.75, 6.25, 6.75, 7.25],
+                             [7.75, 8.25, 8.75, 9.25],
+                             [9.75, 10.25, 10.75, 11.25]])
+        self.assertAllClose(warped_boxes, [[0.0, 0.0, 0.5, 0.5]])
+
+    def test_ragged_boxes_match_dense_boxes(self):
+        tf.random.set_seed(3)
+        images = tf.random.uniform([2, 6, 8, 3])
+        boxes = tf.constant([[[0.1, 0.2, 0.5, 0.6], [0.3, 0.3, 0.4, 0.4]],
+                             [[0.0, 0.0, 1.0, 0.3], [0.5, 0.5, 0.9, 0.9]]])
+        keypoints = tf.constant([[[[0.3, 0.4]], [[0.35, 0.35]]],
+                                 [[[0.5, 0.1]], [[0.7, 0.7]]]])
+        ragged_boxes = tf.RaggedTensor.from_tensor(boxes, lengths=[1, 2])
+        ragged_keypoints = tf.RaggedTensor.from_tensor(keypoints,
+                                                       lengths=[1, 2])
+        kwargs = dict(flip_probability=0.5, min_scale=0.8, max_scale=1.2,
+                      max_translation=0.1, max_rotation_degrees=20.0,
+                      max_shear_degrees=5.0)
+        tf.random.set_seed(7)
+        dense = aug_ops.random_affine(images, boxes=boxes,
+                                      keypoints=keypoints, **kwargs)
+        tf.random.set_seed(7)
+        ragged = aug_ops.random_affine(images, boxes=ragged_boxes,
+                                       keypoints=ragged_keypoints, **kwargs)
+        self.assertAllClose(ragged[2].flat_values,
+                            tf.gather(tf.reshape(dense[2], [4, 4]),
+                                      [0, 2, 3]))
+        self.assertAllClose(ragged[4].flat_values,
+                            tf.gather(tf.reshape(dense[4], [4, 1, 2]),
+                                      [0, 2, 3]))
+
+    def test_compiled_warp_matches_kernel(self):
+        images = tf.random.uniform([2, 6, 8, 3])
+        masks = tf.cast(tf.random.uniform([2, 2, 6, 8]) > 0.5, tf.uint8)
+        matrices = aug_ops._random_affine_matrices(
+            batch_size=2, height=6.0, width=8.0, flip_probability=0.5,
+            min_scale=0.8, max_scale=1.2, max_translation=0.1,
+            max_rotation_degrees=20.0, max_shear_degrees=5.0, seed=None)
+
+        def warp(images, masks, in_xla=False):
+            return (aug_ops._warp_images(images, matrices, 'BILINEAR', 0.5,
+                                         in_xla=in_xla),
+                    aug_ops._warp_masks(masks, matrices, in_xla=in_xla))
+
+        expected_images, expected_masks = warp(images, masks)
+        warped_images, warped_masks = tf.function(
+            functools.partial(warp, in_xla=True),
+            jit_compile=True)(images, masks)
+        self.assertAllClose(warped_images, expected_images, atol=1e-4)
+        self.assertAllEqual(warped_masks, expected_masks)
+
+
+class RandomColorJitterTest(tf.test.TestCase):
+    def test_matches_chained_adjustments(self):
+        images = tf.random.uniform([2, 5, 6, 3], minval=0.2, maxval=0.8)
+        jittered = aug_ops.random_color_jitter(
+            images, min_contrast=1.2, max_contrast=1.2, min_saturation=0.5,
+            max_saturation=0.5)
+        expected = tf.image.adjust_saturation(
+            tf.clip_by_value(tf.image.adjust_contrast(images, 1.2), 0.0, 1.0),
+            0.5)
+        self.assertAllClose(jittered[0], expected, atol=1e-5)
+
+    def test_hue_rotation(self):
+        image = tf.constant([[[1.0, 0.0, 0.0]]])
+        jittered = aug_ops.random_color_jitter(image, max_hue_delta=1e-9)
+        self.assertAllClose(jittered[0], image, atol=1e-5)
+        self.assertAllClose(
+            aug_ops._color_jitter(image[tf.newaxis],
+                                  brightness=tf.constant([0.0]),
+                                  contrast=tf.constant([1.0]),
+                                  saturation=tf.constant([1.0]),
+                                  hue=tf.constant([1.0 / 3.0]),
+                                  adjust_hsv=True),
+            [[[[0.0, 1.0, 0.0]]]], atol=1e-5)
+
+    def test_uint8_and_probability(self):
+        images = tf.cast(tf.random.uniform([3, 4, 4, 3], maxval=256,
+                                           dtype=tf.int32), tf.uint8)
+        jittered = aug_ops.random_color_jitter(
+            images, max_brightness_delta=0.5, jitter_probability=0.0)
+        self.assertEqual(jittered[0].dtype, tf.uint8)
+        self.assertAllEqual(jittered[0], images)
+
+
+class PolygonMasksTest(tf.test.TestCase):
+    def _polygons(self):
+        # A square and a triangle on a 4x4 grid.
+        return tf.ragged.constant(
+            [[[0.0, 0.0], [0.0, 0.5], [0.5, 0.5], [0.5, 0.0]],
+             [[0.1, 1.0], [1.0, 1.0], [1.0, 0.1]]],
+            ragged_rank=1)
+
+    def test_polygons_to_masks(self):
+        masks = aug_ops.polygons_to_masks(self._polygons(), 4, 4)
+        self.assertAllEqual(masks, [[[1, 1, 0, 0],
+                                     [1, 1, 0, 0],
+                                     [0, 0, 0, 0],
+                                     [0, 0, 0, 0]],
+                                    [[0, 0, 0, 0],
+                                     [0, 0, 0, 1],
+                                     [0, 0, 1, 1],
+                                     [0, 1, 1, 1]]])
+
+    def test_flipped_polygons_match_flipped_masks(self):
+        polygons = self._polygons()
+        images = tf.zeros([4, 4, 3])
+        flipped = aug_ops.horizontal_flip(images, masks=polygons)
+        self.assertIsInstance(flipped[3], tf.RaggedTensor)
+        self.assertAllEqual(
+            aug_ops.polygons_to_masks(flipped[3], 4, 4),
+            aug_ops.polygons_to_masks(polygons, 4, 4)[..., ::-1])
+
+    def test_batched_polygons_in_affine(self):
+        polygons = tf.RaggedTensor.from_row_lengths(self._polygons(), [1, 1])
+        images = tf.zeros([2, 4, 4, 3])
+        warped = aug_ops.random_affine(images, masks=polygons,
+                                       flip_probability=1.0)
+        masks = aug_ops.polygons_to_masks(warped[3], 4, 4)
+        self.assertEqual(masks.shape.as_list(), [2, None, 4, 4])
+        self.assertAllEqual(
+            masks.flat_values,
+            aug_ops.polygons_to_masks(self._polygons(), 4, 4)[..., ::-1])
+
+
+class BatchAugmentationsTest(tf.test.TestCase):
+    def _inputs(self):
+        # Every image is filled with its index, so a pixel shows which
+        # examples were mixed into it.
+        images = tf.tile(tf.range(4.0)[:, tf.newaxis, tf.newaxis,
+                                       tf.newaxis], [1, 6, 8, 3])
+        labels = tf.one_hot(tf.range(4), 4)
+        boxes = tf.tile(tf.constant([[[0.0, 0.0, 1.0, 1.0]]]), [4, 1, 1])
+        return images, labels, boxes
+
+    def test_mixup_blends_images_and_labels(self):
+        images, labels, boxes = self._inputs()
+        mixed = aug_ops.mixup(images, labels, boxes, alpha=1.0,
+                              seed=tf.constant([1, 2], tf.int64))
+        self.assertAllClose(mixed[0][:, 0, 0, 0],
+                            tf.linalg.matvec(mixed[1], tf.range(4.0)))
+        self.assertAllClose(tf.reduce_sum(mixed[1], axis=-1), tf.ones([4]))
+        self.assertEqual(mixed[2].shape, [4, 2, 4])
+        self.assertAllClose(mixed[2][:, :1], boxes)
+
+    def test_cutmix_labels_match_pasted_area(self):
+        images, labels, boxes = self._inputs()
+        ragged_boxes = tf.RaggedTensor.from_tensor(boxes, lengths=[1, 0, 1, 1])
+        mixed = aug_ops.cutmix(images, labels, ragged_boxes, alpha=1.0,
+                               seed=tf.constant([3, 4], tf.int64))
+        self.assertAllClose(tf.reduce_mean(mixed[0], axis=[1, 2, 3]),
+                            tf.linalg.matvec(mixed[1], tf.range(4.0)))
+        self.assertAllInRange(mixed[2].flat_values, 0.0, 1.0)
+        with self.assertRaises(ValueError):
+            aug_ops.cutmix(images, keypoints=tf.zeros([4, 1, 1, 2]))
+
+    def test_mosaic_tiles(self):
+        images, labels, boxes = self._inputs()
+        tiled = aug_ops.mosaic(images, labels, boxes,
+                               seed=tf.constant([5, 6], tf.int64))
+        self.assertAllClose(tiled[0][:, :3, :4], images[:, :3, :4])
+        self.assertAllClose(tiled[0][:, 3, 4, 0],
+                            4.0 * tf.linalg.matvec(tiled[1], tf.range(4.0)) -
+                            tiled[0][:, 0, 0, 0] - tiled[0][:, 0, 4, 0] -
+                            tiled[0][:, 3, 0, 0])
+        self.assertAllClose(tiled[2][0], [[0.0, 0.0, 0.5, 0.5],
+                                          [0.0, 0.5, 0.5, 1.0],
+                                          [0.5, 0.0, 1.0, 0.5],
+                                          [0.5, 0.5, 1.0, 1.0]])
+        masks = tf.ones([4, 1, 7, 9], tf.bool)
+        tiled = aug_ops.mosaic(tf.zeros([4, 7, 9, 3]), masks=masks)
+        self.assertEqual(tiled[0].shape, [4, 7, 9, 3])
+        self.assertEqual(tiled[3].shape, [4, 4, 7, 9])
+
+    def test_random_beta_moments(self):
+        for alpha in (0.2, 2.0):
+            draws = aug_ops._random_beta([20000], alpha=alpha,
+                                         seed=tf.constant([7, 8], tf.int64))
+            self.assertAllClose(tf.reduce_mean(draws), 0.5, atol=0.01)
+            self.assertAllClose(tf.math.reduce_variance(draws),
+                                1.0 / (4.0 * (2.0 * alpha + 1.0)), atol=0.01)
+
+
+class RandomAugmentTest(tf.test.TestCase):
+    def test_flip_only_table(self):
+        images = tf.random.uniform([6, 4, 5, 3])
+        boxes = tf.RaggedTensor.from_tensor(tf.random.uniform([6, 2, 4]),
+                                            lengths=[2, 0, 1, 2, 1, 0])
+        augmented = aug_ops.random_augment(
+            images, boxes=boxes, num_layers=1,
+            augmentations=['identity', 'horizontal_flip'],
+            seed=tf.constant([1, 2], tf.int64))
+        flipped = tf.reduce_all(
+            tf.equal(augmented[0], images[:, :, ::-1]), axis=[1, 2, 3])
+        untouched = tf.reduce_all(tf.equal(augmented[0], images),
+                                  axis=[1, 2, 3])
+        self.assertAllEqual(tf.logical_or(flipped, untouched),
+                            tf.ones([6], tf.bool))
+        self.assertTrue(tf.reduce_any(flipped))
+        self.assertTrue(tf.reduce_any(untouched))
+        self.assertAllEqual(augmented[2].row_lengths(), boxes.row_lengths())
+        expected_boxes = tf.where(
+            tf.gather(flipped, augmented[2].value_rowids())[:, tf.newaxis],
+            aug_ops._flip_boxes_left_right(boxes.flat_values),
+            boxes.flat_values)
+        self.assertAllClose(augmented[2].flat_values, expected_boxes)
+
+    def test_compiled_keeps_shapes(self):
+        images = tf.random.uniform([4, 8, 8, 3])
+        masks = tf.ones([4, 2, 8, 8], tf.uint8)
+        augment_fn = tf.function(
+            lambda images, masks: aug_ops.random_augment(
+                images, masks=masks, num_layers=1, magnitude=0.5,
+                augmentations=['horizontal_flip', 'rotate', 'contrast'],
+                seed=tf.constant([3, 4], tf.int64), in_xla=True),
+            jit_compile=True)
+        augmented = augment_fn(images, masks)
+        self.assertEqual(augmented[0].shape, images.shape)
+        self.assertEqual(augmented[3].shape, masks.shape)
+        self.assertAllInRange(augmented[0], 0.0, 1.0)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -0,0 +1,187 @@
+import numpy as np
+import tensorflow as tf
+
+
+class TabulatedSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # Looks the learning rate up in a table of the values of schedule at
+    # steps 0 to max_steps, computed once in a single vectorized call. Steps
+    # past the end use the last value. The config holds schedule and
+    # max_steps rather than the table, which is built again when loaded.
+    def __init__(self, schedule, max_steps, name=None):
+        super().__init__()
+        self.schedule = schedule
+        self.max_steps = max_steps
+        self.name = name
+        steps = tf.range(max_steps + 1, dtype=tf.int64)
+        if callable(schedule):
+            self.table = tf.vectorized_map(
+                lambda step: tf.cast(schedule(step), tf.float32), steps)
+        else:
+            self.table = _evaluate(schedule, steps)
+
+    def __call__(self, step):
+        with tf.name_scope(self.name or 'TabulatedSchedule'):
+            index = tf.clip_by_value(tf.cast(step, tf.int64), 0,
+                                     tf.size(self.table, tf.int64) - 1)
+            return tf.gather(self.table, index)
+
+    def get_config(self):
+        return {
+            'schedule': _serialize(self.schedule),
+            'max_steps': self.max_steps,
+            'name': self.name
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**_deserialized(config))
+
+
+class WarmupSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # Multiplies schedule by a factor that rises from initial_factor at step
+    # 0 to 1 at warmup_steps, linearly, exponentially or along a half
+    # cosine, and leaves it unchanged afterwards. schedule may also be a
+    # constant learning rate.
+    def __init__(self, schedule, warmup_steps, method='linear',
+                 initial_factor=0.0, name=None):
+        super().__init__()
+        self.schedule = schedule
+        self.warmup_steps = warmup_steps
+        self.method = method
+        self.initial_factor = initial_factor
+        self.name = name
+
+    def __call__(self, step):
+        with tf.name_scope(self.name or 'WarmupSchedule'):
+            learning_rate = _evaluate(self.schedule, step)
+            progress = tf.minimum(
+                tf.cast(step, tf.float32) / float(self.warmup_steps), 1.0)
+            initial_factor = self.initial_factor
+            if self.method == 'linear':
+                factor = initial_factor + (1.0 - initial_factor) * progress
+            elif self.method == 'exponential':
+                factor = tf.pow(initial_factor, 1.0 - progress)
+            elif self.method == 'cosine':
+                factor = initial_factor + (1.0 - initial_factor) * 0.5 * (
+                    1.0 - tf.cos(np.pi * progress))
+            else:
+                raise ValueError('Unknown warmup method {}.'.format(
+                    self.method))
+            return learning_rate * tf.cast(factor, learning_rate.dtype)
+
+    def get_config(self):
+        return {
+            'schedule': _serialize(self.schedule),
+            'warmup_steps': self.warmup_steps,
+            'method': self.method,
+            'initial_factor': self.initial_factor,
+            'name': self.name
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**_deserialized(config))
+
+
+class ScaledSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # schedule, or a constant learning rate, multiplied by scale.
+    def __init__(self, schedule, scale, name=None):
+        super().__init__()
+        self.schedule = schedule
+        self.scale = scale
+        self.name = name
+
+    def __call__(self, step):
+        with tf.name_scope(self.name or 'ScaledSchedule'):
+            learning_rate = _evaluate(self.schedule, step)
+            return learning_rate * tf.cast(self.scale, learning_rate.dtype)
+
+    def get_config(self):
+        return {
+            'schedule': _serialize(self.schedule),
+            'scale': self.scale,
+            'name': self.name
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**_deserialized(config))
+
+
+class SequentialSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # Runs schedules[0] up to and including step boundaries[0], then
+    # schedules[1] up to boundaries[1] and so on, switching one step after
+    # every boundary like PiecewiseConstantDecay. Every phase sees the steps
+    # since its start, so its first step is its step 0.
+    # All phases are evaluated and the one of the step is picked with
+    # tf.searchsorted and selects, so there is no control flow for XLA to
+    # deal with.
+    def __init__(self, schedules, boundaries, name=None):
+        super().__init__()
+        self.schedules = list(schedules)
+        self.boundaries = list(boundaries)
+        self.name = name
+
+    def __call__(self, step):
+        with tf.name_scope(self.name or 'SequentialSchedule'):
+            step = tf.cast(step, tf.int64)
+            starts = [0] + [boundary + 1 for boundary in self.boundaries]
+            phase = tf.reshape(tf.searchsorted(
+                tf.constant(self.boundaries, tf.int64),
+                tf.reshape(step, [-1]), side='left', out_type=tf.int64),
+                tf.shape(step))
+            learning_rate = None
+            for index, (schedule, start) in enumerate(zip(self.schedules,
+                                                          starts)):
+                phase_learning_rate = tf.cast(
+                    _evaluate(schedule, tf.maximum(step - start, 0)),
+                    tf.float32)
+                if learning_rate is None:
+                    learning_rate = phase_learning_rate
+                else:
+                    learning_rate = tf.where(tf.equal(phase, index),
+                                             phase_learning_rate,
+                                             learning_rate)
+            return learning_rate
+
+    def get_config(self):
+        return {
+            'schedules': [_serialize(schedule) for schedule in self.schedules],
+            'boundaries': self.boundaries,
+            'name': self.name
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        config = dict(config)
+        config['schedules'] = [_deserialize(schedule)
+                               for schedule in config['schedules']]
+        return cls(**config)
+
+
+def _evaluate(schedule, step):
+    if callable(schedule):
+        return tf.convert_to_tensor(schedule(step))
+    return tf.fill(tf.shape(step), tf.constant(schedule, tf.float32))
+
+
+def _serialize(schedule):
+    if callable(schedule):
+        return tf.keras.optimizers.schedules.serialize(schedule)
+    return schedule
+
+
+def _deserialize(schedule):
+    if not isinstance(schedule, dict):
+        return schedule
+    custom_objects = {cls.__name__: cls for cls in (
+        TabulatedSchedule, WarmupSchedule, ScaledSchedule, SequentialSchedule)}
+    return tf.keras.optimizers.schedules.deserialize(
+        schedule, custom_objects=custom_objects)
+
+
+def _deserialized(config):
+    # config with its serialized schedule turned back into a schedule.
+    config = dict(config)
+    config['schedule'] = _deserialize(config['schedule'])
+    return config
@@ -0,0 +1,275 @@
+import re
+
+import tensorflow as tf
+
+
+class Lamb(tf.keras.optimizers.Optimizer):
+    # Adam with decoupled weight decay whose update is rescaled per variable
+    # by the trust ratio ||w|| / ||update||, https://arxiv.org/abs/1904.00962.
+    # Variables matching a pattern of exclude_from_weight_decay or
+    # exclude_from_layer_adaptation, usually biases and normalization
+    # parameters, skip the weight decay or the trust ratio. The weight decay
+    # is part of the update the trust ratio rescales, so it is
+    # weight_decay_rate rather than the separately applied weight_decay of
+    # the base class.
+    def __init__(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999,
+                 epsilon=1e-6, weight_decay_rate=0.0,
+                 exclude_from_weight_decay=None,
+                 exclude_from_layer_adaptation=None, name='Lamb', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self._learning_rate = self._build_learning_rate(learning_rate)
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+        self.weight_decay_rate = weight_decay_rate
+        self.exclude_from_weight_decay = list(exclude_from_weight_decay or [])
+        self.exclude_from_layer_adaptation = list(
+            exclude_from_layer_adaptation or [])
+
+    def build(self, var_list):
+        super().build(var_list)
+        if hasattr(self, '_built') and self._built:
+            return
+        self._built = True
+        self._momentums = [
+            self.add_variable_from_reference(model_variable=var,
+                                             variable_name='m')
+            for var in var_list]
+        self._velocities = [
+            self.add_variable_from_reference(model_variable=var,
+                                             variable_name='v')
+            for var in var_list]
+
+    def update_step(self, gradient, variable):
+        # The trust ratio needs the whole update, so sparse gradients are
+        # applied densely.
+        gradient = _densify(gradient, variable)
+        dtype = variable.dtype
+        lr = tf.cast(self.learning_rate, dtype)
+        local_step = tf.cast(self.iterations + 1, dtype)
+        beta_1 = tf.cast(self.beta_1, dtype)
+        beta_2 = tf.cast(self.beta_2, dtype)
+        var_key = self._var_key(variable)
+        m = self._momentums[self._index_dict[var_key]]
+        v = self._velocities[self._index_dict[var_key]]
+        m.assign_add((gradient - m) * (1.0 - beta_1))
+        v.assign_add((tf.square(gradient) - v) * (1.0 - beta_2))
+        update = (m / (1.0 - tf.pow(beta_1, local_step))) / (
+            tf.sqrt(v / (1.0 - tf.pow(beta_2, local_step))) +
+            tf.cast(self.epsilon, dtype))
+        if not _matches(variable, self.exclude_from_weight_decay):
+            update += tf.cast(self.weight_decay_rate, dtype) * variable
+        if not _matches(variable, self.exclude_from_layer_adaptation):
+            update *= _trust_ratio(variable, update)
+        variable.assign_sub(lr * update)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'learning_rate': self._serialize_hyperparameter(
+                self._learning_rate),
+            'beta_1': self.beta_1,
+            'beta_2': self.beta_2,
+            'epsilon': self.epsilon,
+            'weight_decay_rate': self.weight_decay_rate,
+            'exclude_from_weight_decay': self.exclude_from_weight_decay,
+            'exclude_from_layer_adaptation':
+                self.exclude_from_layer_adaptation
+        })
+        return config
+
+
+class Lars(tf.keras.optimizers.Optimizer):
+    # Momentum SGD whose learning rate is scaled per variable by the trust
+    # ratio eeta * ||w|| / (||g|| + weight_decay_rate * ||w|| + epsilon),
+    # https://arxiv.org/abs/1708.03888. Variables matching a pattern of
+    # exclude_from_weight_decay or exclude_from_layer_adaptation skip the
+    # weight decay or the trust ratio.
+    def __init__(self, learning_rate=0.01, momentum=0.9,
+                 weight_decay_rate=0.0, eeta=0.001, epsilon=0.0,
+                 nesterov=False, exclude_from_weight_decay=None,
+                 exclude_from_layer_adaptation=None, name='Lars', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self._learning_rate = self._build_learning_rate(learning_rate)
+        self.momentum = momentum
+        self.weight_decay_rate = weight_decay_rate
+        self.eeta = eeta
+        self.epsilon = epsilon
+        self.nesterov = nesterov
+        self.exclude_from_weight_decay = list(exclude_from_weight_decay or [])
+        self.exclude_from_layer_adaptation = list(
+            exclude_from_layer_adaptation or [])
+
+    def build(self, var_list):
+        super().build(var_list)
+        if hasattr(self, '_built') and self._built:
+            return
+        self._built = True
+        self._momentums = [
+            self.add_variable_from_reference(model_variable=var,
+                                             variable_name='momentum')
+            for var in var_list]
+
+    def update_step(self, gradient, variable):
+        gradient = _densify(gradient, variable)
+        dtype = variable.dtype
+        learning_rate = tf.cast(self.learning_rate, dtype)
+        momentum = tf.cast(self.momentum, dtype)
+        weight_decay_rate = tf.cast(self.weight_decay_rate, dtype)
+        if _matches(variable, self.exclude_from_weight_decay):
+            weight_decay_rate = tf.zeros_like(weight_decay_rate)
+        if not _matches(variable, self.exclude_from_layer_adaptation):
+            var_norm = tf.norm(variable)
+            grad_norm = tf.norm(gradient)
+            trust_ratio = tf.where(
+                tf.logical_and(var_norm > 0.0, grad_norm > 0.0),
+                tf.cast(self.eeta, dtype) * var_norm / (
+                    grad_norm + weight_decay_rate * var_norm +
+                    tf.cast(self.epsilon, dtype)),
+                tf.ones_like(var_norm))
+            learning_rate = learning_rate * trust_ratio
+        update = learning_rate * (gradient + weight_decay_rate * variable)
+        m = self._momentums[self._index_dict[self._var_key(variable)]]
+        m.assign(momentum * m + update)
+        if self.nesterov:
+            update += momentum * m
+        else:
+            update = m
+        variable.assign_sub(update)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'learning_rate': self._serialize_hyperparameter(
+                self._learning_rate),
+            'momentum': self.momentum,
+            'weight_decay_rate': self.weight_decay_rate,
+            'eeta': self.eeta,
+            'epsilon': self.epsilon,
+            'nesterov': self.nesterov,
+            'exclude_from_weight_decay': self.exclude_from_weight_decay,
+            'exclude_from_layer_adaptation':
+                self.exclude_from_layer_adaptation
+        })
+        return config
+
+
+def _trust_ratio(var, update):
+    # ||w|| / ||update||, or 1 when either norm is zero, e.g. for freshly
+    # zero initialized variables.
+    var_norm = tf.norm(var)
+    update_norm = tf.norm(update)
+    return tf.where(tf.logical_and(var_norm > 0.0, update_norm > 0.0),
+                    var_norm / update_norm, tf.ones_like(var_norm))
+
+
+def _matches(var, patterns):
+    return any(re.search(pattern, var.name) is not None
+               for pattern in patterns)
+
+
+def _densify(gradient, variable):
+    if not isinstance(gradient, tf.IndexedSlices):
+        return gradient
+    return tf.math.unsorted_segment_sum(
+        gradient.values, gradient.indices,
+        tf.shape(variable, out_type=gradient.indices.dtype)[0])
+
+
+class GradientAccumulation(tf.keras.optimizers.Optimizer):
+    # Wraps an optimizer so apply_gradients sums the gradients of
+    # accumulation_steps micro-batches into buffers allocated once per
+    # variable and applies their mean with the wrapped optimizer on every
+    # accumulation_steps-th call. The wrapped optimizer, and with it its
+    # learning rate schedule, only advances on applied steps; iterations
+    # counts micro-batches. The accumulation and the conditional apply run
+    # in cross-replica context, as a tf.distribute strategy does not allow
+    # a cond in replica context whose branch calls merge_call.
+    def __init__(self, optimizer, accumulation_steps,
+                 name='GradientAccumulation', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+
+    @property
+    def learning_rate(self):
+        return self.optimizer.learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, learning_rate):
+        self.optimizer.learning_rate = learning_rate
+
+    def build(self, var_list):
+        super().build(var_list)
+        if hasattr(self, '_built') and self._built:
+            return
+        self._built = True
+        self._accumulators = [
+            self.add_variable_from_reference(model_variable=var,
+                                             variable_name='accumulator')
+            for var in var_list]
+        self.optimizer.build(var_list)
+
+    def apply_gradients(self, grads_and_vars, name=None,
+                        skip_gradients_aggregation=False, **kwargs):
+        grads_and_vars = [(grad, var) for grad, var in grads_and_vars
+                          if grad is not None]
+        var_list = [var for _, var in grads_and_vars]
+        with tf.init_scope():
+            # Everything the wrapped optimizer applies inside the cond has to
+            # exist before the first step.
+            self.build(var_list)
+        if not skip_gradients_aggregation:
+            grads_and_vars = self.aggregate_gradients(grads_and_vars)
+        accumulators = [self._accumulators[self._index_dict[
+            self._var_key(var)]] for var in var_list]
+        scale = 1.0 / self.accumulation_steps
+
+        def apply_accumulated():
+            # Gradients are already aggregated across replicas.
+            self.optimizer.apply_gradients(
+                [(accumulator * tf.cast(scale, accumulator.dtype), var)
+                 for accumulator, var in zip(accumulators, var_list)],
+                skip_gradients_aggregation=True)
+
+        def accumulate_and_apply(distribution, grads):
+            for grad, accumulator in zip(grads, accumulators):
+                distribution.extended.update(accumulator, _accumulate,
+                                             args=(grad,), group=False)
+            iterations = self.iterations.assign_add(1)
+
+            def apply():
+                distribution.extended.call_for_each_replica(
+                    apply_accumulated)
+                for accumulator in accumulators:
+                    accumulator.assign(tf.zeros_like(accumulator))
+
+            tf.__internal__.smart_cond.smart_cond(
+                iterations % self.accumulation_steps == 0, apply,
+                lambda: None)
+
+        tf.distribute.get_replica_context().merge_call(
+            accumulate_and_apply, args=([grad for grad, _ in grads_and_vars],))
+        return self.iterations
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'optimizer': tf.keras.optimizers.serialize(self.optimizer),
+            'accumulation_steps': self.accumulation_steps
+        })
+        return config
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        config = dict(config)
+        config['optimizer'] = tf.keras.optimizers.deserialize(
+            config['optimizer'], custom_objects=custom_objects)
+        return cls(**config)
+
+
+def _accumulate(accumulator, grad):
+    if isinstance(grad, tf.IndexedSlices):
+        accumulator.scatter_add(grad)
+    else:
+        accumulator.assign_add(grad)